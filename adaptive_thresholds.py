@@ -0,0 +1,237 @@
+import asyncio
+import math
+import random
+from collections import namedtuple
+
+# Per-route behavioral thresholds learned from traffic. Every route keeps
+# fixed-size KLL quantile sketches of the RPM and inter-arrival variance of
+# the clients that hit it; a background task turns configured percentiles of
+# those into scaled copies of the static thresholds and swaps the whole table
+# in one assignment, so the request path only does a dict lookup.
+
+# Same fields as the static constants in api_abuse_detection.py
+RouteLimits = namedtuple("RouteLimits", "flood_rpm rpm_tiers bot_variance bot_min_rpm")
+
+# Paths that are not one of the app's static routes share one entry, so
+# random paths cannot allocate sketches
+OTHER_ROUTE = "*"
+
+
+class KLLSketch:
+    # KLL quantile sketch (Karnin, Lang, Liberty 2016): a stack of compactors
+    # whose capacities shrink geometrically towards the bottom level. A full
+    # compactor sorts itself and promotes every other item (randomly the odd
+    # or even ones) to the level above, where each item weighs twice as much.
+    # About k / (1 - c) items are retained however long the stream; the rank
+    # error is O(1 / k).
+
+    def __init__(self, k=200, c=2 / 3):
+        self.k = k
+        self.c = c
+        self.compactors = [[]]
+        self.retained = 0
+        self.count = 0
+        self._resize()
+
+    def __len__(self):
+        return self.count
+
+    def _resize(self):
+        # Capacities depend on the height, so they change when a level is added
+        height = len(self.compactors)
+        self.capacities = [int(math.ceil(self.k * self.c ** (height - level - 1))) + 1 for level in range(height)]
+        self.limit = sum(self.capacities)
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.count += 1
+        self.retained += 1
+        if self.retained >= self.limit:
+            self._compress()
+
+    def _compress(self):
+        while self.retained >= self.limit:
+            for level, items in enumerate(self.compactors):
+                if len(items) < self.capacities[level]:
+                    continue
+                if level + 1 == len(self.compactors):
+                    self.compactors.append([])
+                    self._resize()
+                items.sort()
+                # An odd item out stays behind
+                keep = [items.pop()] if len(items) % 2 else []
+                promoted = items[random.getrandbits(1)::2]
+                self.compactors[level + 1].extend(promoted)
+                self.retained += len(promoted) - len(items)
+                items[:] = keep
+                break
+
+    def merge(self, other):
+        # Folds `other` in (same k); the result keeps the same error bound
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for level, items in enumerate(other.compactors):
+            self.compactors[level].extend(items)
+        self.count += other.count
+        self.retained = sum(len(items) for items in self.compactors)
+        self._resize()
+        self._compress()
+
+    def quantile(self, q):
+        if not self.retained:
+            return None
+        weighted = sorted(
+            (value, 1 << level) for level, items in enumerate(self.compactors) for value in items
+        )
+        total = sum(weight for _, weight in weighted)
+        rank = q * total
+        seen = 0
+        for value, weight in weighted:
+            seen += weight
+            if seen >= rank:
+                return value
+        return weighted[-1][0]
+
+
+class RouteStats:
+    # Two tumbling windows per metric: quantiles cover the current and the
+    # previous window, so old traffic ages out without unbounded memory
+    __slots__ = ("rpm", "variance", "previous_rpm", "previous_variance", "samples")
+
+    def __init__(self, k):
+        self.rpm = KLLSketch(k)
+        self.variance = KLLSketch(k)
+        self.previous_rpm = KLLSketch(k)
+        self.previous_variance = KLLSketch(k)
+        self.samples = 0
+
+    def rotate(self, k):
+        self.previous_rpm, self.rpm = self.rpm, KLLSketch(k)
+        self.previous_variance, self.variance = self.variance, KLLSketch(k)
+
+    def merged(self, name, k):
+        sketch = KLLSketch(k)
+        sketch.merge(getattr(self, "previous_" + name))
+        sketch.merge(getattr(self, name))
+        return sketch
+
+
+class AdaptiveThresholds:
+    # `rpm_percentile` of a route's clients marks where its lowest RPM tier
+    # starts: every RPM threshold is scaled by (that RPM / lowest static tier),
+    # clamped to [min_scale, max_scale]. The bot-speed variance becomes the
+    # route's `variance_percentile`, clamped to the static value divided by
+    # the same range. The default range only ever relaxes the static values.
+    # A route uses the static thresholds until it has `min_samples` samples.
+    # Requests are sampled with probability 1 / rpm, so every client counts
+    # about once per RPM window however fast it sends.
+
+    def __init__(self, routes=(), rpm_percentile=0.99, variance_percentile=0.05,
+                 min_scale=1.0, max_scale=10.0, min_samples=500, interval=10.0,
+                 window=3600.0, k=200, enabled=True):
+        self.rpm_percentile = rpm_percentile
+        self.variance_percentile = variance_percentile
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.min_samples = min_samples
+        self.interval = interval
+        self.window = window
+        self.k = k
+        self.enabled = enabled
+        self.routes = {}
+        self.track(routes)
+        # route -> RouteLimits, replaced as a whole by recompute()
+        self.current = {}
+        self.recomputes = 0
+        self._task = None
+
+    def track(self, routes):
+        for route in (*routes, OTHER_ROUTE):
+            if route not in self.routes:
+                self.routes[route] = RouteStats(self.k)
+
+    def limits(self, route):
+        # None: score with the static thresholds
+        if route not in self.routes:
+            route = OTHER_ROUTE
+        return self.current.get(route)
+
+    def observe(self, route, rpm, variance, history):
+        # `history`: timestamps the client has on record; variance is only
+        # meaningful from three (two gaps) on
+        if rpm > 1 and random.random() * rpm >= 1:
+            return
+        stats = self.routes.get(route) or self.routes[OTHER_ROUTE]
+        stats.rpm.add(rpm)
+        if history >= 3:
+            stats.variance.add(variance)
+        stats.samples += 1
+
+    def derive(self, stats, static):
+        flood_rpm, rpm_tiers, bot_variance, bot_min_rpm = static
+        rpm = stats.merged("rpm", self.k)
+        if len(rpm) < self.min_samples:
+            return None
+        scale = rpm.quantile(self.rpm_percentile) / rpm_tiers[-1][0]
+        scale = min(max(scale, self.min_scale), self.max_scale)
+        variance = stats.merged("variance", self.k)
+        if len(variance) >= self.min_samples:
+            observed = variance.quantile(self.variance_percentile)
+            bot_variance = min(max(observed, bot_variance / self.max_scale), bot_variance / self.min_scale)
+        return RouteLimits(
+            math.ceil(flood_rpm * scale),
+            tuple((math.ceil(min_rpm * scale), bot_score, human_score) for min_rpm, bot_score, human_score in rpm_tiers),
+            bot_variance,
+            math.ceil(bot_min_rpm * scale),
+        )
+
+    def recompute(self, static):
+        # `static`: (flood_rpm, rpm_tiers, bot_variance, bot_min_rpm)
+        current = {}
+        for route, stats in self.routes.items():
+            limits = self.derive(stats, static)
+            if limits is not None:
+                current[route] = limits
+        self.current = current
+        self.recomputes += 1
+        return current
+
+    def rotate(self):
+        for stats in self.routes.values():
+            stats.rotate(self.k)
+
+    async def _run_forever(self, static):
+        # `static` is a callable so tuning changes to the constants are seen
+        elapsed = 0.0
+        while True:
+            await asyncio.sleep(self.interval)
+            elapsed += self.interval
+            if elapsed >= self.window:
+                elapsed = 0.0
+                self.rotate()
+            # Sorting a few thousand retained items per route: cheap enough
+            # for the event loop, and the swap itself is one assignment
+            self.recompute(static())
+
+    def start(self, static):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever(static))
+        return self._task
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "rpm_percentile": self.rpm_percentile,
+            "variance_percentile": self.variance_percentile,
+            "scale_range": [self.min_scale, self.max_scale],
+            "min_samples": self.min_samples,
+            "recomputes": self.recomputes,
+            "routes": {
+                route: {
+                    "samples": stats.samples,
+                    "retained": sum(sketch.retained for sketch in (stats.rpm, stats.variance, stats.previous_rpm, stats.previous_variance)),
+                    "limits": self.current[route]._asdict() if route in self.current else None,
+                }
+                for route, stats in self.routes.items()
+            },
+        }
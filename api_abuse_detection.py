@@ -1,100 +1,375 @@
+import os
 import time
 import asyncio
 import hashlib
-import statistics
+import functools
+import contextlib
 import uvicorn
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, HTMLResponse
-from collections import defaultdict, deque
+from fastapi.responses import JSONResponse, HTMLResponse, Response, StreamingResponse
+from starlette.datastructures import QueryParams
+from client_store import ClientStateStore
+from shared_state import SharedState
+from state_backend import LocalStateBackend
+from redis_backend import RedisStateBackend
+from tarpit import OVERFLOW_REJECT, OVERFLOW_SHED, TarpitScheduler
+from signature_engine import SignatureEngine
+from rule_pipeline import BLOCK as BLOCK_ACTION, TARPIT as TARPIT_ACTION, ALLOW as ALLOW_ACTION, PolicyEngine, RequestFacts
+from status_feed import ChangeLog, sse_event, top_by_risk
+from prefix_blocks import ALLOW, DENY, PrefixPolicy
+from heavy_hitters import HeavyHitterFilter
+from adaptive_thresholds import AdaptiveThresholds, RouteLimits
+from metrics import Metrics
+from event_log import EventLog
+from snapshot import StatePersistence
+from behavior_features import RPM_WINDOW
+from stream_inspection import (
+    DEFAULT_BODY_TYPES,
+    DEFAULT_SKIP_HEADERS,
+    BodyInspector,
+    body_mode,
+    scan_headers,
+)
 
 # 1. App initialization
-app = FastAPI(title="Flow Lock - Enterprise Behavioral Defense")
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Background tasks (section 10) run for the lifetime of the server
+    await start_background_tasks()
+    try:
+        yield
+    finally:
+        await stop_background_tasks()
+
+app = FastAPI(title="Flow Lock - Enterprise Behavioral Defense", lifespan=lifespan)
 
 # 2. Global variables
 
+# Browser fingerprint: the values of FINGERPRINT_HEADERS plus the order in
+# which the client sends the ORDER_HEADERS it has. Only headers a browser
+# build sends the same way on every request count: anything else (custom
+# headers, Accept, which changes with the resource type, Sec-Fetch-*) would
+# let a client change its fingerprint by adding or varying a header.
+FINGERPRINT_HEADERS = frozenset((b"user-agent", b"accept-language", b"accept-encoding"))
+ORDER_HEADERS = frozenset((
+    b"host", b"connection", b"user-agent", b"accept", b"accept-language", b"accept-encoding",
+    b"sec-ch-ua", b"sec-ch-ua-mobile", b"sec-ch-ua-platform",
+))
+FINGERPRINT_CACHE_SIZE = int(os.environ.get("FLOWLOCK_FINGERPRINT_CACHE", "4096"))
+
 def generate_fingerprint(request: Request):
-    # We combine the User-Agent and Accept-Language headers
-    user_agent = request.headers.get("user-agent", "unknown")
-    language = request.headers.get("accept-language", "unknown")
-    raw_id = f"{user_agent}|{language}"
-    # Create a unique 8-character ID for this "browser/bot type"
-    return hashlib.md5(raw_id.encode()).hexdigest()[:8]
-
-request_logs = defaultdict(lambda: deque(maxlen=100))
-blocked_ips = {}
-block_reasons = {}
-honeypot_victims = set()
-blocked_fingerprints = set()
-highest_risk_seen = defaultdict(float)
+    return request_fingerprint(request.scope)
+
+def request_fingerprint(scope):
+    # Computed once per request and kept on the ASGI scope for later layers
+    # (the honeypot route, the http middleware flavour)
+    fingerprint = scope.get("flowlock.fingerprint")
+    if fingerprint is None:
+        fingerprint = scope["flowlock.fingerprint"] = fingerprint_from_headers(scope.get("headers") or ())
+    return fingerprint
+
+def fingerprint_from_headers(raw_headers):
+    # Raw ASGI (name, value) pairs, names lowercased
+    return fingerprint_digest(tuple(
+        (name, value) if name in FINGERPRINT_HEADERS else (name, b"")
+        for name, value in raw_headers if name in ORDER_HEADERS
+    ))
+
+@functools.lru_cache(maxsize=FINGERPRINT_CACHE_SIZE)
+def fingerprint_digest(key):
+    # Clients of one browser/bot build send identical keys, hence the cache
+    return hashlib.blake2b(b"\n".join(b"%s:%s" % item for item in key), digest_size=8).hexdigest()
+
+# Per-client memory (behavior, risk, blocks) lives in one bounded store:
+# at most FLOWLOCK_MAX_CLIENTS entries, idle clients dropped after FLOWLOCK_CLIENT_TTL seconds
+MAX_CLIENTS = int(os.environ.get("FLOWLOCK_MAX_CLIENTS", "100000"))
+CLIENT_TTL = float(os.environ.get("FLOWLOCK_CLIENT_TTL", "600"))
+
+def create_state_backend():
+    # FLOWLOCK_STATE_BACKEND=redis shares state across API nodes (FLOWLOCK_REDIS_URL).
+    # Multi-worker mode (FLOWLOCK_WORKERS > 1): the parent creates shared-memory
+    # tables and every worker attaches to them, so all workers enforce one policy.
+    if os.environ.get("FLOWLOCK_STATE_BACKEND", "memory").lower() == "redis":
+        return RedisStateBackend(
+            os.environ.get("FLOWLOCK_REDIS_URL", "redis://127.0.0.1:6379/0"),
+            pool_size=int(os.environ.get("FLOWLOCK_REDIS_POOL", "8")),
+            idle_ttl=CLIENT_TTL,
+        )
+    if os.environ.get("FLOWLOCK_SHARED_STATE"):
+        shared = SharedState.attach(os.environ["FLOWLOCK_SHARED_STATE"], idle_ttl=CLIENT_TTL)
+        return LocalStateBackend(shared.clients, shared.fingerprints)
+    return LocalStateBackend(ClientStateStore(max_entries=MAX_CLIENTS, idle_ttl=CLIENT_TTL), set())
+
+state_backend = create_state_backend()
+
+def create_persistence(store, fingerprints, shared=False):
+    # Warm restart (FLOWLOCK_SNAPSHOT=<file>): blocks, blacklisted fingerprints
+    # and client history are reloaded on startup and written back every
+    # FLOWLOCK_SNAPSHOT_INTERVAL seconds and at shutdown. Redis persists on its
+    # own. Shared memory: the parent loads the snapshot before the workers
+    # start and the sweeping worker writes it, without a journal.
+    path = os.environ.get("FLOWLOCK_SNAPSHOT")
+    if not path:
+        return None
+    return StatePersistence(
+        path, store, fingerprints,
+        interval=float(os.environ.get("FLOWLOCK_SNAPSHOT_INTERVAL", "300")),
+        idle_ttl=CLIENT_TTL,
+        journal=not shared,
+    )
+
+persistence = None
+if isinstance(state_backend, LocalStateBackend):
+    persistence = create_persistence(
+        state_backend.store, state_backend.fingerprints, shared=bool(os.environ.get("FLOWLOCK_SHARED_STATE")),
+    )
+    if persistence is not None:
+        state_backend.journal = persistence.journal
+
+# How often the background sweeper lifts expired blocks and drops idle clients
+SWEEP_INTERVAL = 1.0
+
+# Tarpit: one shared timer wheel with caps on how many connections it may hold
+tarpit = TarpitScheduler(
+    max_held=int(os.environ.get("FLOWLOCK_TARPIT_MAX_HELD", "1000")),
+    max_per_client=int(os.environ.get("FLOWLOCK_TARPIT_MAX_PER_CLIENT", "4")),
+    overflow=os.environ.get("FLOWLOCK_TARPIT_OVERFLOW", OVERFLOW_REJECT),
+    min_delay=float(os.environ.get("FLOWLOCK_TARPIT_MIN_DELAY", "2")),
+    max_delay=float(os.environ.get("FLOWLOCK_TARPIT_MAX_DELAY", "4")),
+)
+
+# Prefix policy (see prefix_blocks.py), checked before any per-client state:
+# FLOWLOCK_ALLOW_CIDRS / FLOWLOCK_DENY_CIDRS are comma-separated CIDR lists;
+# once FLOWLOCK_PREFIX_PROMOTE_AFTER addresses of one /24 (IPv4) or /64 (IPv6)
+# are blocked, or the prefix sends more than FLOWLOCK_PREFIX_RPM requests a
+# minute (0 = off), the whole prefix is blocked for FLOWLOCK_PREFIX_BLOCK_SECONDS
+def env_list(name):
+    return [item.strip() for item in os.environ.get(name, "").split(",") if item.strip()]
+
+prefix_policy = PrefixPolicy(
+    allow=env_list("FLOWLOCK_ALLOW_CIDRS"),
+    deny=env_list("FLOWLOCK_DENY_CIDRS"),
+    promote_after=int(os.environ.get("FLOWLOCK_PREFIX_PROMOTE_AFTER", "4")),
+    v4_prefix=int(os.environ.get("FLOWLOCK_PREFIX_V4", "24")),
+    v6_prefix=int(os.environ.get("FLOWLOCK_PREFIX_V6", "64")),
+    block_seconds=float(os.environ.get("FLOWLOCK_PREFIX_BLOCK_SECONDS", "300")),
+    prefix_rpm=int(os.environ.get("FLOWLOCK_PREFIX_RPM", "3000")),
+)
+
+# Prometheus metrics (see metrics.py), served at /metrics: verdicts, blocks,
+# tarpits and fingerprint hits, plus a latency histogram per pipeline stage
+metrics = Metrics(stages=("fingerprint", "block_check", "features", "scoring", "commit", "tarpit", "downstream"))
+metrics.counter("flowlock_requests_total", "Inspected requests by verdict and reason", ("verdict", "reason"))
+metrics.counter("flowlock_blocks_total", "Client blocks by reason", ("reason",))
+metrics.counter("flowlock_tarpits_total", "Tarpitted requests by outcome", ("outcome",))
+metrics.counter("flowlock_fingerprint_hits_total", "Requests denied by the fingerprint blacklist")
+metrics.counter("flowlock_fingerprints_blacklisted_total", "Fingerprints blacklisted by the honeypot")
+metrics.counter("flowlock_rule_hits_total", "Requests decided by each scoring policy rule", ("rule",))
+
+# Security events (blocks, subnet blocks, tarpits, blacklisted fingerprints,
+# failed rule reloads) go through event_log.py: batched JSONL written off the
+# event loop to FLOWLOCK_EVENT_LOG ("{pid}" is replaced by the process id, "-"
+# writes to stdout), rotated at FLOWLOCK_EVENT_LOG_MAX_BYTES keeping
+# FLOWLOCK_EVENT_LOG_BACKUPS old files. The default is flowlock-events.jsonl,
+# one file per worker in multi-worker mode (workers must not rotate each
+# other's file). Up to FLOWLOCK_EVENT_LOG_CAPACITY events wait in memory;
+# beyond that new events are dropped (and counted) rather than slowing
+# requests down.
+EVENT_LOG_PATH = os.environ.get("FLOWLOCK_EVENT_LOG") or (
+    "flowlock-events.{pid}.jsonl" if os.environ.get("FLOWLOCK_SHARED_STATE") else "flowlock-events.jsonl"
+)
+event_log = EventLog(
+    path=None if EVENT_LOG_PATH == "-" else EVENT_LOG_PATH.replace("{pid}", str(os.getpid())),
+    capacity=int(os.environ.get("FLOWLOCK_EVENT_LOG_CAPACITY", "8192")),
+    flush_interval=float(os.environ.get("FLOWLOCK_EVENT_LOG_FLUSH_INTERVAL", "1.0")),
+    batch_size=int(os.environ.get("FLOWLOCK_EVENT_LOG_BATCH", "512")),
+    max_bytes=int(os.environ.get("FLOWLOCK_EVENT_LOG_MAX_BYTES", str(64 * 1024 * 1024))),
+    backups=int(os.environ.get("FLOWLOCK_EVENT_LOG_BACKUPS", "5")),
+)
+
+# Dashboard change feed: per-client views are published only when they change
+change_log = ChangeLog()
+
+def client_view(ip, risk, blocked_until, reason, honeypot, variance, now):
+    blocked = blocked_until > now
+    return {
+        "ip": ip,
+        "risk": 100 if blocked else int(risk),
+        "blocked": blocked,
+        "reason": (reason or "SECURITY_POLICY_VIOLATION") if blocked else None,
+        "honeypot": bool(honeypot) and blocked,
+        "blocked_until": blocked_until if blocked else 0,
+        "variance": variance,
+    }
+
+def state_view(ip, state, now):
+    # A client's stored highest risk already covers its live behavioral score
+    return client_view(ip, state.highest_risk, state.blocked_until, state.block_reason,
+                       state.honeypot, state.snapshot(now)["variance"], now)
 
 # 3. Helper functions (Sensors)
 def extract_behavior_features(ip: str):
-    logs = list(request_logs[ip])
-    if len(logs) < 2:
-        return {"rpm": len(logs), "variance": 1.0}
+    # O(1): the per-client accumulator keeps rpm/variance up to date as
+    # timestamps arrive (see behavior_features.py)
+    state = state_backend.peek(ip)
+    if state is None:
+        return {"rpm": 0, "variance": 1.0}
+    return state.snapshot()
 
-    now = time.time()
-    recent_requests = [t for t in logs if t > (now - 120)]
-    rpm = len(recent_requests)
-    
-    gaps = [logs[i] - logs[i-1] for i in range(1, len(logs))]
-    try:
-        var_value = statistics.variance(gaps) if len(gaps) > 1 else 0.0
-    except:
-        var_value = 0.0
+import urllib.parse
 
-    return {"rpm": rpm, "variance": round(var_value, 6)}
+# Compiled once at startup; set FLOWLOCK_SIGNATURES to a JSON rule file to
+# load threat-feed signatures (hot-reloaded when the file changes)
+signature_engine = SignatureEngine(os.environ.get("FLOWLOCK_SIGNATURES"), events=event_log)
 
-import urllib.parse
+# Risk scoring policy (see rule_pipeline.py): the built-in policy is the
+# honeypot -> signature -> behavior layering; FLOWLOCK_POLICY names a JSON or
+# YAML policy instead (hot-reloaded when the file changes)
+policy_engine = PolicyEngine(os.environ.get("FLOWLOCK_POLICY"), events=event_log)
+
+# Streaming body/header inspection (see stream_inspection.py): the first
+# FLOWLOCK_BODY_SCAN_BYTES of each body (0 disables) whose content type is in
+# FLOWLOCK_BODY_CONTENT_TYPES, and every header not in FLOWLOCK_HEADER_SCAN_SKIP
+# (comma-separated names, "prefix*" for a family; default DEFAULT_SKIP_HEADERS)
+BODY_SCAN_BYTES = int(os.environ.get("FLOWLOCK_BODY_SCAN_BYTES", "65536"))
+BODY_CONTENT_TYPES = tuple(
+    t.strip().lower() for t in os.environ.get("FLOWLOCK_BODY_CONTENT_TYPES", ",".join(DEFAULT_BODY_TYPES)).split(",") if t.strip()
+)
+HEADER_SCAN_SKIP = tuple(
+    h.strip().lower() for h in os.environ.get("FLOWLOCK_HEADER_SCAN_SKIP", ",".join(DEFAULT_SKIP_HEADERS)).split(",") if h.strip()
+)
 
 # 4. Risk Score Calculation (Optimized for Tarpit Demo)
-def calculate_risk_score(features, ip, query_params=""):
-    # LAYER 0: Honeypot Check (Instant Kill)
-    if ip in honeypot_victims:
-        return 100, "HONEYPOT_BREACH"
-    
+
+# --- TUNABLE THRESHOLDS (shared with replay.py for offline tuning) ---
+# Requests inside the RPM window that count as a flood (instant block)
+FLOOD_RPM = 15
+# (min rpm, score at bot speed, score otherwise), checked top-down
+RPM_TIERS = (
+    (8, 85, 50),  # Hits 85% much sooner
+    (5, 70, 40),  # Hits 70% sooner
+    (2, 60, 20),  # Starts Tarpitting almost immediately
+)
+# "Bot speed": request gaps steadier than this variance, above this rpm
+BOT_VARIANCE = 0.5
+BOT_MIN_RPM = 2
+# Risk at which requests are tarpitted / the client is blocked
+TARPIT_RISK = 55
+BLOCK_RISK = 100
+BLOCK_SECONDS = 60
+HONEYPOT_BLOCK_SECONDS = 86400
+
+# Heavy-hitter front line (see heavy_hitters.py), off by default: with
+# FLOWLOCK_HEAVY_HITTER_RPM set, a client gets an exact per-client record once
+# its estimated request count over RPM_WINDOW reaches it. A fingerprint
+# reaching FLOWLOCK_HEAVY_FINGERPRINT_RPM marks all its clients (0 = never).
+# The trade-off: a client's history starts at the request that promotes it,
+# so the RPM tiers and the flood block see up to threshold - 1 fewer requests
+# (a flood is blocked that many requests later). replay.py models the default.
+# FLOWLOCK_CMS_EPSILON / FLOWLOCK_CMS_DELTA bound the overcount: at most
+# epsilon * requests per window, with probability 1 - delta. Memory is fixed at
+# about 2 * 4 * (e / epsilon) * ln(1 / delta) bytes per sketch (6.5 MB each by
+# default), allocated on the first request once the filter is enabled; an
+# overcount only means a client is tracked exactly after all.
+# The sketches are per process: each of FLOWLOCK_WORKERS shared-memory workers
+# counts only the requests it serves, so each promotes at threshold / workers
+# (a client reaching the threshold overall reaches that in some worker). With
+# the Redis backend the thresholds apply per API node.
+def heavy_hitter_threshold(name):
+    threshold = int(os.environ.get(name, "0"))
+    workers = int(os.environ.get("FLOWLOCK_WORKERS", "1")) if os.environ.get("FLOWLOCK_SHARED_STATE") else 1
+    return -(-threshold // max(workers, 1))
+
+heavy_hitters = HeavyHitterFilter(
+    ip_threshold=heavy_hitter_threshold("FLOWLOCK_HEAVY_HITTER_RPM"),
+    fingerprint_threshold=heavy_hitter_threshold("FLOWLOCK_HEAVY_FINGERPRINT_RPM"),
+    window=RPM_WINDOW,
+    epsilon=float(os.environ.get("FLOWLOCK_CMS_EPSILON", "0.00001")),
+    delta=float(os.environ.get("FLOWLOCK_CMS_DELTA", "0.05")),
+    top_k=int(os.environ.get("FLOWLOCK_TOP_K", "100")),
+)
+
+# Adaptive per-route thresholds (see adaptive_thresholds.py), on with
+# FLOWLOCK_ADAPTIVE=1. The constants above are scaled per route so that the
+# FLOWLOCK_ADAPTIVE_RPM_PERCENTILE client sits at the lowest RPM tier, within
+# FLOWLOCK_ADAPTIVE_MIN_SCALE..FLOWLOCK_ADAPTIVE_MAX_SCALE; bot-speed variance
+# follows FLOWLOCK_ADAPTIVE_VARIANCE_PERCENTILE. Recomputed every
+# FLOWLOCK_ADAPTIVE_INTERVAL seconds over the last one to two
+# FLOWLOCK_ADAPTIVE_WINDOWs, once a route has FLOWLOCK_ADAPTIVE_MIN_SAMPLES.
+adaptive_thresholds = AdaptiveThresholds(
+    rpm_percentile=float(os.environ.get("FLOWLOCK_ADAPTIVE_RPM_PERCENTILE", "0.99")),
+    variance_percentile=float(os.environ.get("FLOWLOCK_ADAPTIVE_VARIANCE_PERCENTILE", "0.05")),
+    min_scale=float(os.environ.get("FLOWLOCK_ADAPTIVE_MIN_SCALE", "1")),
+    max_scale=float(os.environ.get("FLOWLOCK_ADAPTIVE_MAX_SCALE", "10")),
+    min_samples=int(os.environ.get("FLOWLOCK_ADAPTIVE_MIN_SAMPLES", "500")),
+    interval=float(os.environ.get("FLOWLOCK_ADAPTIVE_INTERVAL", "10")),
+    window=float(os.environ.get("FLOWLOCK_ADAPTIVE_WINDOW", "3600")),
+    enabled=os.environ.get("FLOWLOCK_ADAPTIVE", "0") == "1",
+)
+
+def static_limits():
+    # Read at every recompute, so replay.py overrides are picked up
+    return RouteLimits(FLOOD_RPM, RPM_TIERS, BOT_VARIANCE, BOT_MIN_RPM)
+
+def scan_signatures(query_params: str):
     # Normalize input for signature scanning
     # We decode %20, %27, etc., and lowercase everything to prevent bypasses
     decoded_params = urllib.parse.unquote(query_params).lower()
 
-    # LAYER 1: Signature Detection (Instant 100% Blocks)
-    
-    # A. JAILBREAK (LLM / Code Injection)
-    jailbreak_sigs = ["__import__", "subprocess", "eval(", "system_override", "ignore instructions"]
-    if any(sig in decoded_params for sig in jailbreak_sigs):
-        return 100, "JAILBREAK_ATTEMPT"
-
-    # B. SQL INJECTION (Database Attacks)
-    sqli_sigs = ["' or '1'='1", "union select", "drop table", "--", "1=1", "admin'--"]
-    if any(sig in decoded_params for sig in sqli_sigs):
-        return 100, "SQL_INJECTION_DETECTED"
-
-    # C. PATH TRAVERSAL (System File Access)
-    lfi_sigs = ["../", "..\\", "/etc/passwd", "c:\\windows", "boot.ini"]
-    if any(sig in decoded_params for sig in lfi_sigs):
-        return 100, "PATH_TRAVERSAL_ATTEMPT"
-
-    # LAYER 2: Behavioral Logic
-    score = 0
-    rpm = features['rpm']
-    variance = features['variance']
-    is_bot_speed = variance < 0.5 and rpm > 2
-    
+    # Jailbreak -> SQL injection -> path traversal, all scanned in one pass
+    # by the compiled automaton (see signature_engine.py)
+    return signature_engine.scan(decoded_params)
+
+def scan_request_signatures(query_params: str, headers=None):
+    # Query string first, then the raw ASGI header list
+    signature_hit = scan_signatures(query_params)
+    if not signature_hit and headers:
+        signature_hit = scan_headers(signature_engine, headers, HEADER_SCAN_SKIP)
+    return signature_hit
+
+def behavioral_score(rpm, variance, limits=None):
+    # `limits`: a route's adaptive RouteLimits; None scores with the constants
+    if limits is None:
+        flood_rpm, rpm_tiers, bot_variance, bot_min_rpm = FLOOD_RPM, RPM_TIERS, BOT_VARIANCE, BOT_MIN_RPM
+    else:
+        flood_rpm, rpm_tiers, bot_variance, bot_min_rpm = limits
+    is_bot_speed = variance < bot_variance and rpm > bot_min_rpm
+
     # --- REDUCED THRESHOLDS FOR FASTER DEMO ---
-    if rpm >= 15: 
+    if rpm >= flood_rpm:
         return 100, "VOLUMETRIC_FLOOD"
-    
-    elif rpm >= 8: # Hits 85% much sooner
-        score = 85 if is_bot_speed else 50
-        
-    elif rpm >= 5: # Hits 70% sooner
-        score = 70 if is_bot_speed else 40
-        
-    elif rpm >= 2: # Starts Tarpitting almost immediately
-        score = 60 if is_bot_speed else 20
-        
-    reason = "BEHAVIORAL_ANOMALY" if score >= 100 else "SCANNING"
-    return int(score), reason
+    for min_rpm, bot_score, human_score in rpm_tiers:
+        if rpm >= min_rpm:
+            return (bot_score if is_bot_speed else human_score), "SCANNING"
+    return 0, "SCANNING"
+
+def assess_risk(features, ip, query_params="", state=None, headers=None, limits=None, fingerprint="", route=""):
+    # (score, reason, action) from the first matching policy rule.
+    # The signature scan and the behavioral score only run if a rule needs them.
+    if state is None:
+        state = state_backend.peek(ip)
+    policy_engine.maybe_reload()
+    pipeline = policy_engine.pipeline
+    if limits is None and pipeline.uses_limits:
+        limits = static_limits()
+    tracked = state is not None
+    facts = RequestFacts(
+        route or "", fingerprint or "",
+        tracked and state.honeypot,
+        features['rpm'], features['variance'],
+        len(state) if tracked else 0,
+        state.highest_risk if tracked else 0,
+        limits, query_params, headers,
+        scan_request_signatures, behavioral_score,
+    )
+    score, reason, action, rule = pipeline.evaluate(facts)
+    if rule is not None:
+        metrics.inc("flowlock_rule_hits_total", rule)
+    return int(score), reason, action
+
+def calculate_risk_score(features, ip, query_params="", state=None, headers=None, limits=None):
+    score, reason, _ = assess_risk(features, ip, query_params, state, headers, limits)
+    return score, reason
 # 5. THE HONEYPOT (Deception Layer)
 
 # --- USP 3: SHADOW DATA (DECEPTION UI) ---
@@ -162,86 +437,280 @@ async def honeypot_trap(request: Request):
     # --- NEW: Extract Digital DNA ---
     fingerprint = generate_fingerprint(request)
     
-    # 1. Log the victim (IP-based)
-    honeypot_victims.add(client_ip)
-    
-    # 2. Block the IP for 24 hours
-    blocked_ips[client_ip] = now + 86400 
-
-    block_reasons[client_ip] = "HONEYPOT_BREACH"
+    # 1. Log the victim (IP-based) and 2. Block the IP for 24 hours
+    await state_backend.block_ip(client_ip, now + HONEYPOT_BLOCK_SECONDS, "HONEYPOT_BREACH", now, honeypot=True)
     
     # --- NEW: Permanently Blacklist the Device Fingerprint ---
-    blocked_fingerprints.add(fingerprint)
-    print(f"!!! FINGERPRINT BLACKLISTED: {fingerprint} !!!")
+    await state_backend.block_fingerprint(fingerprint)
+    metrics.inc("flowlock_fingerprints_blacklisted_total")
+    event_log.emit("fingerprint_blacklisted", ip=client_ip, fingerprint=fingerprint)
+
+    state = state_backend.peek(client_ip)
+    variance = state.snapshot(now)["variance"] if state is not None else None
+    change_log.publish(client_view(client_ip, 100, now + HONEYPOT_BLOCK_SECONDS, "HONEYPOT_BREACH", True, variance, now))
+    note_block(client_ip, now + HONEYPOT_BLOCK_SECONDS, now, "HONEYPOT_BREACH", fingerprint=fingerprint)
 
     # 3. Call and RETURN the HTML function directly
     return await shadow_data_vault()
 
-@app.middleware("http")
-async def abuse_detection_middleware(request: Request, call_next):
-    # Ensure we can modify the global risk memory
-    global highest_risk_seen 
-    
-    client_ip = request.client.host
-    fingerprint = generate_fingerprint(request) 
-    now = time.time()
-    
-    # 1. Capture URL Parameters for Signature Scanning
-    query_params = str(request.query_params)
-    
-    # 2. Bypass check for status page and honeypot logic
-    if request.url.path in ["/status", "/api/v1/debug_login"]:
-        return await call_next(request)
+# 6. THE DETECTION PIPELINE (shared by both middleware flavours)
+
+# Paths that skip detection entirely (dashboard + honeypot bookkeeping)
+BYPASS_PATHS = ("/status", "/metrics", "/api/v1/debug_login")
+
+def is_bypass_path(path: str):
+    return path in BYPASS_PATHS or path.startswith("/status/")
+
+async def inspect_request(client_ip: str, fingerprint: str, query_params: str, headers=None, path=None, now=None):
+    # Runs LAYER 0 - LAYER 4 for one request.
+    # Returns (denial_response, risk_score): a response to send instead of
+    # calling the app, or None plus the risk score to report downstream.
+    # `now` is only passed by replay.py --check (recorded arrival time)
+    if now is None:
+        now = time.time()
+    lap = time.perf_counter_ns()
+
+    # --- LAYER 0a: PREFIX POLICY (allow/deny lists, subnet blocks) ---
+    # One longest-prefix walk before any per-client state is touched, so an
+    # address sprayed from a blocked subnet costs no state round trip and
+    # creates no record
+    rule = prefix_policy.lookup(client_ip, now)
+    if rule is None:
+        rule = prefix_policy.count_request(client_ip, now)
+        if rule is not None:
+            event_log.emit("subnet_block", network=rule.network, reason=rule.reason, until=rule.until)
+    if rule is not None:
+        metrics.lap("block_check", lap)
+        if rule.kind == ALLOW:
+            metrics.inc("flowlock_requests_total", "allow", "ALLOWLIST")
+            return None, 0
+        prefix_policy.denied += 1
+        metrics.inc("flowlock_requests_total", "prefix", rule.reason or "DENYLIST")
+        return prefix_denial(rule, now), None
+
+    # --- LAYER 0b: HEAVY-HITTER FRONT LINE ---
+    # Clients below the threshold have no behavior worth scoring yet. Unless
+    # they already have a record (block, honeypot, earlier history) or send a
+    # signature, they allocate no per-client state. screen() is the same
+    # single round trip as observe(); only a signature from a client without
+    # a record costs a second one.
+    if heavy_hitters.enabled and not heavy_hitters.observe(client_ip, fingerprint, now):
+        fingerprint_blocked, state = await state_backend.screen(client_ip, fingerprint, now)
+        if state is None and not fingerprint_blocked:
+            if not scan_request_signatures(query_params, headers):
+                metrics.lap("block_check", lap)
+                metrics.inc("flowlock_requests_total", "allow", "LIGHT_CLIENT")
+                return None, 0
+            fingerprint_blocked, state = await state_backend.observe(client_ip, fingerprint, now)
+    else:
+        # One state round trip: fingerprint blacklist, block status and the
+        # client's history (with this request logged unless it is blocked)
+        fingerprint_blocked, state = await state_backend.observe(client_ip, fingerprint, now)
+    lap = metrics.lap("block_check", lap)
 
     # --- LAYER 0: FINGERPRINT BLACKLIST ---
-    if fingerprint in blocked_fingerprints:
-        return JSONResponse(
-            status_code=403, 
-            content={"detail": f"Hardware Fingerprint {fingerprint} is Blacklisted."}
-        )
+    if fingerprint_blocked:
+        return fingerprint_denial(fingerprint), None
 
     # --- LAYER 1: IP BLOCK CHECK ---
-    if client_ip in blocked_ips:
-        remaining = int(blocked_ips[client_ip] - now)
-        if remaining > 0:
-            return JSONResponse(status_code=403, content={"detail": f"Blocked. {remaining}s left."})
-        else:
-            # Cleanup expired blocks
-            del blocked_ips[client_ip] 
-            if client_ip in honeypot_victims: honeypot_victims.remove(client_ip)
-            if client_ip in highest_risk_seen: del highest_risk_seen[client_ip]
+    # (expired blocks were already cleaned up by the backend)
+    if state.is_blocked(now):
+        remaining = int(state.blocked_until - now)
+        metrics.inc("flowlock_requests_total", "blocked", state.block_reason)
+        return JSONResponse(status_code=403, content={"detail": f"Blocked. {remaining}s left."}), None
 
     # --- LAYER 2: RISK ASSESSMENT ---
-    request_logs[client_ip].append(now)
-    features = extract_behavior_features(client_ip)
+    features = state.snapshot(now)
+    limits = None
+    if adaptive_thresholds.enabled:
+        limits = adaptive_thresholds.limits(path)
+        adaptive_thresholds.observe(path, features["rpm"], features["variance"], len(state))
+    lap = metrics.lap("features", lap)
     
     # Calculate current risk based on the new Section 4 logic
-    current_risk, reason = calculate_risk_score(features, client_ip, query_params)
+    current_risk, reason, action = assess_risk(features, client_ip, query_params, state, headers, limits, fingerprint, path)
+    lap = metrics.lap("scoring", lap)
 
     # --- THE STABILIZER (Update Global State BEFORE Tarpit) ---
     # This makes sure the dashboard sees the high risk immediately
-    if client_ip in highest_risk_seen:
-        risk_score = max(current_risk, highest_risk_seen[client_ip])
-    else:
-        risk_score = current_risk
-        
-    highest_risk_seen[client_ip] = risk_score
+    risk_score = max(current_risk, state.highest_risk)
     # ---------------------------------------------------------
     
-    # --- LAYER 3: HARD BLOCK (Risk = 100) ---
-    if risk_score >= 100:
-        if client_ip not in blocked_ips:
-            blocked_ips[client_ip] = now + 60
-            block_reasons[client_ip] = reason
-        return JSONResponse(status_code=403, content={"detail": "Access Denied: High Risk Security Threat."})
-
-    # --- LAYER 4: TARPIT (Risk 55 - 99) ---
-    # The dashboard is already updated, so it will show 'SUSPICIOUS' while we sleep
-    if 55 <= risk_score < 100:
-        print(f"!!! TARPIT ACTIVE for {client_ip} | Risk: {risk_score}% !!!")
-        await asyncio.sleep(3) 
+    # --- LAYER 3: HARD BLOCK (Risk = 100, or a "block" rule) ---
+    # An "allow" rule lets this request through whatever the risk
+    blocking = action == BLOCK_ACTION or (risk_score >= BLOCK_RISK and action != ALLOW_ACTION)
+    block_until = now + BLOCK_SECONDS if blocking else 0
+    # Decide before commit(): the in-memory backend updates `state` in place
+    changed = risk_score != state.highest_risk or block_until or len(state) == 1
+    await state_backend.commit(client_ip, state, risk_score, reason, block_until, now)
+    if changed:
+        change_log.publish(client_view(client_ip, risk_score, block_until, reason, False,
+                                       features["variance"], now))
+    lap = metrics.lap("commit", lap)
+    if block_until:
+        note_block(client_ip, block_until, now, reason, fingerprint=fingerprint, risk=risk_score)
+        metrics.inc("flowlock_requests_total", "block", reason)
+        return JSONResponse(status_code=403, content={"detail": "Access Denied: High Risk Security Threat."}), risk_score
+
+    # --- LAYER 4: TARPIT (Risk 55 - 99, or a "tarpit" rule) ---
+    # The dashboard is already updated, so it will show 'SUSPICIOUS' while we wait.
+    # Delay grows with risk; a full tarpit answers 429 (or sheds with 503)
+    # instead of holding yet another connection open.
+    if action == TARPIT_ACTION or (TARPIT_RISK <= risk_score < BLOCK_RISK and action != ALLOW_ACTION):
+        event_log.emit("tarpit", ip=client_ip, risk=risk_score, reason=reason)
+        held = await tarpit.delay(client_ip, risk_score)
+        metrics.lap("tarpit", lap)
+        metrics.inc("flowlock_requests_total", "tarpit", reason)
+        if not held:
+            if tarpit.overflow == OVERFLOW_SHED:
+                metrics.inc("flowlock_tarpits_total", "shed")
+                return Response(status_code=503, headers={"Connection": "close"}), risk_score
+            metrics.inc("flowlock_tarpits_total", "rejected")
+            return JSONResponse(
+                status_code=429,
+                content={"detail": "Too Many Requests: Slow Down."},
+                headers={"Retry-After": tarpit.retry_after()},
+            ), risk_score
+        metrics.inc("flowlock_tarpits_total", "held")
+        return None, risk_score
+
+    metrics.inc("flowlock_requests_total", "allow", reason)
+    return None, risk_score
+
+def fingerprint_denial(fingerprint: str):
+    metrics.inc("flowlock_requests_total", "fingerprint", "FINGERPRINT_BLACKLIST")
+    metrics.inc("flowlock_fingerprint_hits_total")
+    return JSONResponse(
+        status_code=403, 
+        content={"detail": f"Hardware Fingerprint {fingerprint} is Blacklisted."}
+    )
+
+def prefix_denial(rule, now):
+    if rule.kind == DENY:
+        return JSONResponse(status_code=403, content={"detail": f"Network {rule.network} is denied."})
+    remaining = int(rule.until - now)
+    return JSONResponse(status_code=403, content={"detail": f"Network {rule.network} blocked. {remaining}s left."})
+
+def note_block(client_ip: str, until: float, now: float, reason: str, **details):
+    # Called for every address block: counts and logs it, and counts it
+    # towards blocking its whole prefix
+    metrics.inc("flowlock_blocks_total", reason)
+    event_log.emit("block", ip=client_ip, reason=reason, until=until, **details)
+    rule = prefix_policy.record_block(client_ip, until, now)
+    if rule is not None:
+        event_log.emit("subnet_block", network=rule.network, reason=rule.reason, until=rule.until)
+
+# --- LAYER 1b: SIGNATURES IN THE BODY ---
+# Bodies are scanned while the app reads them, so a hit arrives after
+# inspect_request(); it blocks the client exactly like a query-string hit.
+def body_inspector(scope):
+    if not BODY_SCAN_BYTES:
+        return None
+    mode = body_mode(scope.get("headers", []), BODY_CONTENT_TYPES)
+    if mode is None:
+        return None
+    return BodyInspector(signature_engine.automaton, mode, BODY_SCAN_BYTES)
+
+async def block_body_signature(client_ip: str, reason: str):
+    now = time.time()
+    await state_backend.block_ip(client_ip, now + BLOCK_SECONDS, reason, now)
+    change_log.publish(client_view(client_ip, BLOCK_RISK, now + BLOCK_SECONDS, reason, False, None, now))
+    note_block(client_ip, now + BLOCK_SECONDS, now, reason, source="body")
+
+# --- DEFAULT: PURE ASGI MIDDLEWARE ---
+# Runs without Starlette's BaseHTTPMiddleware, so there is no extra task per
+# request and streaming responses pass straight through untouched.
+class AbuseDetectionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or is_bypass_path(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        client = scope.get("client")
+        client_ip = client[0] if client else "unknown"
+        lap = time.perf_counter_ns()
+        fingerprint = request_fingerprint(scope)
+        metrics.lap("fingerprint", lap)
+        # Same normalisation as str(request.query_params)
+        query_params = str(QueryParams(scope.get("query_string", b"")))
+
+        denial, risk_score = await inspect_request(client_ip, fingerprint, query_params, scope.get("headers"), scope["path"])
+        if denial is not None:
+            # Short-circuit: the app is never invoked for denied requests
+            await denial(scope, receive, send)
+            return
+
+        # Body chunks are scanned as the app pulls them; clean requests are
+        # never held back and nothing is buffered
+        inspector = body_inspector(scope)
+        if inspector is not None:
+            receive = inspector.wrap(receive)
+
+        # --- LAYER 5: EXECUTION ---
+        # Add security headers for debugging, without buffering the body
+        extra_headers = [
+            (b"x-risk-score", str(risk_score).encode("latin-1")),
+            (b"x-fingerprint", fingerprint.encode("latin-1")),
+        ]
+        response_started = False
+
+        async def send_with_headers(message):
+            nonlocal response_started
+            if inspector is not None and inspector.match:
+                # Whatever the app makes of the refused body (FastAPI answers
+                # 400 when reading it fails) is dropped; the 403 goes out below
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + extra_headers
+            await send(message)
+
+        lap = time.perf_counter_ns()
+        try:
+            await self.app(scope, receive, send_with_headers)
+        except Exception:
+            if inspector is None or not inspector.match:
+                if response_started:
+                    raise
+                bad_request = JSONResponse(status_code=400, content={"detail": "Bad Request"})
+                await bad_request(scope, receive, send)
+                return
+        finally:
+            metrics.lap("downstream", lap)
+
+        if inspector is not None and inspector.match:
+            await block_body_signature(client_ip, inspector.match)
+            # A response already under way is cut short instead
+            if not response_started:
+                denial = JSONResponse(status_code=403, content={"detail": "Access Denied: High Risk Security Threat."})
+                await denial(scope, receive, send)
+
+# --- OPT-IN FALLBACK: @app.middleware("http") flavour ---
+# Enabled with FLOWLOCK_MIDDLEWARE=http (goes through BaseHTTPMiddleware)
+async def abuse_detection_middleware(request: Request, call_next):
+    # 1. Bypass check for status page and honeypot logic
+    if is_bypass_path(request.url.path):
+        return await call_next(request)
+
+    client_ip = request.client.host
+    lap = time.perf_counter_ns()
+    fingerprint = generate_fingerprint(request) 
+    metrics.lap("fingerprint", lap)
+    
+    # 2. Capture URL Parameters for Signature Scanning
+    query_params = str(request.query_params)
+
+    # (body inspection needs the pure ASGI middleware; headers are scanned here too)
+    denial, risk_score = await inspect_request(client_ip, fingerprint, query_params, request.headers.raw, request.url.path)
+    if denial is not None:
+        return denial
 
     # --- LAYER 5: EXECUTION ---
+    lap = time.perf_counter_ns()
     try:
         response = await call_next(request)
         # Add security headers for debugging
@@ -250,6 +719,13 @@ async def abuse_detection_middleware(request: Request, call_next):
         return response
     except Exception:
         return JSONResponse(status_code=400, content={"detail": "Bad Request"})
+    finally:
+        metrics.lap("downstream", lap)
+
+if os.environ.get("FLOWLOCK_MIDDLEWARE", "asgi").lower() == "http":
+    app.middleware("http")(abuse_detection_middleware)
+else:
+    app.add_middleware(AbuseDetectionMiddleware)
 
 # 7. ENHANCED SECURE DATA ENDPOINT
 @app.get("/data", response_class=HTMLResponse)
@@ -285,94 +761,25 @@ async def get_data(request: Request):
     """
 
 # 8. NEURAL COMMAND CENTER (Fixed for Honeypot Visibility)
-@app.get("/status", response_class=HTMLResponse)
-async def get_status():
-    active_rows = ""
-    
-    # --- FIX: Combine active users and blocked users so they don't disappear ---
-    all_observed_ips = set(list(request_logs.keys()) + list(blocked_ips.keys()))
-    
-    for ip in all_observed_ips:
-        feat = extract_behavior_features(ip)
-        is_blocked = ip in blocked_ips
-        is_honeypot = ip in honeypot_victims
-        
-        # 1. RISK LOGIC
-        if is_blocked:
-            risk = 100
-            # Use the stored reason
-            reason = block_reasons.get(ip, "SECURITY_POLICY_VIOLATION")
-        else:
-            live_risk, reason = calculate_risk_score(feat, ip)
-            risk = max(live_risk, highest_risk_seen.get(ip, 0))
-
-        # 2. STYLING
-        bar_style = "background: linear-gradient(90deg, #ff0055, #ff4d4d); animation: alarm-blink 0.6s infinite; box-shadow: 0 0 20px #ff0055;" if is_blocked else ""
-        text_color = "var(--danger)" if is_blocked else "var(--cyan)"
-        
-        # 3. TAG LOGIC (Honeypot gets top priority)
-        if is_honeypot:
-            status_tag = '<span class="tag" style="background:#ff0055; color:#fff; border:none; font-weight:bold;">⚠️ HONEYPOT_TRAP</span>'
-        elif is_blocked:
-            status_tag = f'<span class="tag tag-danger">{reason}</span>'
-        elif risk >= 55: 
-            status_tag = '<span class="tag" style="border-color: #f59e0b; color: #f59e0b;">SUSPICIOUS (TARPITTING)</span>'
-        else:
-            status_tag = '<span class="tag">AUTHORIZED</span>'
-            
-        active_rows += f"""
-        <tr>
-            <td style="color: #fff; font-weight: 700;">{ip}</td>
-            <td>
-                <div class="velocity-container">
-                    <div class="velocity-track"><div class="velocity-bar" style="width: {risk}%; {bar_style}"></div></div>
-                    <div class="velocity-percentage"><span style="color: {text_color}">{int(risk)}%</span></div>
-                </div>
-            </td>
-            <td>{feat['variance']}ms</td>
-            <td>{status_tag}</td>
-        </tr>
-        """
-    # ... (Rest of your neutralized_cards and return logic)
-    # ... (Rest of your HTML return remains the same)
-    neutralized_cards = ""
-    for ip, expiry in list(blocked_ips.items()):
-        time_left = max(0, int(expiry - time.time()))
-        specific_reason = block_reasons.get(ip, "SECURITY_POLICY_VIOLATION")
-        h, m, s = time_left // 3600, (time_left % 3600) // 60, time_left % 60
-        time_str = f"{h:02d}:{m:02d}:{s:02d}"
-        
-        neutralized_cards += f"""
-        <div class="q-card" style="border-color: var(--danger); box-shadow: 0 0 20px rgba(255, 0, 85, 0.2);">
-            <div style="font-family: 'JetBrains Mono'; font-size: 1.1rem; color: #fff; margin-bottom: 12px; border-bottom: 1px solid rgba(255,0,85,0.3); padding-bottom: 5px;">{ip}</div>
-            <div style="font-size: 0.8rem; color: var(--text-dim); line-height: 1.8;">
-                REASON: <span style="color: #ff0055; font-weight: bold;">{specific_reason}</span><br>
-                <div style="background: #000; padding: 10px; border-radius: 6px; margin-top: 10px; border: 1px solid var(--danger); text-align: center;">
-                    <span style="color: var(--danger); font-size: 0.6rem; letter-spacing: 2px; display: block; margin-bottom: 2px;">EXPIRY COUNTDOWN</span>
-                    <span style="color: #fff; font-family: 'JetBrains Mono'; font-size: 1.5rem; font-weight: 900; letter-spacing: 3px;">{time_str}</span>
-                </div>
-            </div>
-        </div>
-        """
-
-    return f"""
-<!DOCTYPE html>
+# Static shell: the page loads once and is kept current by /status/stream,
+# so dashboard cost no longer grows with (clients x viewers x refreshes).
+STATUS_DASHBOARD_HTML = """<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <title>Flow Lock | Neural Defense</title>
     <link href="https://fonts.googleapis.com/css2?family=Space+Grotesk:wght@300;400;700&family=JetBrains+Mono:wght@400;700&display=swap" rel="stylesheet">
     <style>
-        :root {{ --bg: #010103; --surface: rgba(10, 18, 30, 0.85); --border: rgba(0, 242, 255, 0.15); --cyan: #00f2ff; --danger: #ff0055; --text-main: #e0e0e0; --text-dim: #707070; --grid-line: rgba(0, 242, 255, 0.08); }}
-        @keyframes alarm-blink {{ 0%, 100% {{ opacity: 1; }} 50% {{ opacity: 0.6; }} }}
-        body {{ background-color: var(--bg); color: var(--text-main); font-family: 'Space Grotesk', sans-serif; margin: 0; padding: 40px 20px; background-image: radial-gradient(circle at 50% 0%, rgba(0, 112, 255, 0.1) 0%, transparent 70%), linear-gradient(var(--grid-line) 1.5px, transparent 1.5px), linear-gradient(90deg, var(--grid-line) 1.5px, transparent 1.5px); background-size: 100% 100%, 40px 40px, 40px 40px; background-attachment: fixed; }}
+        :root { --bg: #010103; --surface: rgba(10, 18, 30, 0.85); --border: rgba(0, 242, 255, 0.15); --cyan: #00f2ff; --danger: #ff0055; --text-main: #e0e0e0; --text-dim: #707070; --grid-line: rgba(0, 242, 255, 0.08); }
+        @keyframes alarm-blink { 0%, 100% { opacity: 1; } 50% { opacity: 0.6; } }
+        body { background-color: var(--bg); color: var(--text-main); font-family: 'Space Grotesk', sans-serif; margin: 0; padding: 40px 20px; background-image: radial-gradient(circle at 50% 0%, rgba(0, 112, 255, 0.1) 0%, transparent 70%), linear-gradient(var(--grid-line) 1.5px, transparent 1.5px), linear-gradient(90deg, var(--grid-line) 1.5px, transparent 1.5px); background-size: 100% 100%, 40px 40px, 40px 40px; background-attachment: fixed; }
         
-        .header {{ width: 100%; max-width: 1100px; margin: 0 auto 40px; display: flex; flex-direction: column; align-items: center; border-bottom: 2px solid var(--border); padding-bottom: 20px; }}
-        .brand h1 {{ font-size: 2.5rem; font-weight: 700; margin: 0; color: #fff; text-shadow: 0 0 40px var(--cyan); letter-spacing: 8px; }}
+        .header { width: 100%; max-width: 1100px; margin: 0 auto 40px; display: flex; flex-direction: column; align-items: center; border-bottom: 2px solid var(--border); padding-bottom: 20px; }
+        .brand h1 { font-size: 2.5rem; font-weight: 700; margin: 0; color: #fff; text-shadow: 0 0 40px var(--cyan); letter-spacing: 8px; }
         
-        .container {{ width: 100%; max-width: 1100px; margin: 0 auto; display: grid; gap: 50px; }}
+        .container { width: 100%; max-width: 1100px; margin: 0 auto; display: grid; gap: 50px; }
         
-        .glass-panel {{ 
+        .glass-panel { 
             background: var(--surface); 
             backdrop-filter: blur(25px); 
             border: 1px solid var(--border); 
@@ -381,55 +788,54 @@ async def get_status():
             box-shadow: 0 30px 60px rgba(0, 0, 0, 0.8); 
             position: relative; 
             overflow: hidden; 
-        }}
+        }
         
         /* THE FIXED LIGHT TRACE */
-        .light-trace {{ 
+        .light-trace { 
             position: absolute; 
             background: var(--cyan); 
             box-shadow: 0 0 15px var(--cyan); 
             opacity: 0; 
             transition: all 0.4s ease-out; /* Smooth fill */
-        }}
+        }
         
         /* Line positions */
-        .lt-1 {{ top: 0; left: 0; height: 2px; width: 0; }}
-        .lt-2 {{ top: 0; right: 0; width: 2px; height: 0; }}
-        .lt-3 {{ bottom: 0; right: 0; height: 2px; width: 0; }}
-        .lt-4 {{ bottom: 0; left: 0; width: 2px; height: 0; }}
+        .lt-1 { top: 0; left: 0; height: 2px; width: 0; }
+        .lt-2 { top: 0; right: 0; width: 2px; height: 0; }
+        .lt-3 { bottom: 0; right: 0; height: 2px; width: 0; }
+        .lt-4 { bottom: 0; left: 0; width: 2px; height: 0; }
 
         /* Sequence: Top -> Right -> Bottom -> Left */
-        .glass-panel:hover .lt-1 {{ width: 100%; opacity: 1; transition-delay: 0s; }}
-        .glass-panel:hover .lt-2 {{ height: 100%; opacity: 1; transition-delay: 0.2s; }}
-        .glass-panel:hover .lt-3 {{ width: 100%; opacity: 1; transition-delay: 0.4s; }}
-        .glass-panel:hover .lt-4 {{ height: 100%; opacity: 1; transition-delay: 0.6s; }}
+        .glass-panel:hover .lt-1 { width: 100%; opacity: 1; transition-delay: 0s; }
+        .glass-panel:hover .lt-2 { height: 100%; opacity: 1; transition-delay: 0.2s; }
+        .glass-panel:hover .lt-3 { width: 100%; opacity: 1; transition-delay: 0.4s; }
+        .glass-panel:hover .lt-4 { height: 100%; opacity: 1; transition-delay: 0.6s; }
 
         /* When the page refreshes, if you are still hovering, this keeps them visible */
-        .glass-panel:hover .light-trace {{ opacity: 1; }}
+        .glass-panel:hover .light-trace { opacity: 1; }
 
         /* Instant Hide when mouse leaves */
-        .glass-panel:not(:hover) .light-trace {{ transition: none !important; width: 0; height: 0; opacity: 0; }}
+        .glass-panel:not(:hover) .light-trace { transition: none !important; width: 0; height: 0; opacity: 0; }
 
-        .glass-panel h3 {{ font-size: 0.9rem; text-transform: uppercase; letter-spacing: 5px; margin: 0 0 35px 0; color: var(--cyan); position: relative; z-index: 2; }}
-        table {{ width: 100%; border-collapse: collapse; font-family: 'JetBrains Mono'; position: relative; z-index: 2; }}
-        th {{ text-align: left; color: var(--text-dim); font-size: 0.75rem; padding: 15px; border-bottom: 1px solid var(--border); }}
-        td {{ padding: 20px 15px; font-size: 0.9rem; border-bottom: 1px solid rgba(255,255,255,0.03); }}
+        .glass-panel h3 { font-size: 0.9rem; text-transform: uppercase; letter-spacing: 5px; margin: 0 0 35px 0; color: var(--cyan); position: relative; z-index: 2; }
+        table { width: 100%; border-collapse: collapse; font-family: 'JetBrains Mono'; position: relative; z-index: 2; }
+        th { text-align: left; color: var(--text-dim); font-size: 0.75rem; padding: 15px; border-bottom: 1px solid var(--border); }
+        td { padding: 20px 15px; font-size: 0.9rem; border-bottom: 1px solid rgba(255,255,255,0.03); }
         
-        .velocity-container {{ display: flex; flex-direction: column; gap: 8px; width: 180px; }}
-        .velocity-track {{ height: 8px; background: rgba(0,0,0,0.5); width: 100%; border-radius: 4px; overflow: hidden; border: 1px solid rgba(255,255,255,0.1); }}
-        .velocity-bar {{ height: 100%; background: linear-gradient(90deg, #0070ff, var(--cyan)); border-radius: 4px; transition: width 0.5s ease; }}
-        .velocity-percentage {{ font-size: 0.65rem; font-weight: 700; display: flex; justify-content: flex-end; }}
-        .tag {{ padding: 5px 14px; border-radius: 4px; font-size: 0.7rem; font-weight: 700; background: rgba(0, 242, 255, 0.1); border: 1px solid var(--border); }}
-        .tag-danger {{ color: var(--danger); border-color: var(--danger); }}
-        .q-grid {{ display: grid; grid-template-columns: repeat(auto-fit, minmax(300px, 1fr)); gap: 30px; position: relative; z-index: 2; }}
-        .q-card {{ background: rgba(255,0,85,0.08); border: 1px solid rgba(255,0,85,0.25); padding: 25px; border-radius: 12px; }}
+        .velocity-container { display: flex; flex-direction: column; gap: 8px; width: 180px; }
+        .velocity-track { height: 8px; background: rgba(0,0,0,0.5); width: 100%; border-radius: 4px; overflow: hidden; border: 1px solid rgba(255,255,255,0.1); }
+        .velocity-bar { height: 100%; background: linear-gradient(90deg, #0070ff, var(--cyan)); border-radius: 4px; transition: width 0.5s ease; }
+        .velocity-percentage { font-size: 0.65rem; font-weight: 700; display: flex; justify-content: flex-end; }
+        .tag { padding: 5px 14px; border-radius: 4px; font-size: 0.7rem; font-weight: 700; background: rgba(0, 242, 255, 0.1); border: 1px solid var(--border); }
+        .tag-danger { color: var(--danger); border-color: var(--danger); }
+        .q-grid { display: grid; grid-template-columns: repeat(auto-fit, minmax(300px, 1fr)); gap: 30px; position: relative; z-index: 2; }
+        .q-card { background: rgba(255,0,85,0.08); border: 1px solid rgba(255,0,85,0.25); padding: 25px; border-radius: 12px; }
     </style>
-    <meta http-equiv="refresh" content="3">
 </head>
 <body>
     <div class="header">
         <div class="brand"><h1>FLOW LOCK</h1></div>
-        <div class="stat-item" style="border: 1px solid var(--danger); padding: 8px 16px; color: var(--danger); margin-top: 10px;">ACTIVE THREATS: {len(blocked_ips)}</div>
+        <div class="stat-item" style="border: 1px solid var(--danger); padding: 8px 16px; color: var(--danger); margin-top: 10px;">ACTIVE THREATS: <span id="active-threats">0</span></div>
     </div>
     <div class="container">
         <div class="glass-panel">
@@ -438,7 +844,7 @@ async def get_status():
             <h3>Active Threat Radar</h3>
             <table>
                 <thead><tr><th>Origin Node</th><th>Payload Velocity</th><th>Jitter</th><th>Status</th></tr></thead>
-                <tbody>{active_rows}</tbody>
+                <tbody id="threat-radar"></tbody>
             </table>
         </div>
         <div class="glass-panel" style="border-left: 5px solid var(--danger);">
@@ -447,12 +853,276 @@ async def get_status():
             <span class="light-trace lt-3" style="background:var(--danger); box-shadow:0 0 15px var(--danger);"></span>
             <span class="light-trace lt-4" style="background:var(--danger); box-shadow:0 0 15px var(--danger);"></span>
             <h3 style="color: var(--danger);">Neutralized Entities</h3>
-            <div class="q-grid">{neutralized_cards if neutralized_cards else '<div class="q-card" style="opacity: 0.5;">SYSTEM_STABLE</div>'}</div>
+            <div class="q-grid" id="neutralized"><div class="q-card" style="opacity: 0.5;">SYSTEM_STABLE</div></div>
         </div>
     </div>
+    <script>
+        // Live feed: one snapshot, then only the clients that changed (see /status/stream)
+        const clients = new Map();
+        let clockSkew = 0;
+        let renderQueued = false;
+
+        const esc = (text) => String(text).replace(/[&<>"']/g, (c) => ({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"}[c]));
+        const serverNow = () => Date.now() / 1000 + clockSkew;
+
+        function statusTag(v) {
+            // TAG LOGIC (Honeypot gets top priority)
+            if (v.honeypot) return '<span class="tag" style="background:#ff0055; color:#fff; border:none; font-weight:bold;">⚠️ HONEYPOT_TRAP</span>';
+            if (v.blocked) return `<span class="tag tag-danger">${esc(v.reason)}</span>`;
+            if (v.risk >= 55) return '<span class="tag" style="border-color: #f59e0b; color: #f59e0b;">SUSPICIOUS (TARPITTING)</span>';
+            return '<span class="tag">AUTHORIZED</span>';
+        }
+
+        function row(v) {
+            const barStyle = v.blocked ? "background: linear-gradient(90deg, #ff0055, #ff4d4d); animation: alarm-blink 0.6s infinite; box-shadow: 0 0 20px #ff0055;" : "";
+            const textColor = v.blocked ? "var(--danger)" : "var(--cyan)";
+            return `
+        <tr>
+            <td style="color: #fff; font-weight: 700;">${esc(v.ip)}</td>
+            <td>
+                <div class="velocity-container">
+                    <div class="velocity-track"><div class="velocity-bar" style="width: ${v.risk}%; ${barStyle}"></div></div>
+                    <div class="velocity-percentage"><span style="color: ${textColor}">${v.risk}%</span></div>
+                </div>
+            </td>
+            <td>${v.variance === null || v.variance === undefined ? "-" : v.variance}ms</td>
+            <td>${statusTag(v)}</td>
+        </tr>`;
+        }
+
+        function card(v) {
+            const left = Math.max(0, Math.floor(v.blocked_until - serverNow()));
+            const pad = (n) => String(n).padStart(2, "0");
+            const timeStr = `${pad(Math.floor(left / 3600))}:${pad(Math.floor((left % 3600) / 60))}:${pad(left % 60)}`;
+            return `
+        <div class="q-card" style="border-color: var(--danger); box-shadow: 0 0 20px rgba(255, 0, 85, 0.2);">
+            <div style="font-family: 'JetBrains Mono'; font-size: 1.1rem; color: #fff; margin-bottom: 12px; border-bottom: 1px solid rgba(255,0,85,0.3); padding-bottom: 5px;">${esc(v.ip)}</div>
+            <div style="font-size: 0.8rem; color: var(--text-dim); line-height: 1.8;">
+                REASON: <span style="color: #ff0055; font-weight: bold;">${esc(v.reason)}</span><br>
+                <div style="background: #000; padding: 10px; border-radius: 6px; margin-top: 10px; border: 1px solid var(--danger); text-align: center;">
+                    <span style="color: var(--danger); font-size: 0.6rem; letter-spacing: 2px; display: block; margin-bottom: 2px;">EXPIRY COUNTDOWN</span>
+                    <span style="color: #fff; font-family: 'JetBrains Mono'; font-size: 1.5rem; font-weight: 900; letter-spacing: 3px;">${timeStr}</span>
+                </div>
+            </div>
+        </div>`;
+        }
+
+        function render() {
+            renderQueued = false;
+            const views = [...clients.values()].sort((a, b) => b.risk - a.risk);
+            const blocked = views.filter((v) => v.blocked);
+            document.getElementById("threat-radar").innerHTML = views.map(row).join("");
+            document.getElementById("active-threats").textContent = blocked.length;
+            document.getElementById("neutralized").innerHTML = blocked.length
+                ? blocked.map(card).join("")
+                : '<div class="q-card" style="opacity: 0.5;">SYSTEM_STABLE</div>';
+        }
+
+        function scheduleRender() {
+            if (!renderQueued) {
+                renderQueued = true;
+                requestAnimationFrame(render);
+            }
+        }
+
+        function upsert(view) {
+            if (view.removed) {
+                clients.delete(view.ip);
+                return;
+            }
+            const known = clients.get(view.ip);
+            if (known && (view.variance === null || view.variance === undefined)) view.variance = known.variance;
+            clients.set(view.ip, view);
+        }
+
+        const source = new EventSource("/status/stream");
+        source.addEventListener("snapshot", (e) => {
+            const snapshot = JSON.parse(e.data);
+            clockSkew = snapshot.server_time - Date.now() / 1000;
+            clients.clear();
+            snapshot.clients.forEach(upsert);
+            scheduleRender();
+        });
+        source.addEventListener("change", (e) => {
+            const change = JSON.parse(e.data);
+            clockSkew = change.server_time - Date.now() / 1000;
+            change.clients.forEach(upsert);
+            scheduleRender();
+        });
+
+        // Countdowns tick locally; the server only speaks up when a block is lifted
+        setInterval(() => { if (clients.size) scheduleRender(); }, 1000);
+    </script>
 </body>
 </html>
     """
 
+@app.get("/status", response_class=HTMLResponse)
+async def get_status():
+    return STATUS_DASHBOARD_HTML
+
+# --- STATUS API: paginated top-K snapshot ---
+async def status_snapshot(offset=0, limit=50):
+    now = time.time()
+    views = [state_view(ip, state, now) for ip, state in await state_backend.items()]
+    return {
+        "seq": change_log.seq,
+        "server_time": now,
+        "total": len(views),
+        "active_threats": sum(1 for view in views if view["blocked"]),
+        "offset": offset,
+        "limit": limit,
+        "clients": top_by_risk(views, offset, limit),
+    }
+
+@app.get("/status/api")
+async def get_status_api(offset: int = 0, limit: int = 50):
+    return await status_snapshot(max(offset, 0), max(1, min(limit, 500)))
+
+# --- STATUS STREAM: Server-Sent Events with only the clients that changed ---
+STREAM_HEARTBEAT = 15.0
+
+@app.get("/status/stream")
+async def get_status_stream(request: Request, limit: int = 500):
+    limit = max(1, min(limit, 5000))
+
+    async def events():
+        # Resume from Last-Event-ID when the change log still covers it
+        last_id = request.headers.get("last-event-id", "")
+        seq = int(last_id) if last_id.isdigit() else -1
+        while True:
+            changes = change_log.since(seq) if seq >= 0 else None
+            if changes is None:
+                snapshot = await status_snapshot(0, limit)
+                seq = snapshot["seq"]
+                yield sse_event("snapshot", snapshot, seq)
+            elif changes:
+                seq = change_log.seq
+                yield sse_event("change", {"server_time": time.time(), "clients": changes}, seq)
+            else:
+                yield b": keep-alive\n\n"
+            if await request.is_disconnected():
+                return
+            await change_log.wait(seq, STREAM_HEARTBEAT)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# 9. STORE HEALTH (entry count, evictions, approximate memory)
+@app.get("/status/store")
+async def get_store_stats():
+    return await state_backend.stats()
+
+# --- HEAVY HITTERS (front-line sketch stats, top clients and fingerprints) ---
+@app.get("/status/heavy_hitters")
+async def get_heavy_hitters(limit: int = 10):
+    return {"stats": heavy_hitters.stats(), "top": heavy_hitters.top(max(1, min(limit, heavy_hitters.top_ips.capacity)))}
+
+# --- PREFIX POLICY (allow/deny lists, subnet blocks, counters) ---
+@app.get("/status/prefixes")
+async def get_prefix_policy():
+    now = time.time()
+    return {"stats": prefix_policy.stats(), "rules": prefix_policy.rules(now)}
+
+# --- SCORING POLICY (active rules, per-rule hits and latency) ---
+@app.get("/status/policy")
+async def get_policy_stats():
+    return policy_engine.stats()
+
+# --- ADAPTIVE THRESHOLDS (per-route samples and current limits) ---
+@app.get("/status/adaptive")
+async def get_adaptive_thresholds():
+    return adaptive_thresholds.stats()
+
+# --- PERSISTENCE (snapshot / journal health, last warm start) ---
+@app.get("/status/persistence")
+async def get_persistence_stats():
+    return persistence.stats() if persistence is not None else {"enabled": False}
+
+# --- PROMETHEUS METRICS ---
+@app.get("/metrics")
+async def get_metrics():
+    store = await state_backend.stats()
+    tarpit_stats = tarpit.stats()
+    gauges = [
+        ("flowlock_tracked_clients", "Clients with an exact per-client record", store.get("entries", 0)),
+        ("flowlock_blocked_clients", "Clients currently blocked", store.get("blocked", 0)),
+        ("flowlock_blocked_fingerprints", "Blacklisted fingerprints", store.get("blocked_fingerprints", 0)),
+        ("flowlock_tarpit_held", "Connections held in the tarpit", tarpit_stats["held"]),
+        ("flowlock_prefix_rules", "Prefix allow/deny rules and subnet blocks", prefix_policy.stats()["rules"]),
+        ("flowlock_heavy_hitter_sketch_bytes", "Memory held by the heavy-hitter sketches", heavy_hitters.stats()["sketch_bytes"]),
+    ]
+    event_stats = event_log.stats()
+    gauges.append(("flowlock_event_log_pending", "Security events waiting to be written", event_stats["pending"]))
+    if "approx_bytes" in store:
+        gauges.append(("flowlock_state_bytes", "Approximate per-client state memory", store["approx_bytes"]))
+    counters = [
+        ("flowlock_event_log_dropped_total", "Security events dropped because the buffer was full", event_stats["dropped"]),
+    ]
+    return Response(metrics.render(gauges, counters), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# --- TARPIT HEALTH (held connections, overflows) ---
+@app.get("/status/tarpit")
+async def get_tarpit_stats():
+    return tarpit.stats()
+
+# 10. BACKGROUND SWEEPER (timer wheel for block expiry + idle-TTL eviction)
+async def sweep_client_state():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        now = time.time()
+        # Tell dashboards about lifted blocks (unblock resets the risk) and
+        # about clients the store dropped
+        unblocked, removed = await state_backend.sweep()
+        for ip in unblocked:
+            change_log.publish(client_view(ip, 0, 0, None, False, None, now))
+        for ip in removed:
+            change_log.remove(ip)
+        prefix_policy.sweep(now)
+
+background_tasks = set()
+
+async def start_background_tasks():
+    if persistence is not None:
+        if persistence.journal is not None:
+            # Single process: reload before the first request is served
+            persistence.load()
+        background_tasks.add(persistence.start())
+    if adaptive_thresholds.enabled:
+        # One sketch pair per static route; everything else shares OTHER_ROUTE
+        adaptive_thresholds.track(
+            route.path for route in app.routes if "{" not in route.path and not is_bypass_path(route.path)
+        )
+        background_tasks.add(adaptive_thresholds.start(static_limits))
+    task = asyncio.create_task(sweep_client_state())
+    background_tasks.add(task)
+    background_tasks.add(event_log.start())
+
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    # Whatever is still buffered is written before exit
+    await event_log.stop()
+    if persistence is not None:
+        await persistence.stop()
+    await state_backend.close()
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    workers = int(os.environ.get("FLOWLOCK_WORKERS", "1"))
+    if workers > 1:
+        # One shared-memory state for all workers; they attach by name on import
+        shared = SharedState.create(
+            client_capacity=MAX_CLIENTS,
+            fingerprint_capacity=int(os.environ.get("FLOWLOCK_MAX_FINGERPRINTS", "16384")),
+        )
+        os.environ["FLOWLOCK_SHARED_STATE"] = shared.prefix
+        os.environ["FLOWLOCK_WORKERS"] = str(workers)
+        warm_start = create_persistence(shared.clients, shared.fingerprints, shared=True)
+        if warm_start is not None:
+            warm_start.load()
+        try:
+            uvicorn.run("api_abuse_detection:app", host="0.0.0.0", port=8000, workers=workers)
+        finally:
+            shared.destroy()
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
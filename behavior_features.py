@@ -0,0 +1,110 @@
+import time
+from array import array
+
+# Size of the per-client history and the RPM sliding window (seconds)
+HISTORY_SIZE = 100
+RPM_WINDOW = 120
+
+# Re-derive the running variance from the raw history every N evictions
+# so floating point error from Welford removals can never accumulate.
+RESYNC_EVERY = 4096
+
+
+class BehaviorFeatures:
+    # Incremental sensor for one client.
+    # Keeps the last HISTORY_SIZE timestamps in a compact array('d') ring
+    # (grown on demand, so quiet clients stay small) plus running statistics,
+    # so "rpm" and "variance" can be read in O(1) instead of re-scanning the log.
+    __slots__ = ("ts", "head", "stale", "gap_count", "gap_mean", "gap_m2", "evictions")
+
+    def __init__(self):
+        self.ts = array("d")
+        # Index of the oldest timestamp once the ring is full (0 until then)
+        self.head = 0
+        # Number of oldest timestamps already known to be outside the RPM window
+        self.stale = 0
+        # Welford accumulators over the gaps between consecutive timestamps
+        self.gap_count = 0
+        self.gap_mean = 0.0
+        self.gap_m2 = 0.0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __iter__(self):
+        # Oldest -> newest
+        ts, head = self.ts, self.head
+        return iter(ts[head:] + ts[:head])
+
+    def _add_gap(self, gap):
+        self.gap_count += 1
+        delta = gap - self.gap_mean
+        self.gap_mean += delta / self.gap_count
+        self.gap_m2 += delta * (gap - self.gap_mean)
+
+    def _remove_gap(self, gap):
+        self.gap_count -= 1
+        if self.gap_count == 0:
+            self.gap_mean = 0.0
+            self.gap_m2 = 0.0
+            return
+        delta = gap - self.gap_mean
+        self.gap_mean -= delta / self.gap_count
+        self.gap_m2 -= delta * (gap - self.gap_mean)
+
+    def _resync(self):
+        logs = list(self)
+        self.gap_count = 0
+        self.gap_mean = 0.0
+        self.gap_m2 = 0.0
+        for i in range(1, len(logs)):
+            self._add_gap(logs[i] - logs[i - 1])
+
+    def append(self, timestamp):
+        ts = self.ts
+        count = len(ts)
+
+        if count < HISTORY_SIZE:
+            if count:
+                self._add_gap(timestamp - ts[-1])
+            ts.append(timestamp)
+            return
+
+        # --- EVICTION: the oldest gap leaves the variance window ---
+        head = self.head
+        second = head + 1 if head + 1 < HISTORY_SIZE else 0
+        self._remove_gap(ts[second] - ts[head])
+        self._add_gap(timestamp - ts[head - 1])
+        ts[head] = timestamp
+        self.head = second
+        if self.stale:
+            self.stale -= 1
+
+        self.evictions += 1
+        if self.evictions >= RESYNC_EVERY:
+            self.evictions = 0
+            self._resync()
+
+    def rpm(self, now=None):
+        if now is None:
+            now = time.time()
+        ts = self.ts
+        count = len(ts)
+        cutoff = now - RPM_WINDOW
+        stale = self.stale
+        while stale < count and ts[(self.head + stale) % HISTORY_SIZE] <= cutoff:
+            stale += 1
+        self.stale = stale
+        return count - stale
+
+    def variance(self):
+        if self.gap_count < 2:
+            return 0.0
+        return max(self.gap_m2 / (self.gap_count - 1), 0.0)
+
+    def snapshot(self, now=None):
+        # Same shape and semantics as the original list-based sensor
+        if len(self.ts) < 2:
+            return {"rpm": len(self.ts), "variance": 1.0}
+        return {"rpm": self.rpm(now), "variance": round(self.variance(), 6)}
@@ -0,0 +1,72 @@
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from collections import defaultdict, deque
+
+from client_store import ClientStateStore
+
+# Memory benchmark: original parallel dicts of deques vs the compact ClientRecord store.
+# Usage: python bench_memory.py --clients 100000 --history 100 --blocked 0.05
+
+def client_ips(count):
+    return [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(count)]
+
+def build_legacy(ips, history, blocked_ratio, now):
+    # The pre-ClientRecord layout, exactly as it used to live in api_abuse_detection.py
+    request_logs = defaultdict(lambda: deque(maxlen=100))
+    blocked_ips = {}
+    block_reasons = {}
+    honeypot_victims = set()
+    highest_risk_seen = defaultdict(float)
+    for i, ip in enumerate(ips):
+        logs = request_logs[ip]
+        for j in range(history):
+            logs.append(now + j * random.uniform(0.1, 3.0))
+        highest_risk_seen[ip] = float(random.choice([0, 20, 60, 85]))
+        if random.random() < blocked_ratio:
+            blocked_ips[ip] = now + 60
+            block_reasons[ip] = "VOLUMETRIC_FLOOD"
+            if i % 2:
+                honeypot_victims.add(ip)
+    return request_logs, blocked_ips, block_reasons, honeypot_victims, highest_risk_seen
+
+def build_compact(ips, history, blocked_ratio, now):
+    store = ClientStateStore(max_entries=len(ips) + 1)
+    for i, ip in enumerate(ips):
+        record = store.touch(ip, now)
+        for j in range(history):
+            record.append(now + j * random.uniform(0.1, 3.0))
+        record.highest_risk = random.choice([0, 20, 60, 85])
+        if random.random() < blocked_ratio:
+            store.block(ip, now + 60, "VOLUMETRIC_FLOOD", now, honeypot=bool(i % 2))
+    return store
+
+def measure(builder, ips, history, blocked_ratio):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    state = builder(ips, history, blocked_ratio, time.time())
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del state
+    return used
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FlowLock per-client memory benchmark")
+    parser.add_argument("--clients", type=int, default=100_000)
+    parser.add_argument("--history", type=int, default=100, help="timestamps recorded per client")
+    parser.add_argument("--blocked", type=float, default=0.05, help="fraction of clients blocked")
+    args = parser.parse_args()
+
+    ips = client_ips(args.clients)
+    # The IP strings themselves are shared by both layouts, so they are not counted
+    legacy = measure(build_legacy, ips, args.history, args.blocked)
+    compact = measure(build_compact, ips, args.history, args.blocked)
+
+    print(f"--- FLOW LOCK MEMORY BENCHMARK ({args.clients} clients, {args.history} timestamps each) ---")
+    print(f"Legacy dicts of deques : {legacy / 1e6:8.1f} MB | {legacy / args.clients:7.0f} B/client")
+    print(f"Compact ClientRecord   : {compact / 1e6:8.1f} MB | {compact / args.clients:7.0f} B/client")
+    print(f"Saving                 : {100 * (1 - compact / legacy):5.1f}%")
@@ -0,0 +1,367 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+
+from starlette.requests import Request
+
+import api_abuse_detection as flowlock
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Pipeline benchmark: drives the ASGI app in-process (no sockets, no HTTP
+# client) with a configurable traffic mix, then micro-benchmarks the hot
+# helpers. Results are printed as JSON so runs can be diffed or compared
+# against a saved baseline.
+# Usage: python bench_pipeline.py --requests 20000 --mix human=50,bot=20,signature=10,distinct=20
+#        python bench_pipeline.py --output base.json
+#        python bench_pipeline.py --baseline base.json --tolerance 0.2
+# The state backend follows the usual FLOWLOCK_* environment variables.
+
+PROFILES = ("human", "bot", "signature", "distinct")
+DEFAULT_MIX = "human=50,bot=20,signature=10,distinct=20"
+
+HUMAN_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/124.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 14_4) AppleWebKit/605.1.15 Version/17.4 Safari/605.1.15",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148",
+]
+HUMAN_LANGUAGES = ["en-US,en;q=0.9", "en-GB,en;q=0.8", "de-DE,de;q=0.9", "hi-IN,hi;q=0.9"]
+HUMAN_QUERIES = [b"", b"page=2", b"sort=recent", b"q=weather+delhi", b"category=books&page=1"]
+SIGNATURE_QUERIES = [
+    b"file=../../etc/passwd",
+    b"id=1%20OR%201=1",
+    b"cmd=__import__('os')",
+    b"path=..%5C..%5Cboot.ini",
+    b"prompt=system_override",
+]
+
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in PROFILES:
+            raise ValueError(f"unknown traffic profile {name!r} (expected one of {', '.join(PROFILES)})")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(samples, scale=1e3):
+    # Latency summary in milliseconds (or microseconds with scale=1e6)
+    ordered = sorted(samples)
+    return {
+        "p50": round(percentile(ordered, 50) * scale, 4),
+        "p99": round(percentile(ordered, 99) * scale, 4),
+        "max": round((ordered[-1] if ordered else 0.0) * scale, 4),
+        "mean": round(sum(ordered) / len(ordered) * scale, 4) if ordered else 0.0,
+    }
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def build_scope(ip, path, query, user_agent, language):
+    headers = [(b"host", b"bench"), (b"user-agent", user_agent.encode()), (b"accept-language", language.encode())]
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query,
+        "root_path": "",
+        "headers": headers,
+        "client": (ip, 40000),
+        "server": ("bench", 80),
+    }
+
+
+class TrafficMix:
+    # Endless request generator for the configured profile weights.
+    #   human     - large pool, browser headers, a few requests each
+    #   bot       - small pool hammering /data with one scripted user agent
+    #   signature - attack payloads in the query string from a rotating pool
+    #   distinct  - a brand-new IP every request (store churn / LRU pressure)
+
+    def __init__(self, weights, humans, bots, seed):
+        self.rng = random.Random(seed)
+        self.profiles = list(weights)
+        self.weights = [weights[name] for name in self.profiles]
+        self.humans = [
+            (f"10.1.{i >> 8 & 255}.{i & 255}", self.rng.choice(HUMAN_AGENTS), self.rng.choice(HUMAN_LANGUAGES))
+            for i in range(humans)
+        ]
+        self.bots = [f"10.2.{i >> 8 & 255}.{i & 255}" for i in range(bots)]
+        self.distinct = 0
+
+    def next(self):
+        profile = self.rng.choices(self.profiles, self.weights)[0]
+        rng = self.rng
+        if profile == "human":
+            ip, agent, language = rng.choice(self.humans)
+            return profile, build_scope(ip, "/data", rng.choice(HUMAN_QUERIES), agent, language)
+        if profile == "bot":
+            return profile, build_scope(rng.choice(self.bots), "/data", b"", "python-requests/2.31.0", "unknown")
+        if profile == "signature":
+            ip = f"10.3.{rng.randrange(256)}.{rng.randrange(256)}"
+            return profile, build_scope(ip, "/data", rng.choice(SIGNATURE_QUERIES), "sqlmap/1.8", "unknown")
+        self.distinct += 1
+        ip = f"10.{4 + (self.distinct >> 16) % 200}.{self.distinct >> 8 & 255}.{self.distinct & 255}"
+        return profile, build_scope(ip, "/data", b"", rng.choice(HUMAN_AGENTS), "en-US")
+
+
+async def call_app(app, scope):
+    # Minimal ASGI round trip; returns the response status
+    status = 0
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.sleep(3600)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def run_pipeline(args, weights):
+    mix = TrafficMix(weights, args.humans, args.bots, args.seed)
+    latencies = {name: [] for name in weights}
+    statuses = {name: {} for name in weights}
+    remaining = args.requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            profile, scope = mix.next()
+            started = time.perf_counter()
+            status = await call_app(flowlock.app, scope)
+            latencies[profile].append(time.perf_counter() - started)
+            statuses[profile][str(status)] = statuses[profile].get(str(status), 0) + 1
+            # A real server yields on socket I/O between requests; without
+            # this the sweeper and tarpit driver would starve
+            await asyncio.sleep(0)
+
+    # Warm up imports, caches and the tarpit driver outside the measurement
+    for _ in range(min(200, args.requests)):
+        await call_app(flowlock.app, mix.next()[1])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    everything = [sample for samples in latencies.values() for sample in samples]
+    totals = {}
+    for counts in statuses.values():
+        for status, count in counts.items():
+            totals[status] = totals.get(status, 0) + count
+    return {
+        "requests": len(everything),
+        "concurrency": args.concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(everything) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": summarize(everything),
+        "status": totals,
+        "by_profile": {
+            name: {"requests": len(latencies[name]), "latency_ms": summarize(latencies[name]), "status": statuses[name]}
+            for name in weights
+        },
+    }
+
+
+def time_sync(fn, iterations):
+    samples = []
+    clock = time.perf_counter
+    started = clock()
+    for _ in range(iterations):
+        t0 = clock()
+        fn()
+        samples.append(clock() - t0)
+    return clock() - started, samples
+
+
+async def time_async(fn, iterations):
+    samples = []
+    clock = time.perf_counter
+    started = clock()
+    for _ in range(iterations):
+        t0 = clock()
+        await fn()
+        samples.append(clock() - t0)
+    return clock() - started, samples
+
+
+def micro_result(iterations, elapsed, samples):
+    return {
+        "iterations": iterations,
+        "ops_per_s": round(iterations / elapsed, 1) if elapsed else 0.0,
+        "latency_us": summarize(samples, scale=1e6),
+    }
+
+
+async def run_micro(args):
+    iterations = args.micro_iterations
+    backend = flowlock.state_backend
+    now = time.time()
+
+    # A client with a full history for the per-client sensors
+    ip = "10.250.0.1"
+    for i in range(120):
+        fingerprint_blocked, state = await backend.observe(ip, "bench", now - 120 + i * random.uniform(0.5, 1.5))
+    await backend.commit(ip, state, 20, "SCANNING", 0, now)
+
+    # Enough clients for the dashboard snapshot to have something to rank
+    for i in range(args.status_clients):
+        client = f"10.251.{i >> 8 & 255}.{i & 255}"
+        fingerprint_blocked, record = await backend.observe(client, "bench", now)
+        risk = (i * 37) % 100
+        await backend.commit(client, record, risk, "SCANNING", now + 60 if risk >= 95 else 0, now)
+
+    request = Request(build_scope(ip, "/data", b"q=hello+world", HUMAN_AGENTS[0], HUMAN_LANGUAGES[0]))
+    features = flowlock.extract_behavior_features(ip)
+    state = backend.peek(ip)
+    query = "q=hello+world&page=2&sort=recent"
+
+    results = {}
+    # The scope caches the fingerprint per request; time the per-request
+    # computation (LRU hit for a repeat browser) instead of that lookup
+    raw_headers = request.scope["headers"]
+    elapsed, samples = time_sync(lambda: flowlock.fingerprint_from_headers(raw_headers), iterations)
+    results["generate_fingerprint"] = micro_result(iterations, elapsed, samples)
+    elapsed, samples = time_sync(lambda: flowlock.extract_behavior_features(ip), iterations)
+    results["extract_behavior_features"] = micro_result(iterations, elapsed, samples)
+    elapsed, samples = time_sync(lambda: flowlock.calculate_risk_score(features, ip, query, state), iterations)
+    results["calculate_risk_score"] = micro_result(iterations, elapsed, samples)
+    elapsed, samples = await time_async(flowlock.get_status, iterations)
+    results["get_status"] = micro_result(iterations, elapsed, samples)
+
+    # The dashboard data itself: the top-K snapshot every viewer loads first
+    status_iterations = max(1, iterations // 100)
+    elapsed, samples = await time_async(lambda: flowlock.status_snapshot(0, 500), status_iterations)
+    results["status_snapshot"] = micro_result(status_iterations, elapsed, samples)
+    results["status_snapshot"]["clients"] = len(await backend.items())
+    return results
+
+
+def compare(current, baseline, tolerance):
+    # Regressions beyond `tolerance` (a fraction) in throughput or tail latency
+    regressions = []
+
+    def check(name, new, old, higher_is_better):
+        if not old:
+            return
+        change = (new - old) / old
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append({"metric": name, "baseline": old, "current": new, "change": round(change, 3)})
+
+    check("pipeline.requests_per_s", current["pipeline"]["requests_per_s"],
+          baseline.get("pipeline", {}).get("requests_per_s"), True)
+    check("pipeline.latency_ms.p99", current["pipeline"]["latency_ms"]["p99"],
+          baseline.get("pipeline", {}).get("latency_ms", {}).get("p99"), False)
+    for name, result in current["micro"].items():
+        old = baseline.get("micro", {}).get(name)
+        if old:
+            check(f"micro.{name}.ops_per_s", result["ops_per_s"], old.get("ops_per_s"), True)
+    return regressions
+
+
+async def main(args):
+    weights = parse_mix(args.mix)
+    # The benchmark measures detection overhead, not how long the tarpit holds
+    # a connection; pass --tarpit-delay to include it
+    flowlock.tarpit.min_delay = flowlock.tarpit.max_delay = args.tarpit_delay
+
+    # Keep anything the middleware writes to stdout (FLOWLOCK_EVENT_LOG=-) out
+    # of the JSON output, including the final flush at shutdown
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        await flowlock.start_background_tasks()
+        try:
+            pipeline = await run_pipeline(args, weights)
+            # Per-stage latency as seen by the middleware's own histograms
+            pipeline["stages"] = flowlock.metrics.quantiles()
+            micro = await run_micro(args)
+        finally:
+            await flowlock.stop_background_tasks()
+
+    return {
+        "benchmark": "flowlock-pipeline",
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "config": {
+            "mix": weights,
+            "humans": args.humans,
+            "bots": args.bots,
+            "tarpit_delay": args.tarpit_delay,
+            "seed": args.seed,
+            "backend": (await flowlock.state_backend.stats()).get("backend"),
+        },
+        "pipeline": pipeline,
+        "micro": micro,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FlowLock detection pipeline benchmark")
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, default=64, help="in-flight requests")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="profile weights, e.g. human=50,bot=20,signature=10,distinct=20")
+    parser.add_argument("--humans", type=int, default=5_000, help="size of the human IP pool")
+    parser.add_argument("--bots", type=int, default=20, help="size of the bot IP pool")
+    parser.add_argument("--tarpit-delay", type=float, default=0.0, help="tarpit hold time in seconds")
+    parser.add_argument("--micro-iterations", type=int, default=20_000)
+    parser.add_argument("--status-clients", type=int, default=1_000, help="clients ranked by the status snapshot benchmark")
+    parser.add_argument("--seed", type=int, default=1129)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression vs the baseline (fraction)")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = asyncio.run(main(args))
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+        exit_code = 1 if report["regressions"] else 0
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    sys.exit(exit_code)
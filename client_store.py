@@ -0,0 +1,298 @@
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from behavior_features import BehaviorFeatures
+
+# How many LRU victims we are willing to skip because they are still blocked
+# before evicting one anyway (the memory cap always wins)
+MAX_BLOCKED_SKIPS = 8
+
+
+# Block reasons are interned: every record stores a small int instead of a string
+REASON_CODES = [None]
+_REASON_INDEX = {None: 0}
+
+def intern_reason(reason):
+    code = _REASON_INDEX.get(reason)
+    if code is None:
+        code = len(REASON_CODES)
+        REASON_CODES.append(reason)
+        _REASON_INDEX[reason] = code
+    return code
+
+# Bit flags for the per-client state
+FLAG_BLOCKED = 1
+FLAG_HONEYPOT = 2
+
+
+class ClientRecord(BehaviorFeatures):
+    # Everything FlowLock remembers about one client IP, in a single object:
+    # the timestamp ring and running stats (inherited) plus risk, block expiry,
+    # an interned reason code and blocked/honeypot bit flags.
+    __slots__ = ("highest_risk", "blocked_until", "reason_code", "flags", "last_seen")
+
+    def __init__(self):
+        super().__init__()
+        self.highest_risk = 0
+        self.blocked_until = 0.0
+        self.reason_code = 0
+        self.flags = 0
+        self.last_seen = 0.0
+
+    @property
+    def block_reason(self):
+        return REASON_CODES[self.reason_code]
+
+    @block_reason.setter
+    def block_reason(self, reason):
+        self.reason_code = intern_reason(reason)
+
+    @property
+    def blocked(self):
+        return bool(self.flags & FLAG_BLOCKED)
+
+    @property
+    def honeypot(self):
+        return bool(self.flags & FLAG_HONEYPOT)
+
+    def is_blocked(self, now):
+        return self.blocked_until > now
+
+    def block(self, until, reason, honeypot=False):
+        self.blocked_until = until
+        self.block_reason = reason
+        self.flags |= FLAG_BLOCKED | (FLAG_HONEYPOT if honeypot else 0)
+
+    def unblock(self):
+        # Mirrors the old lazy cleanup: the client starts over with a clean score
+        self.blocked_until = 0.0
+        self.reason_code = 0
+        self.flags &= ~(FLAG_BLOCKED | FLAG_HONEYPOT)
+        self.highest_risk = 0
+
+
+class TimerWheel:
+    # Hashed timer wheel: one bucket per `tick` seconds, deadlines past the
+    # wheel horizon simply stay in their bucket for another revolution.
+    def __init__(self, slots=512, tick=1.0, start=None):
+        self.slots = [[] for _ in range(slots)]
+        self.tick = tick
+        self.current = self._index(time.time() if start is None else start)
+
+    def _index(self, when):
+        return int(when // self.tick)
+
+    def schedule(self, key, when):
+        self.slots[self._index(when) % len(self.slots)].append((when, key))
+
+    def advance(self, now):
+        # Yields every key whose deadline is <= now, visiting each elapsed bucket once
+        target = self._index(now)
+        # After a long stall one full revolution already covers every bucket
+        start = max(self.current, target - len(self.slots) + 1)
+        for tick in range(start, target + 1):
+            bucket_index = tick % len(self.slots)
+            bucket = self.slots[bucket_index]
+            if not bucket:
+                continue
+            pending = []
+            for when, key in bucket:
+                if when <= now:
+                    yield key
+                else:
+                    pending.append((when, key))
+            self.slots[bucket_index] = pending
+        self.current = target
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.slots)
+
+
+class ClientStateStore:
+    # Bounded per-client state: LRU + idle-TTL eviction, an index of blocked
+    # clients, and a timer wheel that lifts expired blocks in the background.
+
+    def __init__(self, max_entries=100_000, idle_ttl=600.0):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.entries = OrderedDict()
+        self.blocked = {}
+        self.wheel = TimerWheel()
+        self.lru_evictions = 0
+        self.ttl_evictions = 0
+        self.expired_blocks = 0
+        # Clients evicted since the last sweep, reported by sweep()
+        self.removed = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, ip):
+        return ip in self.entries
+
+    def get(self, ip):
+        return self.entries.get(ip)
+
+    def touch(self, ip, now):
+        # Fetch-or-create the record and mark it most recently used
+        state = self.entries.get(ip)
+        if state is None:
+            state = ClientRecord()
+            self.entries[ip] = state
+            if len(self.entries) > self.max_entries:
+                self._evict_lru()
+        else:
+            self.entries.move_to_end(ip)
+        state.last_seen = now
+        return state
+
+    def _evict_lru(self):
+        entries = self.entries
+        now = time.time()
+        for _ in range(MAX_BLOCKED_SKIPS):
+            ip, state = next(iter(entries.items()))
+            if not state.is_blocked(now):
+                break
+            entries.move_to_end(ip)
+        ip, _ = entries.popitem(last=False)
+        self.blocked.pop(ip, None)
+        self.lru_evictions += 1
+        if len(self.removed) < self.max_entries:
+            self.removed.append(ip)
+
+    @contextmanager
+    def locked(self, ip, now):
+        # Read-modify-write access to one client's record.
+        # Same contract as the shared-memory store: changes made to the record
+        # inside the block are what the other readers see afterwards.
+        state = self.touch(ip, now)
+        was_blocked_until = state.blocked_until
+        try:
+            yield state
+        finally:
+            self._reindex(ip, state, was_blocked_until)
+
+    def _reindex(self, ip, state, was_blocked_until):
+        # Keep the blocked index and the expiry wheel in step with the record
+        if state.blocked:
+            self.blocked[ip] = state
+            if state.blocked_until != was_blocked_until:
+                self.wheel.schedule(ip, state.blocked_until)
+        else:
+            self.blocked.pop(ip, None)
+
+    def block(self, ip, until, reason, now, honeypot=False):
+        with self.locked(ip, now) as state:
+            state.block(until, reason, honeypot)
+        return state
+
+    def unblock(self, ip):
+        state = self.blocked.pop(ip, None)
+        if state is not None:
+            state.unblock()
+
+    def restore(self, records):
+        # Warm start: (ip, record) pairs come back in the order chunks() walked
+        # them. Blocks are indexed while the record is at hand, and the LRU
+        # cap is enforced once at the end instead of after every insert.
+        # Returns the number of records restored.
+        entries = self.entries
+        blocked = self.blocked
+        schedule = self.wheel.schedule
+        restored = 0
+        for ip, record in records:
+            entries[ip] = record
+            if record.flags & FLAG_BLOCKED:
+                blocked[ip] = record
+                schedule(ip, record.blocked_until)
+            restored += 1
+        while len(entries) > self.max_entries:
+            self._evict_lru()
+        return restored
+
+    def chunks(self, size):
+        # Snapshot walk: the key order is fixed up front and records are read
+        # `size` at a time, so the caller can yield to the event loop in between
+        # (clients evicted meanwhile are skipped). Keys are listed in insertion
+        # order, about 10x cheaper than walking the LRU links; a restored store
+        # is back in LRU order within one idle TTL, since every request moves
+        # its client to the back.
+        keys = list(dict.keys(self.entries))
+        entries = self.entries
+        for start in range(0, len(keys), size):
+            chunk = []
+            for ip in keys[start:start + size]:
+                state = entries.get(ip)
+                if state is not None:
+                    chunk.append((ip, state))
+            yield chunk
+
+    def items(self):
+        return list(self.entries.items())
+
+    def blocked_items(self):
+        return list(self.blocked.items())
+
+    def blocked_count(self):
+        return len(self.blocked)
+
+    def sweep(self, now=None):
+        # Returns (IPs whose block was lifted, IPs evicted since the last sweep)
+        if now is None:
+            now = time.time()
+        removed, self.removed = self.removed, []
+
+        # --- Expired blocks (timer wheel) ---
+        expired = []
+        for ip in self.wheel.advance(now):
+            state = self.blocked.get(ip)
+            # Stale wheel entries (re-blocked or evicted clients) are ignored
+            if state is not None and not state.is_blocked(now):
+                self.unblock(ip)
+                self.expired_blocks += 1
+                expired.append(ip)
+
+        # --- Idle clients (front of the LRU order is the least recently seen) ---
+        entries = self.entries
+        cutoff = now - self.idle_ttl
+        for _ in range(len(entries)):
+            ip, state = next(iter(entries.items()))
+            if state.last_seen > cutoff:
+                break
+            if state.is_blocked(now):
+                # Long blocks (honeypot) keep their record; revisit it one TTL later
+                state.last_seen = now
+                entries.move_to_end(ip)
+                continue
+            del entries[ip]
+            self.ttl_evictions += 1
+            removed.append(ip)
+
+        return expired, removed
+
+    def approx_bytes(self, sample_size=32):
+        # Extrapolated from a small sample so the call stays cheap
+        count = len(self.entries)
+        if not count:
+            return sys.getsizeof(self.entries)
+        sampled = 0
+        total = 0
+        for ip, state in self.entries.items():
+            total += sys.getsizeof(ip) + sys.getsizeof(state) + sys.getsizeof(state.ts)
+            sampled += 1
+            if sampled >= sample_size:
+                break
+        return sys.getsizeof(self.entries) + sys.getsizeof(self.blocked) + total * count // sampled
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "blocked": len(self.blocked),
+            "lru_evictions": self.lru_evictions,
+            "ttl_evictions": self.ttl_evictions,
+            "expired_blocks": self.expired_blocks,
+            "approx_bytes": self.approx_bytes(),
+        }
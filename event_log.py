@@ -0,0 +1,122 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+
+# Security event log. The request path only appends a compact tuple to a
+# bounded in-memory ring; a background task encodes batches as JSONL (one
+# object per line, "ts" first) and writes them off the event loop, rotating
+# the file by size. When the ring is full new events are dropped and counted
+# instead of making a request wait for I/O.
+
+
+class EventLog:
+    def __init__(self, path=None, capacity=8192, flush_interval=1.0, batch_size=512,
+                 max_bytes=64 * 1024 * 1024, backups=5):
+        # path=None writes the batches to stdout instead of a file
+        self.path = path
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.ring = deque()
+        self.emitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self.write_errors = 0
+        self._wakeup = None
+        self._writer = None
+
+    def emit(self, kind, **fields):
+        # Hot path: no encoding, no I/O
+        if len(self.ring) >= self.capacity:
+            self.dropped += 1
+            return
+        self.ring.append((time.time(), kind, fields))
+        self.emitted += 1
+        if len(self.ring) == self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        if self._writer is None:
+            self._wakeup = asyncio.Event()
+            self._writer = asyncio.create_task(self._flush_forever())
+        return self._writer
+
+    async def stop(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        await self.flush()
+
+    async def _flush_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        while self.ring:
+            count = min(len(self.ring), self.batch_size)
+            ring = self.ring
+            batch = [ring.popleft() for _ in range(count)]
+            data = "".join(
+                json.dumps({"ts": ts, "event": kind, **fields}, separators=(",", ":")) + "\n"
+                for ts, kind, fields in batch
+            )
+            try:
+                await asyncio.to_thread(self._write, data)
+                self.written += count
+            except OSError:
+                self.write_errors += 1
+
+    def _write(self, data):
+        # Runs in a worker thread; one batch per call
+        if self.path is None:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            return
+        encoded = data.encode()
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size and size + len(encoded) > self.max_bytes:
+            self._rotate()
+        with open(self.path, "ab") as f:
+            f.write(encoded)
+
+    def _rotate(self):
+        # events.jsonl -> events.jsonl.1 -> ... -> events.jsonl.<backups>
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "pending": len(self.ring),
+            "emitted": self.emitted,
+            "written": self.written,
+            "dropped": self.dropped,
+            "rotations": self.rotations,
+            "write_errors": self.write_errors,
+            "capacity": self.capacity,
+        }
@@ -0,0 +1,233 @@
+import heapq
+import math
+from array import array
+
+# Approximate front line for unbounded client cardinality. Every request is
+# counted per client IP and per fingerprint in fixed memory; only suspected
+# heavy hitters get an exact per-client record (ClientRecord) in the state
+# backend, so a flood of one-shot addresses costs no per-client state.
+
+MASK64 = (1 << 64) - 1
+MASK32 = (1 << 32) - 1
+
+
+class CountMinSketch:
+    # Count-Min Sketch with conservative update over two tumbling windows.
+    # An estimate covers the current and the previous window: it never
+    # undercounts, and overcounts by at most epsilon * (requests in those
+    # windows) with probability 1 - delta. Keys hash with Python's salted
+    # hash(), so collisions cannot be precomputed from outside the process.
+
+    def __init__(self, epsilon=0.00001, delta=0.05):
+        self.epsilon = epsilon
+        self.delta = delta
+        self.width, self.depth = self.dimensions(epsilon, delta)
+        self.current = self._table()
+        self.previous = self._table()
+        self.current_total = 0
+        self.previous_total = 0
+
+    @staticmethod
+    def dimensions(epsilon, delta):
+        return math.ceil(math.e / epsilon), math.ceil(math.log(1.0 / delta))
+
+    def _table(self):
+        return array("i", bytes(4 * self.width * self.depth))
+
+    def _cells(self, key):
+        # One counter per row, from two halves of one 64-bit hash
+        h = hash(key) & MASK64
+        low = h & MASK32
+        step = (h >> 32) | 1
+        width = self.width
+        return [row * width + (low + row * step) % width for row in range(self.depth)]
+
+    def add(self, key):
+        # Counts one occurrence and returns the key's new estimate
+        cells = self._cells(key)
+        current = self.current
+        floor = min([current[cell] for cell in cells]) + 1
+        # Conservative update: only raise the counters that are below the new
+        # estimate, which keeps collisions from inflating every row
+        for cell in cells:
+            if current[cell] < floor:
+                current[cell] = floor
+        self.current_total += 1
+        previous = self.previous
+        return floor + min([previous[cell] for cell in cells])
+
+    def estimate(self, key):
+        cells = self._cells(key)
+        current, previous = self.current, self.previous
+        return min([current[cell] for cell in cells]) + min([previous[cell] for cell in cells])
+
+    def rotate(self, skipped=False):
+        # Starts a new window; `skipped` drops the previous one as well
+        # (a whole window went by without traffic)
+        self.previous = self._table() if skipped else self.current
+        self.previous_total = 0 if skipped else self.current_total
+        self.current = self._table()
+        self.current_total = 0
+
+    def error_bound(self):
+        # Overcount bound (holding with probability 1 - delta) right now
+        return self.epsilon * (self.current_total + self.previous_total)
+
+    def size_bytes(self):
+        return 2 * self.current.itemsize * len(self.current)
+
+
+class SpaceSaving:
+    # Space-Saving top-k over at most `capacity` monitored keys. Every key
+    # whose true count exceeds total / capacity is monitored, with its count
+    # overestimated by at most its recorded error. Keys are bucketed by count
+    # (stream summary), so an update is O(1) even when a key is replaced.
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        # key -> [count, error]
+        self.counts = {}
+        # count -> keys with that count
+        self.buckets = {}
+        self.min_count = 0
+        self.total = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _place(self, key, count):
+        bucket = self.buckets.get(count)
+        if bucket is None:
+            bucket = self.buckets[count] = set()
+        bucket.add(key)
+
+    def _unplace(self, key, count):
+        bucket = self.buckets[count]
+        bucket.discard(key)
+        if not bucket:
+            del self.buckets[count]
+            # Counts only grow by one, so the next bucket up is never empty here
+            if count == self.min_count:
+                self.min_count = count + 1
+
+    def add(self, key):
+        self.total += 1
+        counts = self.counts
+        entry = counts.get(key)
+        if entry is not None:
+            self._unplace(key, entry[0])
+            entry[0] += 1
+            self._place(key, entry[0])
+            return
+        if len(counts) < self.capacity:
+            counts[key] = [1, 0]
+            self._place(key, 1)
+            self.min_count = 1
+            return
+        # Full: the new key takes over a least-counted slot and inherits its
+        # count as the error bound
+        floor = self.min_count
+        victim = next(iter(self.buckets[floor]))
+        self._unplace(victim, floor)
+        del counts[victim]
+        counts[key] = [floor + 1, floor]
+        self._place(key, floor + 1)
+
+    def decay(self):
+        # Halves every count (and error); keys that fall to zero are dropped
+        self.counts = {key: [count // 2, error // 2] for key, (count, error) in self.counts.items() if count >= 2}
+        self.buckets = {}
+        for key, (count, _) in self.counts.items():
+            self._place(key, count)
+        self.min_count = min(self.buckets) if self.buckets else 0
+        self.total //= 2
+
+    def top(self, n=10):
+        ranked = heapq.nlargest(n, self.counts.items(), key=lambda item: item[1][0])
+        return [{"key": key, "count": count, "error": error} for key, (count, error) in ranked]
+
+
+class HeavyHitterFilter:
+    # Front-line stage ahead of the exact per-client path. A request comes
+    # from a suspected heavy hitter when its IP's estimated request count over
+    # the last `window` seconds reaches `ip_threshold`, or its fingerprint's
+    # reaches `fingerprint_threshold` (0 = fingerprints never mark a client,
+    # and only the top-k tracker counts them). Fingerprints are few, so their
+    # sketch gets away with a much coarser `fingerprint_epsilon`.
+    # ip_threshold = 0 disables the filter: every client is tracked exactly,
+    # and the sketches are not allocated until the first observe().
+
+    def __init__(self, ip_threshold, fingerprint_threshold=0, window=120.0,
+                 epsilon=0.00001, delta=0.05, top_k=100, fingerprint_epsilon=0.001):
+        self.ip_threshold = ip_threshold
+        self.fingerprint_threshold = fingerprint_threshold
+        self.window = window
+        self.epsilon = epsilon
+        self.delta = delta
+        self.fingerprint_epsilon = fingerprint_epsilon
+        self.ips = None
+        self.fingerprints = None
+        self.top_ips = SpaceSaving(top_k)
+        self.top_fingerprints = SpaceSaving(top_k)
+        self.window_index = None
+        self.light = 0
+        self.heavy = 0
+
+    @property
+    def enabled(self):
+        return self.ip_threshold > 0
+
+    def _advance(self, now):
+        index = int(now // self.window)
+        if self.window_index is None:
+            self.ips = CountMinSketch(self.epsilon, self.delta)
+            if self.fingerprint_threshold:
+                self.fingerprints = CountMinSketch(self.fingerprint_epsilon, self.delta)
+            self.window_index = index
+            return
+        if index <= self.window_index:
+            return
+        skipped = index > self.window_index + 1
+        self.ips.rotate(skipped)
+        if self.fingerprints is not None:
+            self.fingerprints.rotate(skipped)
+        # Top-k counts decay by half per window so old floods fall off the list
+        self.top_ips.decay()
+        self.top_fingerprints.decay()
+        self.window_index = index
+
+    def observe(self, ip, fingerprint, now):
+        # Counts the request; True when the client should be tracked exactly
+        self._advance(now)
+        self.top_ips.add(ip)
+        self.top_fingerprints.add(fingerprint)
+        heavy = self.ips.add(ip) >= self.ip_threshold
+        if self.fingerprints is not None and self.fingerprints.add(fingerprint) >= self.fingerprint_threshold:
+            heavy = True
+        if heavy:
+            self.heavy += 1
+            return True
+        self.light += 1
+        return False
+
+    def top(self, n=10):
+        return {"ips": self.top_ips.top(n), "fingerprints": self.top_fingerprints.top(n)}
+
+    def stats(self):
+        width, depth = CountMinSketch.dimensions(self.epsilon, self.delta)
+        return {
+            "enabled": self.enabled,
+            "ip_threshold": self.ip_threshold,
+            "fingerprint_threshold": self.fingerprint_threshold,
+            "window": self.window,
+            "epsilon": self.epsilon,
+            "delta": self.delta,
+            "width": width,
+            "depth": depth,
+            "sketch_bytes": sum(sketch.size_bytes() for sketch in (self.ips, self.fingerprints) if sketch),
+            "ip_error_bound": round(self.ips.error_bound(), 1) if self.ips else None,
+            "fingerprint_error_bound": round(self.fingerprints.error_bound(), 1) if self.fingerprints else None,
+            "top_k": self.top_ips.capacity,
+            "light_requests": self.light,
+            "heavy_requests": self.heavy,
+        }
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import threading
+import time
+
+# File watching for hot-reloaded configuration (signature feeds, policies).
+# The request path only ever does a rate-limited stat(); when the file has
+# changed and an event loop is running, the new value is built in a worker
+# thread and published on the loop with a single reference swap. Without a
+# loop (startup, replay, tests) the build runs inline.
+
+
+class WatchedFile:
+    def __init__(self, path, build, publish, failure_event, check_interval=2.0, events=None):
+        # `build(path)` returns the new value or raises OSError/ValueError;
+        # `publish(value)` installs it. Failures keep the last good value and
+        # are emitted to `events` (an EventLog) as `failure_event`.
+        self.path = path
+        self.build = build
+        self.publish = publish
+        self.failure_event = failure_event
+        self.check_interval = check_interval
+        self.events = events
+        self.reloads = 0
+        self.last_error = None
+        self.pending = None
+        self._mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def reload(self):
+        # Synchronous build and publish
+        with self._lock:
+            mtime = None
+            try:
+                mtime = os.stat(self.path).st_mtime
+                value = self.build(self.path)
+            except (OSError, ValueError) as e:
+                self._failed(mtime, e)
+                return False
+            self._published(mtime, value)
+            return True
+
+    def maybe_reload(self, now=None):
+        # At most one stat() every `check_interval` seconds, and at most one
+        # background build at a time
+        if not self.path or self.pending is not None:
+            return False
+        if now is None:
+            now = time.time()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self.reload()
+        self.pending = asyncio.create_task(self._reload_off_loop(mtime))
+        return True
+
+    async def _reload_off_loop(self, mtime):
+        try:
+            value = await asyncio.to_thread(self.build, self.path)
+        except (OSError, ValueError) as e:
+            self._failed(mtime, e)
+        else:
+            self._published(mtime, value)
+        finally:
+            self.pending = None
+
+    def _published(self, mtime, value):
+        self._mtime = mtime
+        self.publish(value)
+        self.reloads += 1
+        self.last_error = None
+
+    def _failed(self, mtime, error):
+        # Keep serving with the last good value; a broken file is not retried
+        # (or reported again) until it changes
+        self._mtime = mtime
+        self.last_error = str(error)
+        if self.events is not None:
+            self.events.emit(self.failure_event, path=self.path, error=self.last_error)
@@ -0,0 +1,144 @@
+from time import perf_counter_ns
+
+# Per-process telemetry in the Prometheus text format (version 0.0.4).
+# Recording is a dict or list increment on the event loop thread: no locks,
+# no allocation on the hot path once a label combination has been seen.
+
+# Latency buckets are log-linear (HDR style): 2**SUB_BITS buckets per power of
+# two, so any recorded value is off by at most 1 / 2**SUB_BITS (25%)
+SUB_BITS = 2
+SUB_COUNT = 1 << SUB_BITS
+# Recorded range in nanoseconds; slower samples land in the last bucket
+MAX_SHIFT = 36
+BUCKETS = (MAX_SHIFT + 2) * SUB_COUNT
+# Exported `le` bounds: one per power of two from 2**15 ns (33 us) to 2**30 ns
+# (1.07 s). Recording keeps the fine buckets (quantiles() and the bench use
+# them); the scrape only carries 17 buckets per stage.
+EXPORT_FROM_NS = 1 << 15
+EXPORT_TO_NS = 1 << 30
+
+
+def bucket_index(ns):
+    if ns < 2 * SUB_COUNT:
+        return ns if ns > 0 else 0
+    shift = ns.bit_length() - SUB_BITS - 1
+    if shift > MAX_SHIFT:
+        return BUCKETS - 1
+    return SUB_COUNT * shift + (ns >> shift)
+
+
+def bucket_upper(index):
+    # Exclusive upper bound (ns) of a bucket
+    if index < 2 * SUB_COUNT:
+        return index + 1
+    shift = index // SUB_COUNT - 1
+    return ((index % SUB_COUNT + SUB_COUNT) + 1) << shift
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class LatencyHistogram:
+    __slots__ = ("counts", "count", "total_ns")
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total_ns = 0
+
+    def record(self, ns):
+        self.counts[bucket_index(ns)] += 1
+        self.count += 1
+        self.total_ns += ns
+
+    def quantile(self, q):
+        # Upper bound (ns) of the bucket holding the q-th sample
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bucket_upper(index)
+        return bucket_upper(BUCKETS - 1)
+
+
+class Metrics:
+    def __init__(self, stages=()):
+        # name -> (help, label names, {label values: count})
+        self.counters = {}
+        self.stages = {stage: LatencyHistogram() for stage in stages}
+        self.exported = [
+            index for index in range(BUCKETS)
+            if EXPORT_FROM_NS <= bucket_upper(index) <= EXPORT_TO_NS
+            and bucket_upper(index) & (bucket_upper(index) - 1) == 0
+        ]
+
+    def counter(self, name, help_text, labels=()):
+        # Unlabelled counters report 0 before their first increment
+        self.counters[name] = (help_text, tuple(labels), {} if labels else {(): 0})
+
+    def inc(self, name, *values):
+        series = self.counters[name][2]
+        series[values] = series.get(values, 0) + 1
+
+    def lap(self, stage, started_ns):
+        # Records the time since `started_ns` and returns the new start
+        # (LatencyHistogram.record inlined: this runs several times a request)
+        now_ns = perf_counter_ns()
+        ns = now_ns - started_ns
+        histogram = self.stages[stage]
+        shift = ns.bit_length() - SUB_BITS - 1
+        index = SUB_COUNT * shift + (ns >> shift) if shift > 0 else max(ns, 0)
+        histogram.counts[index if index < BUCKETS else BUCKETS - 1] += 1
+        histogram.count += 1
+        histogram.total_ns += ns
+        return now_ns
+
+    def quantiles(self, qs=(0.5, 0.99)):
+        return {
+            stage: {f"p{int(q * 100)}_us": round(histogram.quantile(q) / 1000, 3) for q in qs}
+            for stage, histogram in self.stages.items() if histogram.count
+        }
+
+    def render(self, gauges=(), counters=()):
+        # `gauges` / `counters`: (name, help, value) sampled by the caller at
+        # scrape time; counters are totals kept elsewhere that only grow
+        lines = []
+        for name, (help_text, labels, series) in self.counters.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for values, count in list(series.items()):
+                lines.append(f"{name}{format_labels(labels, values)} {count}")
+
+        name = "flowlock_stage_duration_seconds"
+        lines.append(f"# HELP {name} Time spent in each detection stage")
+        lines.append(f"# TYPE {name} histogram")
+        for stage, histogram in self.stages.items():
+            counts = histogram.counts
+            # Each exported bound folds in every fine bucket below it
+            cumulative = 0
+            start = 0
+            for index in self.exported:
+                cumulative += sum(counts[start:index + 1])
+                start = index + 1
+                le = bucket_upper(index) / 1e9
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{le:.9g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.total_ns / 1e9:.9f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+        for kind, sampled in (("gauge", gauges), ("counter", counters)):
+            for name, help_text, value in sampled:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
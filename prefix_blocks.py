@@ -0,0 +1,376 @@
+import functools
+import ipaddress
+import socket
+
+from client_store import TimerWheel
+
+# Prefix-level policy: static allow/deny CIDR lists plus subnet blocks that
+# are created on the fly, all held in one radix trie per address family and
+# matched longest-prefix-first, so checking a request costs O(prefix length)
+# no matter how many addresses an attacker rotates through.
+
+ALLOW = "allow"
+DENY = "deny"
+BLOCK = "block"
+
+# Sliding window (seconds) for the per-prefix request counters
+RATE_WINDOW = 60.0
+
+IPV4_MAPPED = b"\0" * 10 + b"\xff\xff"
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_address(ip):
+    # (bits, integer) for an address, None for anything that is not one
+    # ("testclient", unix sockets); IPv4-mapped IPv6 is treated as IPv4.
+    # inet_pton instead of ipaddress: spoofed floods make most lookups misses.
+    try:
+        return 32, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+    except (OSError, TypeError):
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, ip)
+    except (OSError, TypeError):
+        return None
+    if packed[:12] == IPV4_MAPPED:
+        return 32, int.from_bytes(packed[12:], "big")
+    return 128, int.from_bytes(packed, "big")
+
+
+def parse_network(cidr):
+    network = ipaddress.ip_network(cidr.strip(), strict=False)
+    return network.max_prefixlen, int(network.network_address), network.prefixlen
+
+
+def format_network(bits, key, length):
+    address = ipaddress.IPv4Address(key) if bits == 32 else ipaddress.IPv6Address(key)
+    return f"{address}/{length}"
+
+
+class _Node:
+    __slots__ = ("key", "length", "children", "value")
+
+    def __init__(self, key, length, value=None):
+        self.key = key
+        self.length = length
+        self.children = [None, None]
+        self.value = value
+
+
+class RadixTrie:
+    # Path-compressed binary trie over one address family. Keys are network
+    # addresses as integers (host bits zero) plus a prefix length; a node
+    # exists only where a prefix is stored or two branches split.
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _bit(self, key, index):
+        return (key >> (self.bits - 1 - index)) & 1
+
+    def _common(self, key_a, length_a, key_b, length_b):
+        # Length of the common leading bits, capped at the shorter prefix
+        shortest = min(length_a, length_b)
+        if not shortest:
+            return 0
+        differ = (key_a ^ key_b) >> (self.bits - shortest)
+        return shortest - differ.bit_length()
+
+    def _mask(self, key, length):
+        if not length:
+            return 0
+        shift = self.bits - length
+        return (key >> shift) << shift
+
+    def insert(self, key, length, value):
+        key = self._mask(key, length)
+        parent, slot, node = None, 0, self.root
+        while node is not None:
+            common = self._common(key, length, node.key, node.length)
+            if common < node.length:
+                # Split: the new prefix (or a glue node) goes above `node`
+                if common == length:
+                    above = _Node(key, length, value)
+                    self.size += 1
+                else:
+                    above = _Node(self._mask(key, common), common)
+                    leaf = _Node(key, length, value)
+                    self.size += 1
+                    above.children[self._bit(key, common)] = leaf
+                above.children[self._bit(node.key, common)] = node
+                self._attach(parent, slot, above)
+                return
+            if length == node.length:
+                if node.value is None:
+                    self.size += 1
+                node.value = value
+                return
+            parent, slot = node, self._bit(key, node.length)
+            node = node.children[slot]
+        self._attach(parent, slot, _Node(key, length, value))
+        self.size += 1
+
+    def _attach(self, parent, slot, node):
+        if parent is None:
+            self.root = node
+        else:
+            parent.children[slot] = node
+
+    def get(self, key, length):
+        key = self._mask(key, length)
+        node = self.root
+        while node is not None and node.length <= length:
+            if self._common(key, length, node.key, node.length) < node.length:
+                return None
+            if node.length == length:
+                return node.value
+            node = node.children[self._bit(key, node.length)]
+        return None
+
+    def remove(self, key, length):
+        key = self._mask(key, length)
+        path = []
+        node = self.root
+        while node is not None and node.length <= length:
+            if self._common(key, length, node.key, node.length) < node.length:
+                return False
+            if node.length == length:
+                break
+            slot = self._bit(key, node.length)
+            path.append((node, slot))
+            node = node.children[slot]
+        else:
+            return False
+        if node.value is None:
+            return False
+        node.value = None
+        self.size -= 1
+
+        # Drop nodes that no longer store or split anything
+        while node is not None and node.value is None:
+            kids = [child for child in node.children if child is not None]
+            if len(kids) == 2:
+                break
+            replacement = kids[0] if kids else None
+            if path:
+                parent, slot = path.pop()
+                parent.children[slot] = replacement
+                node = parent
+            else:
+                self.root = replacement
+                break
+        return True
+
+    def matches(self, key):
+        # Every stored prefix covering `key`, shortest first
+        found = []
+        node = self.root
+        while node is not None:
+            if self._common(key, self.bits, node.key, node.length) < node.length:
+                break
+            if node.value is not None:
+                found.append(node.value)
+            if node.length == self.bits:
+                break
+            node = node.children[self._bit(key, node.length)]
+        return found
+
+    def items(self):
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            if node.value is not None:
+                yield node.key, node.length, node.value
+            stack.extend(child for child in node.children if child is not None)
+
+
+class PrefixRule:
+    __slots__ = ("network", "kind", "until", "reason")
+
+    def __init__(self, network, kind, until=0.0, reason=None):
+        self.network = network
+        self.kind = kind
+        # 0 = permanent (static lists)
+        self.until = until
+        self.reason = reason
+
+    def active(self, now):
+        return not self.until or self.until > now
+
+    def view(self, now):
+        return {
+            "network": self.network,
+            "kind": self.kind,
+            "reason": self.reason,
+            "expires_in": round(self.until - now, 1) if self.until else None,
+        }
+
+
+class PrefixPolicy:
+    # Longest-prefix-match policy for LAYER 1.
+    #   - static allow/deny CIDR lists
+    #   - promotion: once `promote_after` addresses of one /24 (IPv4) or /64
+    #     (IPv6) are blocked, the whole prefix is blocked
+    #   - per-prefix request rate: more than `prefix_rpm` requests a minute
+    #     from one prefix blocks it (0 disables)
+    # The most specific matching rule wins, so an allow-listed /32 inside a
+    # denied /16 still gets through.
+
+    def __init__(self, allow=(), deny=(), promote_after=4, v4_prefix=24, v6_prefix=64,
+                 block_seconds=300.0, prefix_rpm=0, max_tracked=100_000):
+        self.tries = {32: RadixTrie(32), 128: RadixTrie(128)}
+        self.aggregate = {32: v4_prefix, 128: v6_prefix}
+        self.promote_after = promote_after
+        self.block_seconds = block_seconds
+        self.prefix_rpm = prefix_rpm
+        self.max_tracked = max_tracked
+        # prefix -> {address: blocked_until} for promotion
+        self.blocked_members = {}
+        # prefix -> [window index, count in window, count in previous window]
+        self.rates = {}
+        self.wheel = TimerWheel()
+        self.promotions = 0
+        self.rate_blocks = 0
+        self.denied = 0
+        for cidr in allow:
+            self.add_rule(cidr, ALLOW)
+        for cidr in deny:
+            self.add_rule(cidr, DENY)
+
+    def add_rule(self, cidr, kind, until=0.0, reason=None):
+        bits, key, length = parse_network(cidr)
+        rule = PrefixRule(format_network(bits, key, length), kind, until, reason)
+        self.tries[bits].insert(key, length, rule)
+        if until:
+            self.wheel.schedule((bits, key, length), until)
+        return rule
+
+    def remove_rule(self, cidr):
+        bits, key, length = parse_network(cidr)
+        return self.tries[bits].remove(key, length)
+
+    def lookup(self, ip, now):
+        # Most specific active rule covering `ip`, or None
+        parsed = parse_address(ip)
+        if parsed is None:
+            return None
+        bits, key = parsed
+        for rule in reversed(self.tries[bits].matches(key)):
+            if rule.active(now):
+                return rule
+        return None
+
+    def _prefix_of(self, ip):
+        parsed = parse_address(ip)
+        if parsed is None:
+            return None
+        bits, key = parsed
+        length = self.aggregate[bits]
+        shift = bits - length
+        return bits, (key >> shift) << shift, length
+
+    def _block_prefix(self, prefix, reason, now):
+        bits, key, length = prefix
+        trie = self.tries[bits]
+        covering = [rule for rule in trie.matches(key) if rule.active(now)]
+        # Never block inside an allow-listed network, nor re-block a denied one
+        if covering and covering[-1].kind in (ALLOW, DENY):
+            return None
+        until = now + self.block_seconds
+        rule = PrefixRule(format_network(bits, key, length), BLOCK, until, reason)
+        trie.insert(key, length, rule)
+        self.wheel.schedule(prefix, until)
+        return rule
+
+    def count_request(self, ip, now):
+        # Per-prefix sliding-window rate; returns the new block rule when
+        # this request pushes the prefix over `prefix_rpm`
+        if not self.prefix_rpm:
+            return None
+        prefix = self._prefix_of(ip)
+        if prefix is None:
+            return None
+        window = int(now // RATE_WINDOW)
+        counter = self.rates.get(prefix)
+        if counter is None:
+            if len(self.rates) >= self.max_tracked:
+                return None
+            counter = self.rates[prefix] = [window, 0, 0]
+        elif counter[0] != window:
+            counter[2] = counter[1] if counter[0] == window - 1 else 0
+            counter[0] = window
+            counter[1] = 0
+        counter[1] += 1
+        elapsed = (now - window * RATE_WINDOW) / RATE_WINDOW
+        rate = counter[1] + counter[2] * (1.0 - elapsed)
+        if rate <= self.prefix_rpm:
+            return None
+        del self.rates[prefix]
+        rule = self._block_prefix(prefix, "SUBNET_FLOOD", now)
+        if rule is not None:
+            self.rate_blocks += 1
+        return rule
+
+    def record_block(self, ip, until, now):
+        # Called for every per-address block; promotes the prefix once
+        # `promote_after` distinct addresses in it are blocked at once
+        if not self.promote_after:
+            return None
+        prefix = self._prefix_of(ip)
+        if prefix is None:
+            return None
+        members = self.blocked_members.get(prefix)
+        if members is None:
+            if len(self.blocked_members) >= self.max_tracked:
+                return None
+            members = self.blocked_members[prefix] = {}
+        members[ip] = until
+        for address in [address for address, expiry in members.items() if expiry <= now]:
+            del members[address]
+        if len(members) < self.promote_after:
+            return None
+        del self.blocked_members[prefix]
+        rule = self._block_prefix(prefix, "SUBNET_SPRAY", now)
+        if rule is not None:
+            self.promotions += 1
+        return rule
+
+    def sweep(self, now):
+        # Lifts expired prefix blocks and forgets stale counters;
+        # returns the networks that were unblocked
+        expired = []
+        for bits, key, length in self.wheel.advance(now):
+            trie = self.tries[bits]
+            rule = trie.get(key, length)
+            if rule is not None and rule.until and not rule.active(now):
+                trie.remove(key, length)
+                expired.append(rule.network)
+        window = int(now // RATE_WINDOW)
+        for prefix in [prefix for prefix, counter in self.rates.items() if counter[0] < window - 1]:
+            del self.rates[prefix]
+        for prefix in [prefix for prefix, members in self.blocked_members.items()
+                       if all(expiry <= now for expiry in members.values())]:
+            del self.blocked_members[prefix]
+        return expired
+
+    def rules(self, now):
+        return [rule.view(now) for trie in self.tries.values() for _, _, rule in trie.items() if rule.active(now)]
+
+    def stats(self):
+        blocks = sum(1 for trie in self.tries.values() for _, _, rule in trie.items() if rule.kind == BLOCK)
+        return {
+            "rules": sum(len(trie) for trie in self.tries.values()),
+            "prefix_blocks": blocks,
+            "promotions": self.promotions,
+            "rate_blocks": self.rate_blocks,
+            "denied": self.denied,
+            "tracked_rates": len(self.rates),
+            "tracked_blocked_prefixes": len(self.blocked_members),
+            "promote_after": self.promote_after,
+            "prefix_rpm": self.prefix_rpm,
+        }
@@ -0,0 +1,352 @@
+import asyncio
+import time
+import urllib.parse
+
+from behavior_features import HISTORY_SIZE
+from client_store import ClientRecord
+from state_backend import StateBackend
+
+# Redis-protocol state backend for running FlowLock across many API nodes.
+#
+# Hot path: observe() sends one pipeline (fingerprint check, block check,
+# timestamp append + trim + read, risk read) and waits for one round trip.
+# Everything decided afterwards (risk updates, blocks, undoing the log entry
+# of a rejected request) is queued and flushed by a background writer, so a
+# request never waits for more than one network RTT. screen() (heavy-hitter
+# front line) is the same single round trip, reads only.
+#
+# Key layout (all under `prefix`):
+#   log:<ip>      list of the last HISTORY_SIZE timestamps
+#   risk:<ip>     highest risk seen (expires with the block / idle TTL)
+#   block:<ip>    "until|honeypot|reason", expires when the block lifts
+#   clients       zset ip -> last seen (dashboard listing, idle pruning)
+#   blocked       zset ip -> block expiry
+#   fingerprints  set of blacklisted fingerprints
+
+
+class RedisError(Exception):
+    pass
+
+
+def _encode_command(args):
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, float):
+            data = repr(arg).encode()
+        else:
+            data = str(arg).encode()
+        out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(out)
+
+
+async def _read_reply(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("connection closed by server")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload
+    if kind == b"-":
+        return RedisError(payload.decode())
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    raise RedisError(f"unexpected reply: {line!r}")
+
+
+def _check(replies):
+    # Error replies are returned as RedisError values so a pipeline can carry
+    # on past them; wherever a reply is read as data (an error is truthy,
+    # e.g. a "blocked" fingerprint) it is raised instead
+    for reply in replies:
+        if isinstance(reply, RedisError):
+            raise reply
+    return replies
+
+
+class RedisConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host, port, password=None, db=0):
+        reader, writer = await asyncio.open_connection(host, port)
+        conn = cls(reader, writer)
+        setup = []
+        if password:
+            setup.append((b"AUTH", password))
+        if db:
+            setup.append((b"SELECT", db))
+        if setup:
+            for reply in await conn.pipeline(setup):
+                if isinstance(reply, RedisError):
+                    conn.close()
+                    raise reply
+        return conn
+
+    async def pipeline(self, commands):
+        # All commands go out in one write; replies are read back in order
+        self.writer.write(b"".join(_encode_command(cmd) for cmd in commands))
+        await self.writer.drain()
+        return [await _read_reply(self.reader) for _ in commands]
+
+    def close(self):
+        self.writer.close()
+
+
+class RedisPool:
+    # Small pool of pipelined connections, opened lazily
+
+    def __init__(self, url, size=8):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 6379
+        self.password = parts.password
+        self.db = int(parts.path.lstrip("/") or 0)
+        self.size = size
+        self.idle = []
+        self.opened = 0
+        self.available = asyncio.Semaphore(size)
+
+    async def pipeline(self, commands):
+        async with self.available:
+            conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = await RedisConnection.open(self.host, self.port, self.password, self.db)
+                self.opened += 1
+            try:
+                replies = await conn.pipeline(commands)
+            except (OSError, ConnectionError, asyncio.IncompleteReadError):
+                # Never return a connection in an unknown protocol state
+                conn.close()
+                raise
+            self.idle.append(conn)
+            return replies
+
+    async def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+
+class RedisStateBackend(StateBackend):
+
+    def __init__(self, url="redis://127.0.0.1:6379/0", prefix="flowlock:", pool_size=8,
+                 idle_ttl=600.0, max_deferred=10000):
+        self.pool = RedisPool(url, size=pool_size)
+        self.prefix = prefix
+        self.idle_ttl = int(idle_ttl)
+        self.max_deferred = max_deferred
+        self.deferred = []
+        self.deferred_dropped = 0
+        self.deferred_errors = 0
+        self._wakeup = None
+        self._writer = None
+
+    def _key(self, name):
+        return self.prefix + name
+
+    async def _pipeline(self, commands):
+        return _check(await self.pool.pipeline(commands))
+
+    # --- Deferred writes (no RTT on the request path) ---
+
+    def defer(self, *commands):
+        if len(self.deferred) + len(commands) > self.max_deferred:
+            self.deferred_dropped += len(commands)
+            return
+        self.deferred.extend(commands)
+        if self._writer is None:
+            self._wakeup = asyncio.Event()
+            self._writer = asyncio.create_task(self._flush_forever())
+        self._wakeup.set()
+
+    async def _flush_forever(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        batch, self.deferred = self.deferred, []
+        if not batch:
+            return
+        try:
+            replies = await self.pool.pipeline(batch)
+            self.deferred_errors += sum(isinstance(reply, RedisError) for reply in replies)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            self.deferred_errors += len(batch)
+
+    # --- Record reconstruction ---
+
+    @staticmethod
+    def _record(timestamps, risk, block):
+        record = ClientRecord()
+        for ts in timestamps:
+            record.append(float(ts))
+        record.highest_risk = int(risk) if risk is not None else 0
+        if block is not None:
+            until, honeypot, reason = block.decode().split("|", 2)
+            record.block(float(until), reason, honeypot == "1")
+        return record
+
+    def _read_commands(self, ip):
+        return [
+            (b"LRANGE", self._key("log:" + ip), 0, -1),
+            (b"GET", self._key("risk:" + ip)),
+            (b"GET", self._key("block:" + ip)),
+        ]
+
+    async def _records(self, ips):
+        if not ips:
+            return []
+        commands = []
+        for ip in ips:
+            commands.extend(self._read_commands(ip))
+        replies = await self._pipeline(commands)
+        return [
+            (ip, self._record(replies[i * 3], replies[i * 3 + 1], replies[i * 3 + 2]))
+            for i, ip in enumerate(ips)
+        ]
+
+    # --- StateBackend interface ---
+
+    async def observe(self, ip, fingerprint, now):
+        log_key = self._key("log:" + ip)
+        ts = repr(now)
+        fp_blocked, block, _, _, timestamps, risk, _, _ = await self._pipeline([
+            (b"SISMEMBER", self._key("fingerprints"), fingerprint),
+            (b"GET", self._key("block:" + ip)),
+            (b"RPUSH", log_key, ts),
+            (b"LTRIM", log_key, -HISTORY_SIZE, -1),
+            (b"LRANGE", log_key, 0, -1),
+            (b"GET", self._key("risk:" + ip)),
+            (b"EXPIRE", log_key, self.idle_ttl),
+            (b"ZADD", self._key("clients"), now, ip),
+        ])
+        if fp_blocked:
+            # Blocked requests are not logged: take our timestamp back out
+            self.defer((b"LREM", log_key, -1, ts))
+            return True, None
+        record = self._record(timestamps, risk, block)
+        if record.is_blocked(now):
+            self.defer((b"LREM", log_key, -1, ts))
+        return False, record
+
+    async def screen(self, ip, fingerprint, now):
+        # Reads only; for an existing record the timestamp append goes out
+        # with the deferred writes, so this stays one round trip
+        log_key = self._key("log:" + ip)
+        fp_blocked, block, timestamps, risk = await self._pipeline([
+            (b"SISMEMBER", self._key("fingerprints"), fingerprint),
+            (b"GET", self._key("block:" + ip)),
+            (b"LRANGE", log_key, 1 - HISTORY_SIZE, -1),
+            (b"GET", self._key("risk:" + ip)),
+        ])
+        if fp_blocked:
+            return True, None
+        if not timestamps and block is None:
+            return False, None
+        record = self._record(timestamps, risk, block)
+        record.append(now)
+        if not record.is_blocked(now):
+            self.defer(
+                (b"RPUSH", log_key, repr(now)),
+                (b"LTRIM", log_key, -HISTORY_SIZE, -1),
+                (b"EXPIRE", log_key, self.idle_ttl),
+                (b"ZADD", self._key("clients"), now, ip),
+            )
+        return False, record
+
+    async def commit(self, ip, state, risk_score, reason, block_until, now):
+        if block_until and not state.blocked:
+            ttl_ms = max(1, int((block_until - now) * 1000))
+            self.defer(
+                (b"SET", self._key("block:" + ip), f"{block_until!r}|0|{reason}", b"PX", ttl_ms, b"NX"),
+                (b"ZADD", self._key("blocked"), block_until, ip),
+                # Highest risk resets when the block lifts, like the local stores
+                (b"SET", self._key("risk:" + ip), int(risk_score), b"PX", ttl_ms),
+            )
+        elif risk_score > state.highest_risk:
+            self.defer((b"SET", self._key("risk:" + ip), int(risk_score), b"EX", self.idle_ttl))
+
+    async def block_ip(self, ip, until, reason, now, honeypot=False):
+        ttl_ms = max(1, int((until - now) * 1000))
+        flag = "1" if honeypot else "0"
+        await self._pipeline([
+            (b"SET", self._key("block:" + ip), f"{until!r}|{flag}|{reason}", b"PX", ttl_ms),
+            (b"ZADD", self._key("blocked"), until, ip),
+            (b"ZADD", self._key("clients"), now, ip),
+            (b"PEXPIRE", self._key("risk:" + ip), ttl_ms),
+        ])
+
+    async def block_fingerprint(self, fingerprint):
+        await self._pipeline([(b"SADD", self._key("fingerprints"), fingerprint)])
+
+    async def items(self):
+        now = time.time()
+        (ips,) = await self._pipeline([
+            (b"ZRANGEBYSCORE", self._key("clients"), now - self.idle_ttl, b"+inf"),
+        ])
+        return await self._records([ip.decode() for ip in ips])
+
+    async def blocked_items(self):
+        (ips,) = await self._pipeline([
+            (b"ZRANGEBYSCORE", self._key("blocked"), f"({time.time()!r}", b"+inf"),
+        ])
+        records = await self._records([ip.decode() for ip in ips])
+        return [(ip, record) for ip, record in records if record.blocked]
+
+    async def blocked_count(self):
+        (count,) = await self._pipeline([
+            (b"ZCOUNT", self._key("blocked"), f"({time.time()!r}", b"+inf"),
+        ])
+        return count
+
+    async def sweep(self):
+        # Keys expire on their own; only the listing indexes need pruning
+        now = time.time()
+        expired, _, idle, _ = await self._pipeline([
+            (b"ZRANGEBYSCORE", self._key("blocked"), b"-inf", now),
+            (b"ZREMRANGEBYSCORE", self._key("blocked"), b"-inf", now),
+            (b"ZRANGEBYSCORE", self._key("clients"), b"-inf", now - self.idle_ttl),
+            (b"ZREMRANGEBYSCORE", self._key("clients"), b"-inf", now - self.idle_ttl),
+        ])
+        return [ip.decode() for ip in expired], [ip.decode() for ip in idle]
+
+    async def stats(self):
+        now = time.time()
+        entries, blocked, fingerprints = await self._pipeline([
+            (b"ZCOUNT", self._key("clients"), now - self.idle_ttl, b"+inf"),
+            (b"ZCOUNT", self._key("blocked"), f"({now!r}", b"+inf"),
+            (b"SCARD", self._key("fingerprints")),
+        ])
+        return {
+            "backend": "redis",
+            "entries": entries,
+            "blocked": blocked,
+            "blocked_fingerprints": fingerprints,
+            "connections": self.pool.opened,
+            "deferred_pending": len(self.deferred),
+            "deferred_dropped": self.deferred_dropped,
+            "deferred_errors": self.deferred_errors,
+        }
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.cancel()
+        await self.flush()
+        await self.pool.close()
+
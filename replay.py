@@ -0,0 +1,580 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+from starlette.datastructures import QueryParams
+
+import api_abuse_detection as flowlock
+import prefix_blocks
+from behavior_features import HISTORY_SIZE, RPM_WINDOW
+from client_store import ClientRecord
+
+# Offline replay: scores a captured JSONL request log with the same features,
+# thresholds, blocks, fingerprint blacklist and honeypot rules as the live
+# middleware, without HTTP. Per-client rpm/variance are computed with NumPy
+# over sorted timestamp arrays. Clients that get blocked (or hit the honeypot)
+# are replayed sequentially with the live ClientRecord sensor instead, since
+# their blocks decide which of their later requests are logged at all.
+#
+# One JSON object per line:
+#   {"ts": 1718000000.25, "ip": "10.0.0.7", "path": "/data",
+#    "query": "page=2", "headers": {"user-agent": "...", "accept-language": "..."}}
+# "ts" may also be "timestamp" or an ISO 8601 string; "path" defaults to /data;
+# a precomputed "fingerprint" takes precedence over "headers", which should be
+# logged in the order they arrived (the fingerprint covers header order).
+# Header values are signature-scanned like the live middleware does; bodies
+# are not logged.
+#
+# Usage: python replay.py traffic.jsonl
+#        python replay.py traffic.jsonl --timelines verdicts.jsonl
+#        python replay.py traffic.jsonl --flood-rpm 20 --bot-variance 0.3
+#        python replay.py traffic.jsonl --check   (cross-check against inspect_request)
+#
+# Assumes the live store never hit FLOWLOCK_MAX_CLIENTS (no LRU evictions) and
+# the sweeper ticks on whole multiples of SWEEP_INTERVAL. The static
+# FLOWLOCK_ALLOW_CIDRS / FLOWLOCK_DENY_CIDRS lists are applied; subnet blocks
+# the live prefix policy creates on the fly are not modeled, every client
+# is tracked exactly (no heavy-hitter front line) and scored with the static
+# thresholds (FLOWLOCK_ADAPTIVE is ignored) and the built-in scoring policy
+# (a FLOWLOCK_POLICY file is refused: the vectorized scorer cannot run it).
+
+# Verdict codes
+ALLOW, TARPIT, BLOCK, BLOCKED, FINGERPRINT, HONEYPOT, BYPASS, PREFIX = range(8)
+VERDICTS = ("allow", "tarpit", "block", "blocked", "fingerprint", "honeypot", "bypass", "prefix")
+
+# Path kinds
+SCORED, BYPASSED, HONEYPOT_PATH = 0, 1, 2
+HONEYPOT_ROUTE = "/api/v1/debug_login"
+
+# Reason codes: behavioral reasons first, then signature categories
+REASONS = ["SCANNING", "VOLUMETRIC_FLOOD"]
+REASON_INDEX = {reason: code for code, reason in enumerate(REASONS)}
+
+
+def reason_code(reason):
+    code = REASON_INDEX.get(reason)
+    if code is None:
+        code = REASON_INDEX[reason] = len(REASONS)
+        REASONS.append(reason)
+    return code
+
+
+def raw_headers(headers):
+    # Logged (name, value) pairs as the ASGI header list the middleware sees
+    return [(name.lower().encode("latin-1"), str(value).encode()) for name, value in headers]
+
+
+def parse_timestamp(value):
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    return float(value)
+
+
+class RequestLog:
+    # Column store for a streamed JSONL log; strings are interned to int codes
+    def __init__(self):
+        self.ts = []
+        self.ip = []
+        self.fingerprint = []
+        self.query = []
+        self.kind = []
+        self.headers = []
+        self.ips = {}
+        self.fingerprints = {}
+        self.queries = {}
+        self.header_sets = {}
+        self._header_fingerprints = {}
+        self._path_kinds = {}
+
+    def _fingerprint_of(self, record, headers):
+        if "fingerprint" in record:
+            return record["fingerprint"]
+        # Header values and order, as the middleware fingerprints them
+        fingerprint = self._header_fingerprints.get(headers)
+        if fingerprint is None:
+            fingerprint = self._header_fingerprints[headers] = flowlock.fingerprint_from_headers(raw_headers(headers))
+        return fingerprint
+
+    def _path_kind(self, path):
+        kind = self._path_kinds.get(path)
+        if kind is None:
+            if path == HONEYPOT_ROUTE:
+                kind = HONEYPOT_PATH
+            elif flowlock.is_bypass_path(path):
+                kind = BYPASSED
+            else:
+                kind = SCORED
+            self._path_kinds[path] = kind
+        return kind
+
+    def add(self, record):
+        ts = record["ts"] if "ts" in record else record["timestamp"]
+        self.ts.append(ts if type(ts) is float else parse_timestamp(ts))
+        ips, fingerprints, queries, header_sets = self.ips, self.fingerprints, self.queries, self.header_sets
+        headers = tuple({key.lower(): value for key, value in (record.get("headers") or {}).items()}.items())
+        self.ip.append(ips.setdefault(record["ip"], len(ips)))
+        self.fingerprint.append(fingerprints.setdefault(self._fingerprint_of(record, headers), len(fingerprints)))
+        self.headers.append(header_sets.setdefault(headers, len(header_sets)))
+        self.query.append(queries.setdefault(record.get("query", ""), len(queries)))
+        self.kind.append(self._path_kind(record.get("path", "/data")))
+
+    @classmethod
+    def load(cls, path):
+        log = cls()
+        decode = json.JSONDecoder().decode
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    log.add(decode(line))
+        return log
+
+
+class Thresholds:
+    # Snapshot of the live scoring constants, optionally overridden for tuning
+    def __init__(self, flood_rpm=None, rpm_tiers=None, bot_variance=None, bot_min_rpm=None):
+        self.flood_rpm = flowlock.FLOOD_RPM if flood_rpm is None else flood_rpm
+        self.rpm_tiers = flowlock.RPM_TIERS if rpm_tiers is None else rpm_tiers
+        self.bot_variance = flowlock.BOT_VARIANCE if bot_variance is None else bot_variance
+        self.bot_min_rpm = flowlock.BOT_MIN_RPM if bot_min_rpm is None else bot_min_rpm
+        self.tarpit_risk = flowlock.TARPIT_RISK
+        self.block_risk = flowlock.BLOCK_RISK
+        self.block_seconds = flowlock.BLOCK_SECONDS
+        self.honeypot_seconds = flowlock.HONEYPOT_BLOCK_SECONDS
+        self.idle_ttl = flowlock.CLIENT_TTL
+        self.sweep_interval = flowlock.SWEEP_INTERVAL
+
+    def apply_to_live(self):
+        # The sequential path and --check score through the live functions,
+        # so they have to see the same overrides
+        flowlock.FLOOD_RPM = self.flood_rpm
+        flowlock.RPM_TIERS = self.rpm_tiers
+        flowlock.BOT_VARIANCE = self.bot_variance
+        flowlock.BOT_MIN_RPM = self.bot_min_rpm
+
+    def as_dict(self):
+        return {
+            "flood_rpm": self.flood_rpm,
+            "rpm_tiers": [list(tier) for tier in self.rpm_tiers],
+            "bot_variance": self.bot_variance,
+            "bot_min_rpm": self.bot_min_rpm,
+            "block_seconds": self.block_seconds,
+            "idle_ttl": self.idle_ttl,
+        }
+
+
+def parse_tiers(text):
+    # "8:85:50,5:70:40,2:60:20" -> ((8, 85, 50), (5, 70, 40), (2, 60, 20))
+    tiers = []
+    for part in text.split(","):
+        min_rpm, bot_score, human_score = (int(value) for value in part.split(":"))
+        tiers.append((min_rpm, bot_score, human_score))
+    return tuple(sorted(tiers, reverse=True))
+
+
+# --- VECTORIZED SENSORS ---
+
+def window_features(t, start, chunk=65536):
+    # rpm and variance for every row of `t`, each computed over that row's last
+    # HISTORY_SIZE timestamps of its own client (rows start[i]..i), exactly as
+    # BehaviorFeatures.snapshot() would report them right after appending t[i].
+    n = len(t)
+    idx = np.arange(n)
+    lo = np.maximum(start, idx - (HISTORY_SIZE - 1))
+    cutoff = t - RPM_WINDOW
+
+    # First row inside the RPM window: binary search over [lo, idx], which is
+    # at most HISTORY_SIZE wide, so a handful of vectorized steps
+    left = lo.copy()
+    right = idx.copy()
+    while True:
+        active = left < right
+        if not active.any():
+            break
+        mid = (left + right) // 2
+        stale = t[mid] <= cutoff
+        left = np.where(active & stale, mid + 1, left)
+        right = np.where(active & ~stale, mid, right)
+    rpm = idx - left + 1
+
+    # Sample variance of the gaps inside the history window (two-pass, per chunk)
+    gaps = np.diff(t, prepend=t[:1] if n else t)
+    variance = np.zeros(n)
+    offsets = np.arange(-(HISTORY_SIZE - 2), 1)
+    for begin in range(0, n, chunk):
+        rows = idx[begin:begin + chunk]
+        cols = rows[:, None] + offsets
+        valid = cols > lo[begin:begin + chunk, None]
+        window = np.where(valid, gaps[np.clip(cols, 0, None)], 0.0)
+        count = valid.sum(axis=1)
+        mean = window.sum(axis=1) / np.maximum(count, 1)
+        m2 = (np.where(valid, window - mean[:, None], 0.0) ** 2).sum(axis=1)
+        variance[begin:begin + chunk] = np.where(count >= 2, np.maximum(m2 / np.maximum(count - 1, 1), 0.0), 0.0)
+    variance = np.round(variance, 6)
+
+    # A single logged request reads as {"rpm": 1, "variance": 1.0}
+    first = idx == lo
+    variance[first] = 1.0
+    return rpm, variance
+
+
+def score_rows(rpm, variance, signature, thresholds):
+    # Vectorized calculate_risk_score(): (current risk, reason code) per row
+    is_bot_speed = (variance < thresholds.bot_variance) & (rpm > thresholds.bot_min_rpm)
+    score = np.zeros(len(rpm), dtype=np.int64)
+    reason = np.zeros(len(rpm), dtype=np.int64)
+
+    assigned = rpm >= thresholds.flood_rpm
+    score[assigned] = 100
+    reason[assigned] = REASON_INDEX["VOLUMETRIC_FLOOD"]
+    for min_rpm, bot_score, human_score in thresholds.rpm_tiers:
+        tier = (rpm >= min_rpm) & ~assigned
+        score[tier] = np.where(is_bot_speed[tier], bot_score, human_score)
+        assigned |= tier
+
+    hit = signature > 0
+    score[hit] = 100
+    reason[hit] = signature[hit]
+    return score, reason
+
+
+class Replay:
+    def __init__(self, log, thresholds):
+        self.log = log
+        self.thresholds = thresholds
+        thresholds.apply_to_live()
+
+    def _signature_codes(self):
+        # Signature scan once per distinct query string, normalised the way the
+        # middleware sees it (str(QueryParams(...))), and once per distinct
+        # header set; the query takes precedence, as in calculate_risk_score()
+        query_codes = np.zeros(len(self.log.queries), dtype=np.int64)
+        for query, code in self.log.queries.items():
+            category = flowlock.scan_signatures(str(QueryParams(query)))
+            if category:
+                query_codes[code] = reason_code(category)
+        header_codes = np.zeros(len(self.log.header_sets), dtype=np.int64)
+        for headers, code in self.log.header_sets.items():
+            category = flowlock.scan_headers(flowlock.signature_engine, raw_headers(headers), flowlock.HEADER_SCAN_SKIP)
+            if category:
+                header_codes[code] = reason_code(category)
+        by_query = query_codes[np.asarray(self.log.query, dtype=np.int64)]
+        by_headers = header_codes[np.asarray(self.log.headers, dtype=np.int64)]
+        return np.where(by_query > 0, by_query, by_headers)
+
+    def _prefix_rules(self):
+        # Static allow/deny rule per distinct client: 0 none, 1 allow, 2 deny
+        codes = np.zeros(len(self.log.ips), dtype=np.int8)
+        for ip, code in self.log.ips.items():
+            rule = flowlock.prefix_policy.lookup(ip, 0.0)
+            if rule is not None and rule.kind in (prefix_blocks.ALLOW, prefix_blocks.DENY):
+                codes[code] = 1 if rule.kind == prefix_blocks.ALLOW else 2
+        return codes
+
+    def _first_idle_sweep(self, last_seen):
+        # First sweeper tick that finds a record last seen at `last_seen` idle
+        ttl = self.thresholds.idle_ttl
+        interval = self.thresholds.sweep_interval
+        tick = np.ceil((last_seen + ttl) / interval) * interval
+        return np.where(last_seen > tick - ttl, tick + interval, tick)
+
+    def _evicted(self, last_seen, blocked_until, now):
+        # Did the sweeper drop this record before `now`? Blocked records are
+        # revisited one TTL later instead of being dropped.
+        ttl = self.thresholds.idle_ttl
+        interval = self.thresholds.sweep_interval
+        while True:
+            tick = math.ceil((last_seen + ttl) / interval) * interval
+            if last_seen > tick - ttl:
+                tick += interval
+            if tick > now:
+                return False
+            if blocked_until <= tick:
+                return True
+            last_seen = tick
+
+    def run(self):
+        log = self.log
+        th = self.thresholds
+        started = time.perf_counter()
+
+        ts = np.asarray(log.ts, dtype=np.float64)
+        ips = np.asarray(log.ip, dtype=np.int64)
+        fingerprints = np.asarray(log.fingerprint, dtype=np.int64)
+        kinds = np.asarray(log.kind, dtype=np.int8)
+        signatures = self._signature_codes()
+        n = len(ts)
+
+        # Arrival order (stable, so ties keep their order in the file)
+        order = np.argsort(ts, kind="stable")
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n)
+
+        verdict = np.full(n, ALLOW, dtype=np.int8)
+        risk = np.zeros(n, dtype=np.int64)
+        reason = np.zeros(n, dtype=np.int64)
+        verdict[kinds == BYPASSED] = BYPASS
+        verdict[kinds == HONEYPOT_PATH] = HONEYPOT
+
+        # --- LAYER 0a: allow/deny-listed networks skip everything else ---
+        prefix_rule = self._prefix_rules()[ips]
+        listed = (kinds == SCORED) & (prefix_rule > 0)
+        verdict[listed & (prefix_rule == 2)] = PREFIX
+
+        # --- LAYER 0: fingerprints blacklisted by an earlier honeypot hit ---
+        honeypot_rows = np.flatnonzero(kinds == HONEYPOT_PATH)
+        blacklisted_at = np.full(len(log.fingerprints), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(blacklisted_at, fingerprints[honeypot_rows], rank[honeypot_rows])
+        fingerprint_blocked = (kinds == SCORED) & ~listed & (rank > blacklisted_at[fingerprints])
+        verdict[fingerprint_blocked] = FINGERPRINT
+
+        # --- Every other scored request, grouped by client in arrival order ---
+        rows = np.flatnonzero((kinds == SCORED) & ~listed & ~fingerprint_blocked)
+        rows = rows[np.lexsort((rank[rows], ips[rows]))]
+        client = ips[rows]
+        t = ts[rows]
+        count = len(rows)
+        position = np.arange(count)
+        first = np.ones(count, dtype=bool)
+        first[1:] = client[1:] != client[:-1]
+
+        # Optimistic pass: assume nobody is ever blocked. A client that was
+        # never blocked loses its whole record when the sweeper finds it idle,
+        # so each idle gap simply starts a new session with a clean history.
+        session = first.copy()
+        if count > 1:
+            session[1:] |= self._first_idle_sweep(t[:-1]) <= t[1:]
+        start = np.maximum.accumulate(np.where(session, position, 0)) if count else position
+        rpm, variance = window_features(t, start)
+        current, current_reason = score_rows(rpm, variance, signatures[rows], th)
+        # Running max of risk per session (offset trick keeps sessions apart)
+        group = np.cumsum(session) - 1
+        running = np.maximum.accumulate(current + group * 1000) - group * 1000
+
+        # Clients whose optimistic timeline is exact: never blocked and no
+        # honeypot hit
+        dirty = np.zeros(len(log.ips), dtype=bool)
+        dirty[client[running >= th.block_risk]] = True
+        dirty[ips[honeypot_rows]] = True
+
+        clean = ~dirty[client]
+        clean_rows = rows[clean]
+        risk[clean_rows] = running[clean]
+        reason[clean_rows] = current_reason[clean]
+        verdict[clean_rows] = np.where(running[clean] >= th.tarpit_risk, TARPIT, ALLOW)
+
+        # Sequential fallback, one client at a time
+        honeypots_by_ip = {}
+        for row in honeypot_rows[np.argsort(rank[honeypot_rows], kind="stable")]:
+            honeypots_by_ip.setdefault(int(ips[row]), []).append(int(row))
+        bounds = np.flatnonzero(first).tolist() + [count]
+        group_of_ip = {int(client[bounds[i]]): (bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)}
+        block_events = []
+        for ip in np.flatnonzero(dirty).tolist():
+            lo, hi = group_of_ip.get(ip, (0, 0))
+            self._replay_client(rows[lo:hi], honeypots_by_ip.get(ip, []), ts, rank, signatures,
+                                verdict, risk, reason, block_events)
+
+        self.ts, self.ips, self.verdict, self.risk, self.reason = ts, ips, verdict, risk, reason
+        self.order = order
+        self.block_events = block_events
+        self.elapsed = time.perf_counter() - started
+        return self
+
+    def _replay_client(self, rows, honeypots, ts, rank, signatures, verdict, risk, reason, block_events):
+        # Sequential replay with the live sensor (ClientRecord) and scoring
+        # function, for clients whose blocks decide which requests get logged
+        th = self.thresholds
+        timeline = sorted([(int(rank[row]), row, False) for row in rows.tolist()]
+                          + [(int(rank[row]), row, True) for row in honeypots])
+        record = None
+        for _, row, is_honeypot in timeline:
+            now = float(ts[row])
+            if record is not None and self._evicted(record.last_seen, record.blocked_until, now):
+                record = None
+            if record is None:
+                record = ClientRecord()
+            record.last_seen = now
+
+            if is_honeypot:
+                record.block(now + th.honeypot_seconds, "HONEYPOT_BREACH", honeypot=True)
+                block_events.append((now, "HONEYPOT_BREACH"))
+                continue
+
+            # --- LAYER 1: already blocked (not logged) ---
+            if record.blocked:
+                if record.blocked_until > now:
+                    verdict[row] = BLOCKED
+                    continue
+                record.unblock()
+
+            record.append(now)
+            signature = int(signatures[row])
+            if signature:
+                current, code = 100, signature
+            else:
+                features = record.snapshot(now)
+                current, why = flowlock.behavioral_score(features["rpm"], features["variance"])
+                code = reason_code(why)
+            risk_score = max(current, record.highest_risk)
+            record.highest_risk = risk_score
+            risk[row] = risk_score
+            reason[row] = code
+            if risk_score >= th.block_risk:
+                record.block(now + th.block_seconds, REASONS[code])
+                verdict[row] = BLOCK
+                block_events.append((now, REASONS[code]))
+            else:
+                verdict[row] = TARPIT if risk_score >= th.tarpit_risk else ALLOW
+
+    def summary(self):
+        verdict_counts = np.bincount(self.verdict, minlength=len(VERDICTS))
+        blocks_by_reason = {}
+        for _, block_reason in self.block_events:
+            blocks_by_reason[block_reason] = blocks_by_reason.get(block_reason, 0) + 1
+        denied = np.isin(self.verdict, (BLOCK, BLOCKED, FINGERPRINT, PREFIX))
+        blocked_clients = np.unique(self.ips[(self.verdict == BLOCK) | (self.verdict == HONEYPOT)])
+        records = len(self.ts)
+        return {
+            "records": records,
+            "clients": len(self.log.ips),
+            "elapsed_s": round(self.elapsed, 3),
+            "records_per_s": round(records / self.elapsed, 1) if self.elapsed else 0.0,
+            "verdicts": {name: int(verdict_counts[code]) for code, name in enumerate(VERDICTS)},
+            "block_events": len(self.block_events),
+            "blocks_by_reason": blocks_by_reason,
+            "blocked_clients": int(len(blocked_clients)),
+            "denied_requests": int(denied.sum()),
+            "blacklisted_fingerprints": int(len(np.unique(
+                np.asarray(self.log.fingerprint)[self.verdict == HONEYPOT]))) if records else 0,
+            "thresholds": self.thresholds.as_dict(),
+        }
+
+    def write_timelines(self, path):
+        # One line per client: runs of identical (verdict, risk) in arrival order,
+        # each [first_ts, last_ts, verdict, risk, count, block_reason]
+        names = {code: ip for ip, code in self.log.ips.items()}
+        by_client = self.order[np.argsort(self.ips[self.order], kind="stable")]
+        bounds = np.flatnonzero(np.diff(self.ips[by_client])) + 1
+        with open(path, "w") as f:
+            for rows in np.split(by_client, bounds):
+                if not len(rows):
+                    continue
+                timeline = []
+                for row in rows.tolist():
+                    if self.verdict[row] == BYPASS:
+                        continue
+                    entry = (int(self.verdict[row]), int(self.risk[row]))
+                    if timeline and timeline[-1][0] == entry:
+                        timeline[-1][1][1] = float(self.ts[row])
+                        timeline[-1][1][4] += 1
+                    else:
+                        reason_name = REASONS[self.reason[row]] if self.verdict[row] == BLOCK else None
+                        timeline.append((entry, [float(self.ts[row]), float(self.ts[row]),
+                                                 VERDICTS[entry[0]], entry[1], 1, reason_name]))
+                if timeline:
+                    f.write(json.dumps({
+                        "ip": names[int(self.ips[rows[0]])],
+                        "requests": len(rows),
+                        "timeline": [run for _, run in timeline],
+                    }) + "\n")
+
+
+async def check_live(replay):
+    # Replays the same log through the real inspect_request() on a fresh
+    # in-memory store (recorded timestamps, tarpit disabled, sweeper ticks
+    # simulated) and counts requests whose (status, risk) differ.
+    backend = flowlock.state_backend
+    if not hasattr(backend, "store") or not hasattr(backend.store, "entries"):
+        raise SystemExit("--check needs the in-memory state backend")
+    flowlock.tarpit.min_delay = flowlock.tarpit.max_delay = 0
+    # Only the static allow/deny lists are modeled offline, every client
+    # gets an exact record (the default; see the warning in __main__) and
+    # every route the static thresholds
+    flowlock.prefix_policy.promote_after = flowlock.prefix_policy.prefix_rpm = 0
+    flowlock.heavy_hitters.ip_threshold = 0
+    flowlock.adaptive_thresholds.enabled = False
+    store = backend.store
+    log = replay.log
+    fingerprint_names = {code: fp for fp, code in log.fingerprints.items()}
+    ip_names = {code: ip for ip, code in log.ips.items()}
+    query_names = {code: query for query, code in log.queries.items()}
+    header_names = {code: raw_headers(headers) for headers, code in log.header_sets.items()}
+    interval = replay.thresholds.sweep_interval
+    next_sweep = None
+    mismatches = []
+    checked = 0
+
+    for row in replay.order.tolist():
+        now = log.ts[row]
+        if next_sweep is None:
+            next_sweep = math.ceil(now / interval) * interval
+        while next_sweep <= now:
+            store.sweep(next_sweep)
+            next_sweep += interval
+
+        ip = ip_names[log.ip[row]]
+        fingerprint = fingerprint_names[log.fingerprint[row]]
+        if log.kind[row] == HONEYPOT_PATH:
+            await backend.block_ip(ip, now + flowlock.HONEYPOT_BLOCK_SECONDS, "HONEYPOT_BREACH", now, honeypot=True)
+            await backend.block_fingerprint(fingerprint)
+            continue
+        if log.kind[row] == BYPASSED:
+            continue
+
+        query = str(QueryParams(query_names[log.query[row]]))
+        headers = header_names[log.headers[row]]
+        denial, risk_score = await flowlock.inspect_request(ip, fingerprint, query, headers, now=now)
+        live = (denial.status_code if denial is not None else 200, risk_score)
+        code = replay.verdict[row]
+        if code in (BLOCKED, FINGERPRINT, PREFIX):
+            expected = (403, None)
+        else:
+            expected = (403 if code == BLOCK else 200, int(replay.risk[row]))
+        checked += 1
+        if live != expected:
+            mismatches.append({"ip": ip, "ts": now, "live": list(live), "replay": list(expected)})
+    return {"checked": checked, "mismatches": len(mismatches), "examples": mismatches[:10]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FlowLock offline traffic replay")
+    parser.add_argument("log", help="JSONL request log")
+    parser.add_argument("--timelines", help="write per-client verdict timelines (JSONL) here")
+    parser.add_argument("--flood-rpm", type=int, help=f"default {flowlock.FLOOD_RPM}")
+    parser.add_argument("--rpm-tiers", type=parse_tiers, help="min_rpm:bot_score:human_score,... (default from api_abuse_detection)")
+    parser.add_argument("--bot-variance", type=float, help=f"default {flowlock.BOT_VARIANCE}")
+    parser.add_argument("--bot-min-rpm", type=int, help=f"default {flowlock.BOT_MIN_RPM}")
+    parser.add_argument("--check", action="store_true", help="also replay through inspect_request() and compare")
+    args = parser.parse_args()
+
+    if flowlock.policy_engine.policy_path:
+        raise SystemExit("replay models the built-in scoring policy; unset FLOWLOCK_POLICY to replay")
+    if flowlock.heavy_hitters.enabled:
+        print("replay: FLOWLOCK_HEAVY_HITTER_RPM is ignored; every client is tracked from its first "
+              "request, so live blocks can come later than replayed ones", file=sys.stderr)
+    thresholds = Thresholds(args.flood_rpm, args.rpm_tiers, args.bot_variance, args.bot_min_rpm)
+    loading = time.perf_counter()
+    replay = Replay(RequestLog.load(args.log), thresholds).run()
+    report = replay.summary()
+    report["load_s"] = round(time.perf_counter() - loading - replay.elapsed, 3)
+
+    if args.timelines:
+        replay.write_timelines(args.timelines)
+    if args.check:
+        # Keep the middleware's console logging out of the JSON output
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            report["check"] = asyncio.run(check_live(replay))
+
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if report.get("check", {}).get("mismatches") else 0)
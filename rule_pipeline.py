@@ -0,0 +1,333 @@
+import json
+from time import perf_counter_ns
+
+try:
+    import yaml
+except ImportError:  # YAML policies need PyYAML; JSON always works
+    yaml = None
+
+from hot_reload import WatchedFile
+
+# Declarative risk scoring. A policy is an ordered list of rules:
+#
+#   {"name": "flood", "when": {"rpm": {">=": "$flood_rpm"}}, "score": 100,
+#    "action": "block", "reason": "VOLUMETRIC_FLOOD"}
+#
+# The first rule whose conditions all hold decides the request. Rules are
+# compiled into tuples of predicates, each rule's conditions sorted cheapest
+# first, and facts that cost real work (the signature scan, the behavioral
+# score) are computed at most once per request, and only if a rule asks.
+#
+# Conditions ("when", all must hold):
+#   route, fingerprint        string, list of strings or {"prefix": "..."}
+#   honeypot                  true / false
+#   signature                 true (any category), false, or a list of categories
+#   rpm, variance, history,   {"<op>": value, ...} with ops > >= < <= == !=;
+#   risk                      a value is a number or "$flood_rpm" /
+#                             "$bot_variance" / "$bot_min_rpm" (the route's
+#                             current thresholds)
+# "score" is 0-100 or "behavior" (the RPM tier / bot-speed scorer).
+# "action": "score" (default: the risk thresholds decide), "block", "tarpit"
+# or "allow" (never tarpitted or blocked by this request).
+# "reason" defaults to the signature category, then the behavior reason,
+# then the rule name.
+#
+# The policy scores requests that reach LAYER 2 of inspect_request: blocked
+# clients and light clients passed by the heavy-hitter front line never get
+# this far.
+
+SCORE = "score"
+BLOCK = "block"
+TARPIT = "tarpit"
+ALLOW = "allow"
+ACTIONS = (SCORE, BLOCK, TARPIT, ALLOW)
+
+# Built-in policy: the original calculate_risk_score layering
+DEFAULT_POLICY = [
+    {"name": "honeypot", "when": {"honeypot": True}, "score": 100, "reason": "HONEYPOT_BREACH"},
+    {"name": "signature", "when": {"signature": True}, "score": 100},
+    {"name": "behavior", "score": "behavior"},
+]
+
+# Relative evaluation cost of each condition
+CHEAP, SCAN = 0, 1
+NUMERIC_FACTS = ("rpm", "variance", "history", "risk")
+LIMIT_NAMES = ("flood_rpm", "bot_variance", "bot_min_rpm")
+COMPARISONS = {
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+}
+
+_UNSET = object()
+
+
+class RequestFacts:
+    # What the rules can look at for one request. The signature scan
+    # (scan(query, headers)) and the behavioral score
+    # (behavior(rpm, variance, limits)) run lazily, at most once.
+    __slots__ = ("route", "fingerprint", "honeypot", "rpm", "variance", "history", "risk",
+                 "limits", "query", "headers", "_scan", "_signature", "_behavior", "_behavior_result")
+
+    def __init__(self, route, fingerprint, honeypot, rpm, variance, history, risk, limits,
+                 query, headers, scan, behavior):
+        self.route = route
+        self.fingerprint = fingerprint
+        self.honeypot = honeypot
+        self.rpm = rpm
+        self.variance = variance
+        self.history = history
+        self.risk = risk
+        self.limits = limits
+        self.query = query
+        self.headers = headers
+        self._scan = scan
+        self._signature = _UNSET
+        self._behavior = behavior
+        self._behavior_result = None
+
+    @property
+    def signature(self):
+        if self._signature is _UNSET:
+            self._signature = self._scan(self.query, self.headers)
+        return self._signature
+
+    @property
+    def behavior(self):
+        # (score, reason)
+        if self._behavior_result is None:
+            self._behavior_result = self._behavior(self.rpm, self.variance, self.limits)
+        return self._behavior_result
+
+
+def _strings(rule, field, value):
+    if isinstance(value, str):
+        return frozenset((value,))
+    if isinstance(value, list) and all(isinstance(item, str) for item in value):
+        return frozenset(value)
+    raise ValueError(f"rule {rule!r}: {field} must be a string or a list of strings")
+
+
+def _compile_match(rule, field, value):
+    # route / fingerprint
+    if isinstance(value, dict):
+        if set(value) != {"prefix"} or not isinstance(value["prefix"], str):
+            raise ValueError(f"rule {rule!r}: {field} takes a string, a list or {{\"prefix\": ...}}")
+        prefix = value["prefix"]
+        return lambda facts: getattr(facts, field).startswith(prefix)
+    allowed = _strings(rule, field, value)
+    return lambda facts: getattr(facts, field) in allowed
+
+
+def _compile_operand(rule, value):
+    # -> (constant, None) or (None, threshold name)
+    if isinstance(value, str) and value.startswith("$"):
+        name = value[1:]
+        if name not in LIMIT_NAMES:
+            raise ValueError(f"rule {rule!r}: unknown threshold {value!r} (known: {', '.join(LIMIT_NAMES)})")
+        return None, name
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"rule {rule!r}: expected a number or a $threshold, got {value!r}")
+    return value, None
+
+
+def _compile_numeric(rule, field, value):
+    if not isinstance(value, dict) or not value:
+        raise ValueError(f"rule {rule!r}: {field} takes {{\"<op>\": value}}")
+    tests = []
+    for op, operand in value.items():
+        compare = COMPARISONS.get(op)
+        if compare is None:
+            raise ValueError(f"rule {rule!r}: unknown comparison {op!r} (known: {' '.join(COMPARISONS)})")
+        constant, name = _compile_operand(rule, operand)
+        if name is None:
+            tests.append(lambda facts, compare=compare, constant=constant: compare(getattr(facts, field), constant))
+        else:
+            tests.append(lambda facts, compare=compare, name=name: compare(getattr(facts, field), getattr(facts.limits, name)))
+    if len(tests) == 1:
+        return tests[0]
+    return lambda facts: all(test(facts) for test in tests)
+
+
+def _compile_signature(rule, value):
+    if value is True:
+        return lambda facts: facts.signature is not None
+    if value is False:
+        return lambda facts: facts.signature is None
+    categories = _strings(rule, "signature", value)
+    return lambda facts: facts.signature in categories
+
+
+def _compile_condition(rule, field, value):
+    # -> (cost, predicate)
+    if field in ("route", "fingerprint"):
+        return CHEAP, _compile_match(rule, field, value)
+    if field == "honeypot":
+        if not isinstance(value, bool):
+            raise ValueError(f"rule {rule!r}: honeypot must be true or false")
+        return CHEAP, (lambda facts: facts.honeypot) if value else (lambda facts: not facts.honeypot)
+    if field in NUMERIC_FACTS:
+        return CHEAP, _compile_numeric(rule, field, value)
+    if field == "signature":
+        return SCAN, _compile_signature(rule, value)
+    raise ValueError(f"rule {rule!r}: unknown condition {field!r}")
+
+
+class CompiledRule:
+    __slots__ = ("name", "tests", "score", "action", "reason", "uses_signature",
+                 "uses_limits", "hits", "evaluations", "total_ns")
+
+    def __init__(self, spec, index):
+        if not isinstance(spec, dict):
+            raise ValueError(f"rule #{index}: expected an object")
+        self.name = str(spec.get("name") or f"rule{index}")
+        unknown = set(spec) - {"name", "when", "score", "action", "reason"}
+        if unknown:
+            raise ValueError(f"rule {self.name!r}: unknown keys {sorted(unknown)}")
+        when = spec.get("when") or {}
+        if not isinstance(when, dict):
+            raise ValueError(f"rule {self.name!r}: 'when' must be an object")
+        conditions = [_compile_condition(self.name, field, value) for field, value in when.items()]
+        # Cheapest first; the sort is stable, so equal costs keep policy order
+        conditions.sort(key=lambda condition: condition[0])
+        self.tests = tuple(test for _, test in conditions)
+        self.uses_signature = "signature" in when
+        self.uses_limits = any(
+            isinstance(operand, str) and operand.startswith("$")
+            for field, value in when.items() if field in NUMERIC_FACTS
+            for operand in value.values()
+        )
+
+        self.score = spec.get("score", 0)
+        if self.score != "behavior" and (isinstance(self.score, bool) or not isinstance(self.score, int) or not 0 <= self.score <= 100):
+            raise ValueError(f"rule {self.name!r}: score must be 0-100 or \"behavior\"")
+        self.action = spec.get("action", SCORE)
+        if self.action not in ACTIONS:
+            raise ValueError(f"rule {self.name!r}: action must be one of {', '.join(ACTIONS)}")
+        self.reason = spec.get("reason")
+        if self.reason is not None and not isinstance(self.reason, str):
+            raise ValueError(f"rule {self.name!r}: reason must be a string")
+        self.hits = 0
+        self.evaluations = 0
+        self.total_ns = 0
+
+    def outcome(self, facts):
+        # (score, reason, action)
+        if self.score == "behavior":
+            score, reason = facts.behavior
+        else:
+            score, reason = self.score, None
+        if self.reason is not None:
+            reason = self.reason
+        elif self.uses_signature and facts.signature is not None:
+            reason = facts.signature
+        elif reason is None:
+            reason = self.name
+        return score, reason, self.action
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "hits": self.hits,
+            "evaluations": self.evaluations,
+            "mean_us": round(self.total_ns / self.evaluations / 1000, 3) if self.evaluations else 0,
+        }
+
+
+class RulePipeline:
+    # An ordered, compiled policy. evaluate() walks the rules in order and
+    # stops at the first match; every rule it evaluates is timed.
+
+    def __init__(self, policy, source="built-in"):
+        if isinstance(policy, dict):
+            policy = policy.get("rules")
+        if not isinstance(policy, list) or not policy:
+            raise ValueError("a policy is a non-empty list of rules (or {\"rules\": [...]})")
+        self.rules = tuple(CompiledRule(spec, index) for index, spec in enumerate(policy))
+        names = [rule.name for rule in self.rules]
+        if len(set(names)) != len(names):
+            raise ValueError("rule names must be unique")
+        self.source = source
+        self.uses_limits = any(rule.uses_limits for rule in self.rules)
+        self.misses = 0
+
+    def evaluate(self, facts):
+        # (score, reason, action, rule name); no match scores 0.
+        # One clock read per rule: each rule is charged from the end of the
+        # previous one.
+        started = perf_counter_ns()
+        for rule in self.rules:
+            rule.evaluations += 1
+            for test in rule.tests:
+                if not test(facts):
+                    break
+            else:
+                outcome = rule.outcome(facts)
+                rule.hits += 1
+                rule.total_ns += perf_counter_ns() - started
+                return (*outcome, rule.name)
+            finished = perf_counter_ns()
+            rule.total_ns += finished - started
+            started = finished
+        self.misses += 1
+        return 0, "NO_RULE", SCORE, None
+
+    def stats(self):
+        return {"source": self.source, "misses": self.misses, "rules": [rule.stats() for rule in self.rules]}
+
+
+def load_policy_file(path):
+    # JSON, or YAML for .yaml / .yml files
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ValueError(f"{path}: YAML policies need PyYAML (pip install pyyaml)")
+            try:
+                return yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(f"{path}: {e}") from e
+        return json.load(f)
+
+
+def build_pipeline(path):
+    return RulePipeline(load_policy_file(path), source=path)
+
+
+class PolicyEngine:
+    # Holds the active pipeline and swaps it atomically on reload, the same
+    # way SignatureEngine handles rule files: a request always runs one
+    # complete pipeline, old or new.
+
+    def __init__(self, policy_path=None, check_interval=2.0, events=None):
+        # `events`: an EventLog for failed reloads, as for SignatureEngine
+        self.policy_path = policy_path
+        self.pipeline = RulePipeline(DEFAULT_POLICY)
+        self.watch = WatchedFile(policy_path, build_pipeline, self._publish, "policy_reload_failed",
+                                 check_interval=check_interval, events=events)
+        if policy_path:
+            self.watch.reload()
+
+    @property
+    def last_error(self):
+        return self.watch.last_error
+
+    def _publish(self, pipeline):
+        self.pipeline = pipeline
+
+    def reload(self):
+        # Compile off to the side, then publish with a single reference swap
+        if not self.policy_path:
+            self.pipeline = RulePipeline(DEFAULT_POLICY)
+            return True
+        return self.watch.reload()
+
+    def maybe_reload(self, now=None):
+        # A rate-limited stat(); a changed policy is compiled in a worker
+        # thread when called from the event loop
+        return self.watch.maybe_reload(now)
+
+    def stats(self):
+        return {"reloads": self.watch.reloads, "last_error": self.last_error, **self.pipeline.stats()}
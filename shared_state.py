@@ -0,0 +1,492 @@
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+from array import array
+from contextlib import contextmanager
+
+from behavior_features import HISTORY_SIZE
+from client_store import ClientRecord, FLAG_BLOCKED
+
+# Multi-worker mode: per-client records and the fingerprint blacklist live in
+# fixed-size hash tables inside memory-mapped files under /dev/shm, so every
+# uvicorn worker reads and writes the same state without any RPC.
+#
+# Each table is split into groups of GROUP_SIZE slots; a key hashes to one
+# group and never leaves it, so a single byte-range lock (striped over
+# LOCK_STRIPES) protects everything about that key.
+
+MAGIC = b"FLK1"
+TABLE_HEADER = struct.Struct("<4sIII")  # magic, groups, group size, slot size
+HEADER_SIZE = 64
+GROUP_SIZE = 16
+LOCK_STRIPES = 1024
+
+# Slot keys: 1 length byte + up to 47 bytes of text (IPv6 text is at most 45)
+KEY_SIZE = 48
+
+# Client slot: key | record header | timestamp ring
+CLIENT_HEADER = struct.Struct("<BxHHHIIidddd32s")
+CLIENT_HEADER_OFFSET = KEY_SIZE
+CLIENT_TS_OFFSET = (KEY_SIZE + CLIENT_HEADER.size + 7) // 8 * 8
+CLIENT_SLOT_SIZE = CLIENT_TS_OFFSET + HISTORY_SIZE * 8
+# Just the fields the sweeper and eviction need: flags, blocked_until, last_seen
+CLIENT_FLAGS = struct.Struct("<B")
+CLIENT_TIMES = struct.Struct("<dd")
+CLIENT_TIMES_OFFSET = CLIENT_HEADER_OFFSET + 20
+
+# Fingerprint slot: key | time it was blacklisted
+FINGERPRINT_SLOT = struct.Struct("<d")
+FINGERPRINT_SLOT_SIZE = KEY_SIZE + FINGERPRINT_SLOT.size
+
+# Byte used as the "one sweeper across all workers" leader lock
+LEADER_LOCK_OFFSET = 2 * LOCK_STRIPES
+
+
+def shared_state_dir():
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def _encode_key(text):
+    raw = text.encode("utf-8")
+    if len(raw) >= KEY_SIZE:
+        # Oversized keys (not real IPs) are stored by digest
+        raw = b"~" + format(zlib.crc32(raw), "08x").encode() + raw[-30:]
+    return bytes([len(raw)]) + raw.ljust(KEY_SIZE - 1, b"\0")
+
+
+def _decode_key(raw):
+    return bytes(raw[1:1 + raw[0]]).decode("utf-8", "replace")
+
+
+class SharedHashTable:
+    # Fixed-size grouped hash table in a memory-mapped file.
+    # Callers hold the group's stripe lock around every access.
+
+    def __init__(self, path, stripe_base=0):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR)
+        size = os.fstat(self.fd).st_size
+        self.buf = mmap.mmap(self.fd, size)
+        magic, self.groups, group_size, self.slot_size = TABLE_HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or group_size != GROUP_SIZE:
+            raise ValueError(f"{path} is not a FlowLock shared table")
+        self.stripe_base = stripe_base
+        self.tags = struct.Struct(f"<{GROUP_SIZE}I")
+        self.tags_offset = HEADER_SIZE
+        self.slots_offset = (HEADER_SIZE + self.groups * GROUP_SIZE * 4 + 7) // 8 * 8
+        self.evictions = 0
+
+    @classmethod
+    def create(cls, path, capacity, slot_size, stripe_base=0):
+        groups = max(1, -(-capacity // GROUP_SIZE))
+        slots_offset = (HEADER_SIZE + groups * GROUP_SIZE * 4 + 7) // 8 * 8
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, slots_offset + groups * GROUP_SIZE * slot_size)
+            os.pwrite(fd, TABLE_HEADER.pack(MAGIC, groups, GROUP_SIZE, slot_size), 0)
+        finally:
+            os.close(fd)
+        return cls(path, stripe_base)
+
+    def close(self):
+        self.buf.close()
+        os.close(self.fd)
+
+    @property
+    def size_bytes(self):
+        return len(self.buf)
+
+    @property
+    def capacity(self):
+        return self.groups * GROUP_SIZE
+
+    # --- Locking ---
+
+    @contextmanager
+    def group_lock(self, group):
+        stripe = self.stripe_base + group % LOCK_STRIPES
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, stripe)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, stripe)
+
+    # --- Slot addressing (lock held) ---
+
+    def place(self, key):
+        # Deterministic across processes (unlike hash()); tag 0 means "empty"
+        group = zlib.crc32(key) % self.groups
+        tag = zlib.crc32(key, 0x9E3779B9) | 1
+        return group, tag
+
+    def slot_offset(self, group, index):
+        return self.slots_offset + (group * GROUP_SIZE + index) * self.slot_size
+
+    def group_tags(self, group):
+        return self.tags.unpack_from(self.buf, self.tags_offset + group * GROUP_SIZE * 4)
+
+    def _set_tag(self, group, index, tag):
+        struct.pack_into("<I", self.buf, self.tags_offset + (group * GROUP_SIZE + index) * 4, tag)
+
+    def lookup(self, group, tag, key):
+        tags = self.group_tags(group)
+        start = 0
+        while True:
+            try:
+                index = tags.index(tag, start)
+            except ValueError:
+                return -1
+            offset = self.slot_offset(group, index)
+            if self.buf[offset:offset + KEY_SIZE] == key:
+                return index
+            start = index + 1
+
+    def insert(self, group, tag, key):
+        tags = self.group_tags(group)
+        try:
+            index = tags.index(0)
+        except ValueError:
+            index = self.victim(group)
+            self.evictions += 1
+            self.evicted(self.slot_offset(group, index))
+        offset = self.slot_offset(group, index)
+        self.buf[offset:offset + self.slot_size] = bytes(self.slot_size)
+        self.buf[offset:offset + KEY_SIZE] = key
+        self._set_tag(group, index, tag)
+        return index
+
+    def remove(self, group, index):
+        self._set_tag(group, index, 0)
+
+    def victim(self, group):
+        # Which slot to overwrite when a group is full (subclasses decide)
+        return 0
+
+    def evicted(self, offset):
+        # Called with the victim's slot just before it is overwritten
+        pass
+
+    def used_slots(self, group):
+        for index, tag in enumerate(self.group_tags(group)):
+            if tag:
+                yield index, self.slot_offset(group, index)
+
+    def __len__(self):
+        tags = array("I")
+        tags.frombytes(self.buf[self.tags_offset:self.tags_offset + self.capacity * 4])
+        return len(tags) - tags.count(0)
+
+
+class SharedClientStore(SharedHashTable):
+    # Drop-in replacement for ClientStateStore backed by shared memory.
+    # Records are copied into a ClientRecord under the group lock, mutated by
+    # the caller and written back before the lock is released.
+
+    def __init__(self, path, idle_ttl=600.0, sweep_groups=256):
+        super().__init__(path, stripe_base=0)
+        self.idle_ttl = idle_ttl
+        self.sweep_groups = sweep_groups
+        self.sweep_cursor = 0
+        self.is_leader = False
+        self.ttl_evictions = 0
+        self.expired_blocks = 0
+        # Clients this worker evicted since its last sweep
+        self.removed = []
+
+    @classmethod
+    def create(cls, path, capacity):
+        SharedHashTable.create(path, capacity, CLIENT_SLOT_SIZE).close()
+        return cls(path)
+
+    @property
+    def max_entries(self):
+        return self.capacity
+
+    # --- (de)serialisation ---
+
+    def _load(self, offset):
+        buf = self.buf
+        (flags, count, head, stale, gap_count, evictions, highest_risk,
+         blocked_until, last_seen, gap_mean, gap_m2, reason) = CLIENT_HEADER.unpack_from(buf, offset + CLIENT_HEADER_OFFSET)
+        record = ClientRecord()
+        ts_offset = offset + CLIENT_TS_OFFSET
+        record.ts.frombytes(buf[ts_offset:ts_offset + count * 8])
+        record.head = head
+        record.stale = stale
+        record.gap_count = gap_count
+        record.evictions = evictions
+        record.gap_mean = gap_mean
+        record.gap_m2 = gap_m2
+        record.highest_risk = highest_risk
+        record.blocked_until = blocked_until
+        record.last_seen = last_seen
+        record.flags = flags
+        record.block_reason = reason.rstrip(b"\0").decode() or None
+        return record
+
+    def _save(self, offset, record):
+        reason = (record.block_reason or "").encode()[:32]
+        CLIENT_HEADER.pack_into(
+            self.buf, offset + CLIENT_HEADER_OFFSET,
+            record.flags, len(record.ts), record.head, record.stale, record.gap_count,
+            record.evictions, int(record.highest_risk), record.blocked_until, record.last_seen,
+            record.gap_mean, record.gap_m2, reason,
+        )
+        ts_offset = offset + CLIENT_TS_OFFSET
+        self.buf[ts_offset:ts_offset + len(record.ts) * 8] = record.ts.tobytes()
+
+    def _times(self, offset):
+        # (blocked_until, last_seen) without deserialising the whole record
+        return CLIENT_TIMES.unpack_from(self.buf, offset + CLIENT_TIMES_OFFSET)
+
+    def _flags(self, offset):
+        return self.buf[offset + CLIENT_HEADER_OFFSET]
+
+    def victim(self, group):
+        # Least recently seen client that is not blocked (any client if all are)
+        now = time.time()
+        best, best_seen = 0, float("inf")
+        best_blocked, best_blocked_seen = 0, float("inf")
+        for index, offset in self.used_slots(group):
+            blocked_until, last_seen = self._times(offset)
+            if blocked_until > now:
+                if last_seen < best_blocked_seen:
+                    best_blocked, best_blocked_seen = index, last_seen
+            elif last_seen < best_seen:
+                best, best_seen = index, last_seen
+        return best if best_seen != float("inf") else best_blocked
+
+    def evicted(self, offset):
+        if len(self.removed) < self.capacity:
+            self.removed.append(_decode_key(self.buf[offset:offset + KEY_SIZE]))
+
+    # --- ClientStateStore interface ---
+
+    def __contains__(self, ip):
+        key = _encode_key(ip)
+        group, tag = self.place(key)
+        with self.group_lock(group):
+            return self.lookup(group, tag, key) >= 0
+
+    def get(self, ip):
+        # Returns a detached copy; use locked() to modify
+        key = _encode_key(ip)
+        group, tag = self.place(key)
+        with self.group_lock(group):
+            index = self.lookup(group, tag, key)
+            if index < 0:
+                return None
+            return self._load(self.slot_offset(group, index))
+
+    @contextmanager
+    def locked(self, ip, now):
+        key = _encode_key(ip)
+        group, tag = self.place(key)
+        with self.group_lock(group):
+            index = self.lookup(group, tag, key)
+            if index < 0:
+                index = self.insert(group, tag, key)
+                record = ClientRecord()
+            else:
+                record = self._load(self.slot_offset(group, index))
+            record.last_seen = now
+            try:
+                yield record
+            finally:
+                self._save(self.slot_offset(group, index), record)
+
+    def block(self, ip, until, reason, now, honeypot=False):
+        with self.locked(ip, now) as state:
+            state.block(until, reason, honeypot)
+        return state
+
+    def unblock(self, ip):
+        with self.locked(ip, time.time()) as state:
+            state.unblock()
+
+    def _scan(self, blocked_only=False):
+        for group in range(self.groups):
+            with self.group_lock(group):
+                for index, offset in self.used_slots(group):
+                    if blocked_only and not self._flags(offset) & FLAG_BLOCKED:
+                        continue
+                    yield _decode_key(self.buf[offset:offset + KEY_SIZE]), self._load(offset)
+
+    def restore(self, records):
+        # Warm start: writes the (ip, record) pairs loaded from a snapshot as
+        # is. Returns the number of records restored.
+        restored = 0
+        for ip, record in records:
+            key = _encode_key(ip)
+            group, tag = self.place(key)
+            with self.group_lock(group):
+                index = self.lookup(group, tag, key)
+                if index < 0:
+                    index = self.insert(group, tag, key)
+                self._save(self.slot_offset(group, index), record)
+            restored += 1
+        return restored
+
+    def chunks(self, size):
+        # Snapshot walk: whole groups of about `size` records, never yielding
+        # while a group lock is held
+        chunk = []
+        for group in range(self.groups):
+            with self.group_lock(group):
+                for index, offset in self.used_slots(group):
+                    chunk.append((_decode_key(self.buf[offset:offset + KEY_SIZE]), self._load(offset)))
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def items(self):
+        return list(self._scan())
+
+    def blocked_items(self):
+        return list(self._scan(blocked_only=True))
+
+    def blocked_count(self):
+        count = 0
+        for group in range(self.groups):
+            for index, offset in self.used_slots(group):
+                if self._flags(offset) & FLAG_BLOCKED:
+                    count += 1
+        return count
+
+    def _claim_leadership(self):
+        # Only one worker sweeps; if it dies the OS drops its lock and the
+        # next worker to try takes over.
+        if not self.is_leader:
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, LEADER_LOCK_OFFSET)
+                self.is_leader = True
+            except OSError:
+                pass
+        return self.is_leader
+
+    def sweep(self, now=None):
+        # Incremental: `sweep_groups` groups per call, so one sweep never
+        # holds the event loop for a full pass over the table.
+        # Returns (IPs whose block was lifted, IPs evicted since the last
+        # sweep); every worker reports its own LRU evictions.
+        removed, self.removed = self.removed, []
+        if not self._claim_leadership():
+            return [], removed
+        if now is None:
+            now = time.time()
+        cutoff = now - self.idle_ttl
+        expired = []
+        for _ in range(min(self.sweep_groups, self.groups)):
+            group = self.sweep_cursor
+            self.sweep_cursor = (group + 1) % self.groups
+            with self.group_lock(group):
+                for index, offset in list(self.used_slots(group)):
+                    blocked_until, last_seen = self._times(offset)
+                    if self._flags(offset) & FLAG_BLOCKED:
+                        if blocked_until <= now:
+                            record = self._load(offset)
+                            record.unblock()
+                            self._save(offset, record)
+                            self.expired_blocks += 1
+                            expired.append(_decode_key(self.buf[offset:offset + KEY_SIZE]))
+                    elif last_seen <= cutoff:
+                        removed.append(_decode_key(self.buf[offset:offset + KEY_SIZE]))
+                        self.remove(group, index)
+                        self.ttl_evictions += 1
+        return expired, removed
+
+    def stats(self):
+        return {
+            "entries": len(self),
+            "max_entries": self.capacity,
+            "blocked": self.blocked_count(),
+            "lru_evictions": self.evictions,
+            "ttl_evictions": self.ttl_evictions,
+            "expired_blocks": self.expired_blocks,
+            "approx_bytes": self.size_bytes,
+            "shared": True,
+        }
+
+
+class SharedFingerprintSet(SharedHashTable):
+    # Set-like blacklist of device fingerprints shared by all workers
+
+    def __init__(self, path):
+        super().__init__(path, stripe_base=LOCK_STRIPES)
+
+    @classmethod
+    def create(cls, path, capacity):
+        SharedHashTable.create(path, capacity, FINGERPRINT_SLOT_SIZE, stripe_base=LOCK_STRIPES).close()
+        return cls(path)
+
+    def victim(self, group):
+        # Oldest blacklisting makes room for the newest
+        oldest, oldest_at = 0, float("inf")
+        for index, offset in self.used_slots(group):
+            (added_at,) = FINGERPRINT_SLOT.unpack_from(self.buf, offset + KEY_SIZE)
+            if added_at < oldest_at:
+                oldest, oldest_at = index, added_at
+        return oldest
+
+    def __contains__(self, fingerprint):
+        key = _encode_key(fingerprint)
+        group, tag = self.place(key)
+        with self.group_lock(group):
+            return self.lookup(group, tag, key) >= 0
+
+    def add(self, fingerprint):
+        key = _encode_key(fingerprint)
+        group, tag = self.place(key)
+        with self.group_lock(group):
+            if self.lookup(group, tag, key) < 0:
+                index = self.insert(group, tag, key)
+                FINGERPRINT_SLOT.pack_into(self.buf, self.slot_offset(group, index) + KEY_SIZE, time.time())
+
+    def __iter__(self):
+        for group in range(self.groups):
+            with self.group_lock(group):
+                keys = [_decode_key(self.buf[offset:offset + KEY_SIZE]) for _, offset in self.used_slots(group)]
+            yield from keys
+
+
+class SharedState:
+    # The pair of tables one FlowLock deployment shares across its workers.
+    # The parent process creates them, workers attach via FLOWLOCK_SHARED_STATE.
+
+    def __init__(self, prefix, clients, fingerprints):
+        self.prefix = prefix
+        self.clients = clients
+        self.fingerprints = fingerprints
+
+    @staticmethod
+    def paths(prefix):
+        base = os.path.join(shared_state_dir(), prefix)
+        return base + ".clients", base + ".fingerprints"
+
+    @classmethod
+    def create(cls, client_capacity=65536, fingerprint_capacity=16384, prefix=None):
+        prefix = prefix or f"flowlock-{os.getpid()}"
+        clients_path, fingerprints_path = cls.paths(prefix)
+        clients = SharedClientStore.create(clients_path, client_capacity)
+        fingerprints = SharedFingerprintSet.create(fingerprints_path, fingerprint_capacity)
+        return cls(prefix, clients, fingerprints)
+
+    @classmethod
+    def attach(cls, prefix, idle_ttl=600.0):
+        clients_path, fingerprints_path = cls.paths(prefix)
+        clients = SharedClientStore(clients_path, idle_ttl=idle_ttl)
+        return cls(prefix, clients, SharedFingerprintSet(fingerprints_path))
+
+    def destroy(self):
+        for table in (self.clients, self.fingerprints):
+            table.close()
+            try:
+                os.unlink(table.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,142 @@
+import json
+from collections import deque
+
+from hot_reload import WatchedFile
+
+# Built-in rules, in precedence order (first category wins, same as the
+# original hardcoded checks in calculate_risk_score)
+DEFAULT_SIGNATURES = {
+    # A. JAILBREAK (LLM / Code Injection)
+    "JAILBREAK_ATTEMPT": ["__import__", "subprocess", "eval(", "system_override", "ignore instructions"],
+    # B. SQL INJECTION (Database Attacks)
+    "SQL_INJECTION_DETECTED": ["' or '1'='1", "union select", "drop table", "--", "1=1", "admin'--"],
+    # C. PATH TRAVERSAL (System File Access)
+    "PATH_TRAVERSAL_ATTEMPT": ["../", "..\\", "/etc/passwd", "c:\\windows", "boot.ini"],
+}
+
+NO_MATCH = 1 << 30
+
+
+class SignatureAutomaton:
+    # Aho-Corasick automaton over every signature of every category.
+    # Each state stores the best (lowest) category rank reachable through its
+    # output links, so a scan is a single linear pass over the payload.
+    __slots__ = ("categories", "goto", "fail", "best", "pattern_count")
+
+    def __init__(self, signatures):
+        self.categories = list(signatures.keys())
+        self.goto = [{}]
+        self.fail = [0]
+        self.best = [NO_MATCH]
+        self.pattern_count = 0
+
+        for rank, category in enumerate(self.categories):
+            for pattern in signatures[category]:
+                pattern = pattern.lower()
+                if pattern:
+                    self._insert(pattern, rank)
+        self._link()
+
+    def _insert(self, pattern, rank):
+        state = 0
+        for ch in pattern:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.best.append(NO_MATCH)
+            state = nxt
+        self.best[state] = min(self.best[state], rank)
+        self.pattern_count += 1
+
+    def _link(self):
+        # Breadth-first pass: fail links + folding outputs along the fail chain
+        goto, fail, best = self.goto, self.fail, self.best
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                if state:
+                    f = fail[state]
+                    while f and ch not in goto[f]:
+                        f = fail[f]
+                    fail[nxt] = goto[f].get(ch, 0)
+                best[nxt] = min(best[nxt], best[fail[nxt]])
+
+    def step(self, state, text):
+        # Advance from `state` over `text`; returns (state, best_rank).
+        # Exposed separately so streaming callers can carry state across chunks.
+        goto, fail, best = self.goto, self.fail, self.best
+        found = NO_MATCH
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            rank = best[state]
+            if rank < found:
+                found = rank
+                if found == 0:
+                    break
+        return state, found
+
+    def scan(self, text):
+        # Returns the highest-precedence matching category, or None
+        _, rank = self.step(0, text)
+        if rank == NO_MATCH:
+            return None
+        return self.categories[rank]
+
+
+def load_rule_file(path):
+    # Rule files are JSON objects: {"CATEGORY_REASON": ["sig", ...], ...}
+    # Key order defines precedence.
+    with open(path, "r", encoding="utf-8") as f:
+        rules = json.load(f)
+    if not isinstance(rules, dict):
+        raise ValueError(f"{path}: expected an object of category -> signature list")
+    return {str(category): [str(sig) for sig in sigs] for category, sigs in rules.items()}
+
+
+def build_automaton(path):
+    return SignatureAutomaton(load_rule_file(path))
+
+
+class SignatureEngine:
+    # Holds the active automaton and swaps it atomically on reload.
+    # Requests always see either the old or the new automaton, never a mix.
+
+    def __init__(self, rule_path=None, check_interval=2.0, events=None):
+        # `events`: an EventLog; failed reloads are emitted there (reload
+        # runs on the request path, so never print)
+        self.rule_path = rule_path
+        self.automaton = SignatureAutomaton(DEFAULT_SIGNATURES)
+        self.watch = WatchedFile(rule_path, build_automaton, self._publish, "signature_reload_failed",
+                                 check_interval=check_interval, events=events)
+        if rule_path:
+            self.watch.reload()
+
+    @property
+    def last_error(self):
+        return self.watch.last_error
+
+    def _publish(self, automaton):
+        self.automaton = automaton
+
+    def reload(self):
+        # Build off to the side, then publish with a single reference swap
+        if not self.rule_path:
+            self.automaton = SignatureAutomaton(DEFAULT_SIGNATURES)
+            return True
+        return self.watch.reload()
+
+    def maybe_reload(self, now=None):
+        # Cheap hot-reload hook: a rate-limited stat(); a changed file is
+        # rebuilt in a worker thread when called from the event loop
+        return self.watch.maybe_reload(now)
+
+    def scan(self, text):
+        self.maybe_reload()
+        return self.automaton.scan(text)
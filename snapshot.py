@@ -0,0 +1,404 @@
+import asyncio
+import gc
+import glob
+import mmap
+import os
+import struct
+import time
+from array import array
+
+from client_store import REASON_CODES, ClientRecord, intern_reason
+
+# Warm restart for the in-process state (blocks, blacklisted fingerprints,
+# per-client history). Two files per deployment:
+#
+#   <path>                  binary snapshot of every client record and fingerprint
+#   <path>.journal.<gen>    append-only log of blocks, unblocks, fingerprints and
+#                           risk raises since the snapshot that started generation <gen>
+#
+# A snapshot is written incrementally: the store is walked in chunks on the
+# event loop (a chunk is packed in one go, so every record is self-consistent)
+# and the bytes go to disk from a worker thread. Changes made while the walk
+# runs land in the journal generation opened when it started, and replaying
+# them is idempotent, so snapshot + newer journals always rebuild the state.
+# Once the new snapshot replaces the old one, older journals are deleted
+# (compaction).
+
+MAGIC = b"FLOWLOCK"
+VERSION = 1
+# magic, version, created_at, journal generation, clients, fingerprints,
+# offset of the fingerprint section, offset of the reason table
+HEADER = struct.Struct("<8sHdIQQQQ")
+# ip length, flags, timestamp count, gap count, highest risk, reason code,
+# blocked_until, last_seen, gap mean, gap m2; then the ip and the timestamps
+CLIENT = struct.Struct("<BBBBHHdddd")
+# Journal entry: kind, flags, value (block expiry or risk), key length, reason length
+ENTRY = struct.Struct("<BBdHH")
+LENGTH = struct.Struct("<H")
+
+ENTRY_BLOCK = 1
+ENTRY_FINGERPRINT = 2
+ENTRY_RISK = 3
+ENTRY_UNBLOCK = 4
+
+# Records packed per event-loop slice while snapshotting
+CHUNK_SIZE = 2048
+
+
+def _read_strings(buf, offset, count):
+    strings = []
+    for _ in range(count):
+        (length,) = LENGTH.unpack_from(buf, offset)
+        offset += LENGTH.size
+        strings.append(buf[offset:offset + length].decode())
+        offset += length
+    return strings, offset
+
+
+def _pack_string(value):
+    encoded = value.encode()
+    return LENGTH.pack(len(encoded)) + encoded
+
+
+class StateJournal:
+    # Buffered append-only log; the request path only appends bytes to a list
+
+    def __init__(self, path, generation=0):
+        self.path = path
+        self.generation = generation
+        self.pending = []
+        self.entries = 0
+        self.write_errors = 0
+
+    def file(self, generation):
+        return f"{self.path}.journal.{generation}"
+
+    def block(self, ip, until, reason, honeypot=False):
+        key, reason = ip.encode(), (reason or "").encode()
+        self.pending.append(ENTRY.pack(ENTRY_BLOCK, 1 if honeypot else 0, until, len(key), len(reason)) + key + reason)
+
+    def fingerprint(self, fingerprint):
+        key = fingerprint.encode()
+        self.pending.append(ENTRY.pack(ENTRY_FINGERPRINT, 0, 0.0, len(key), 0) + key)
+
+    def risk(self, ip, risk):
+        key = ip.encode()
+        self.pending.append(ENTRY.pack(ENTRY_RISK, 0, risk, len(key), 0) + key)
+
+    def unblock(self, ip):
+        # Lifting a block also resets the client's risk
+        key = ip.encode()
+        self.pending.append(ENTRY.pack(ENTRY_UNBLOCK, 0, 0.0, len(key), 0) + key)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        data, self.pending = b"".join(self.pending), []
+        try:
+            await asyncio.to_thread(self._append, self.file(self.generation), data)
+        except OSError:
+            self.write_errors += 1
+
+    @staticmethod
+    def _append(path, data):
+        with open(path, "ab") as f:
+            f.write(data)
+
+    async def rotate(self):
+        # Everything journaled so far goes to the current generation; later
+        # entries start the next one
+        await self.flush()
+        self.generation += 1
+        return self.generation
+
+    def compact(self, generation):
+        # Drops the journals a snapshot starting at `generation` already covers
+        for path in glob.glob(glob.escape(self.path) + ".journal.*"):
+            suffix = path.rsplit(".", 1)[1]
+            if suffix.isdigit() and int(suffix) < generation:
+                os.remove(path)
+
+    def generations(self):
+        found = []
+        for path in glob.glob(glob.escape(self.path) + ".journal.*"):
+            suffix = path.rsplit(".", 1)[1]
+            if suffix.isdigit():
+                found.append(int(suffix))
+        return sorted(found)
+
+    def replay(self, generation, apply):
+        # Calls apply(kind, key, value, reason, flags) for every complete
+        # entry of `generation`; a torn tail from a crash is ignored
+        with open(self.file(generation), "rb") as f:
+            data = f.read()
+        offset, end = 0, len(data)
+        count = 0
+        while offset + ENTRY.size <= end:
+            kind, flags, value, key_length, reason_length = ENTRY.unpack_from(data, offset)
+            start = offset + ENTRY.size
+            stop = start + key_length + reason_length
+            if stop > end:
+                break
+            key = data[start:start + key_length].decode()
+            reason = data[start + key_length:stop].decode() or None
+            apply(kind, key, value, reason, flags)
+            offset = stop
+            count += 1
+        self.entries += count
+        return count
+
+
+class StatePersistence:
+    # Snapshot + journal for one LocalStateBackend (ClientStateStore or
+    # SharedClientStore, plus its fingerprint set)
+
+    def __init__(self, path, store, fingerprints, interval=300.0, idle_ttl=600.0, journal=True):
+        self.path = path
+        self.store = store
+        self.fingerprints = fingerprints
+        self.interval = interval
+        self.idle_ttl = idle_ttl
+        # Shared-memory workers skip the journal: several processes would
+        # append to and compact the same files
+        self.journal = StateJournal(path) if journal else None
+        self.snapshots = 0
+        self.snapshot_errors = 0
+        self.last_snapshot = None
+        self.last_snapshot_seconds = None
+        self.last_load = None
+        self._task = None
+
+    # --- loading ---
+
+    def load(self, now=None):
+        # Synchronous: runs before the server accepts traffic
+        if now is None:
+            now = time.time()
+        started = time.perf_counter()
+        generation = 0
+        clients = fingerprints = 0
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= HEADER.size:
+            generation, clients, fingerprints = self._load_snapshot(now)
+        replayed = 0
+        if self.journal is not None:
+            generations = [g for g in self.journal.generations() if g >= generation]
+            for g in generations:
+                replayed += self.journal.replay(g, lambda *entry: self._apply(*entry, now=now))
+            # Never append to a journal that may end in a torn entry
+            self.journal.generation = max(generations, default=generation) + 1
+        self.last_load = {
+            "clients": clients,
+            "fingerprints": fingerprints,
+            "journal_entries": replayed,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        return self.last_load
+
+    def _load_snapshot(self, now):
+        with open(self.path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Millions of new long-lived objects would otherwise trigger a
+        # collection every few hundred records
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            magic, version, _, generation, clients, fingerprints, fingerprints_at, reasons_at = HEADER.unpack_from(buf, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{self.path} is not a FlowLock snapshot (version {VERSION})")
+            (reason_count,) = LENGTH.unpack_from(buf, reasons_at)
+            names, _ = _read_strings(buf, reasons_at + LENGTH.size, reason_count)
+            # Snapshot reason codes -> this process's interned codes
+            codes = [intern_reason(name or None) for name in names]
+            restored = self.store.restore(self._read_clients(buf, HEADER.size, clients, codes, now))
+            for fingerprint in _read_strings(buf, fingerprints_at, fingerprints)[0]:
+                self.fingerprints.add(fingerprint)
+        finally:
+            if collecting:
+                gc.enable()
+            buf.close()
+        return generation, restored, fingerprints
+
+    def _read_clients(self, buf, offset, count, codes, now):
+        # The hot loop of a warm start: one unpack, one record, one array copy.
+        # Records are built without __init__, so every slot is assigned here;
+        # the store takes them in bulk and indexes blocks once at the end.
+        unpack = CLIENT.unpack_from
+        size = CLIENT.size
+        new = ClientRecord.__new__
+        # Copying an empty array and filling it is about twice as fast as
+        # calling the array() constructor per record
+        empty = array("d")
+        cutoff = now - self.idle_ttl
+        for _ in range(count):
+            (ip_length, flags, ts_count, gap_count, highest_risk, reason_code,
+             blocked_until, last_seen, gap_mean, gap_m2) = unpack(buf, offset)
+            offset += size
+            ip = buf[offset:offset + ip_length].decode()
+            offset += ip_length
+            ts_end = offset + 8 * ts_count
+            blocked = blocked_until > now
+            if last_seen <= cutoff and not blocked:
+                # The sweeper would drop it on its first pass anyway
+                offset = ts_end
+                continue
+            record = new(ClientRecord)
+            record.ts = ts = empty[:]
+            ts.frombytes(buf[offset:ts_end])
+            offset = ts_end
+            record.head = 0
+            record.stale = 0
+            record.evictions = 0
+            record.gap_count = gap_count
+            record.gap_mean = gap_mean
+            record.gap_m2 = gap_m2
+            record.last_seen = last_seen
+            if blocked:
+                record.highest_risk = highest_risk
+                record.blocked_until = blocked_until
+                record.reason_code = codes[reason_code]
+                record.flags = flags
+            else:
+                # A block that expired while we were down resets the client,
+                # same as the sweeper's unblock
+                record.highest_risk = 0 if flags else highest_risk
+                record.blocked_until = 0.0
+                record.reason_code = 0
+                record.flags = 0
+            yield ip, record
+
+    def _apply(self, kind, key, value, reason, flags, now):
+        if kind == ENTRY_FINGERPRINT:
+            self.fingerprints.add(key)
+        elif kind == ENTRY_BLOCK:
+            if value > now:
+                self.store.block(key, value, reason, now, honeypot=bool(flags))
+            else:
+                # Expired while we were down: the unblock was never journaled
+                self._unblock(key, now)
+        elif kind == ENTRY_UNBLOCK:
+            self._unblock(key, now)
+        elif kind == ENTRY_RISK:
+            record = self.store.get(key)
+            if record is not None and record.highest_risk < value:
+                with self.store.locked(key, record.last_seen) as state:
+                    state.highest_risk = max(state.highest_risk, int(value))
+
+    def _unblock(self, key, now):
+        # Same reset as the sweeper's, unless a later block is in force
+        record = self.store.get(key)
+        if record is not None and not record.is_blocked(now):
+            with self.store.locked(key, record.last_seen) as state:
+                state.unblock()
+
+    # --- snapshotting ---
+
+    async def snapshot(self):
+        if not getattr(self.store, "is_leader", True):
+            # Shared memory: the sweeping worker snapshots for everyone
+            return None
+        started = time.perf_counter()
+        generation = await self.journal.rotate() if self.journal is not None else 0
+        temp = f"{self.path}.tmp"
+        f = await asyncio.to_thread(open, temp, "wb")
+        try:
+            await asyncio.to_thread(f.write, bytes(HEADER.size))
+            clients = 0
+            for chunk in self.store.chunks(CHUNK_SIZE):
+                data = bytearray()
+                for ip, record in chunk:
+                    data += self._pack_client(ip, record)
+                clients += len(chunk)
+                # The write is where the event loop gets to serve requests
+                await asyncio.to_thread(f.write, data)
+            fingerprints_at = f.tell()
+            fingerprint_list = list(self.fingerprints)
+            data = b"".join(_pack_string(fingerprint) for fingerprint in fingerprint_list)
+            reasons_at = fingerprints_at + len(data)
+            # Reason codes are append-only, so this table covers every record written
+            names = list(REASON_CODES)
+            data += LENGTH.pack(len(names)) + b"".join(_pack_string(name or "") for name in names)
+            header = HEADER.pack(MAGIC, VERSION, time.time(), generation, clients,
+                                 len(fingerprint_list), fingerprints_at, reasons_at)
+            await asyncio.to_thread(self._finish, f, data, header)
+        except BaseException:
+            f.close()
+            self.snapshot_errors += 1
+            raise
+        await asyncio.to_thread(os.replace, temp, self.path)
+        if self.journal is not None:
+            await asyncio.to_thread(self.journal.compact, generation)
+        self.snapshots += 1
+        self.last_snapshot = time.time()
+        self.last_snapshot_seconds = round(time.perf_counter() - started, 3)
+        return clients
+
+    @staticmethod
+    def _pack_client(ip, record):
+        key = ip.encode()
+        # Oldest timestamp first, so the restored ring starts at head 0
+        ts = record.ts
+        if record.head:
+            ts = ts[record.head:] + ts[:record.head]
+        return CLIENT.pack(
+            len(key), record.flags, len(ts), record.gap_count, int(record.highest_risk), record.reason_code,
+            record.blocked_until, record.last_seen, record.gap_mean, record.gap_m2,
+        ) + key + ts.tobytes()
+
+    @staticmethod
+    def _finish(f, tail, header):
+        with f:
+            f.write(tail)
+            f.seek(0)
+            f.write(header)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # --- background task ---
+
+    async def _run_forever(self):
+        # Journal flushes every second, full snapshot every `interval`
+        due = time.monotonic() + self.interval
+        while True:
+            await asyncio.sleep(1.0)
+            if self.journal is not None:
+                await self.journal.flush()
+            if time.monotonic() >= due:
+                due = time.monotonic() + self.interval
+                try:
+                    await self.snapshot()
+                except OSError:
+                    pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+        return self._task
+
+    async def stop(self):
+        # Final snapshot, so the next start needs no journal replay
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.snapshot()
+        except OSError:
+            if self.journal is not None:
+                await self.journal.flush()
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "interval": self.interval,
+            "snapshots": self.snapshots,
+            "snapshot_errors": self.snapshot_errors,
+            "last_snapshot": self.last_snapshot,
+            "last_snapshot_seconds": self.last_snapshot_seconds,
+            "journal_generation": self.journal.generation if self.journal is not None else None,
+            "journal_pending": len(self.journal.pending) if self.journal is not None else 0,
+            "journal_write_errors": self.journal.write_errors if self.journal is not None else 0,
+            "last_load": self.last_load,
+        }
@@ -0,0 +1,140 @@
+# Where FlowLock keeps per-client state.
+#
+# The middleware and honeypot only talk to a StateBackend. Each request costs
+# one observe() (a single round trip for networked backends) followed by a
+# commit() of the scoring decision, which networked backends may defer.
+
+
+class StateBackend:
+    async def observe(self, ip, fingerprint, now):
+        # Returns (fingerprint_blocked, record).
+        # `record` is a ClientRecord snapshot that already includes this
+        # request's timestamp, unless the client is currently blocked (blocked
+        # requests are not logged). It is None when the fingerprint is blocked.
+        raise NotImplementedError
+
+    async def screen(self, ip, fingerprint, now):
+        # observe() for clients the heavy-hitter front line lets past the
+        # exact path: (fingerprint_blocked, record), where `record` is None
+        # when the client has no record yet. No record is ever created, and
+        # it is still one round trip for networked backends.
+        raise NotImplementedError
+
+    async def commit(self, ip, state, risk_score, reason, block_until, now):
+        # Persist the outcome of scoring for the record returned by observe():
+        # raise highest_risk to `risk_score` and, when `block_until` is set,
+        # block the client if it is not already
+        raise NotImplementedError
+
+    async def block_ip(self, ip, until, reason, now, honeypot=False):
+        raise NotImplementedError
+
+    async def block_fingerprint(self, fingerprint):
+        raise NotImplementedError
+
+    def peek(self, ip):
+        # Best-effort synchronous read for helpers; may return None
+        return None
+
+    async def items(self):
+        raise NotImplementedError
+
+    async def blocked_items(self):
+        raise NotImplementedError
+
+    async def blocked_count(self):
+        raise NotImplementedError
+
+    async def sweep(self):
+        # Housekeeping; returns (IPs whose block was lifted, IPs dropped from
+        # the store by idle TTL or LRU eviction)
+        return [], []
+
+    async def stats(self):
+        return {}
+
+    async def close(self):
+        pass
+
+
+class LocalStateBackend(StateBackend):
+    # In-process state: a ClientStateStore (single worker) or a
+    # SharedClientStore (multi-worker, shared memory), plus a fingerprint set.
+
+    def __init__(self, store, fingerprints):
+        self.store = store
+        self.fingerprints = fingerprints
+        # Optional snapshot.StateJournal: blocks, unblocks, blacklisted
+        # fingerprints and risk raises are journaled between snapshots
+        self.journal = None
+
+    async def observe(self, ip, fingerprint, now):
+        if fingerprint in self.fingerprints:
+            return True, None
+        with self.store.locked(ip, now) as state:
+            if state.blocked:
+                if state.blocked_until > now:
+                    return False, state
+                # Cleanup expired blocks (the sweeper usually got here first)
+                state.unblock()
+                if self.journal is not None:
+                    self.journal.unblock(ip)
+            state.append(now)
+            return False, state
+
+    async def screen(self, ip, fingerprint, now):
+        if fingerprint in self.fingerprints:
+            return True, None
+        if ip not in self.store:
+            return False, None
+        return await self.observe(ip, fingerprint, now)
+
+    async def commit(self, ip, state, risk_score, reason, block_until, now):
+        if risk_score <= state.highest_risk and not block_until:
+            return
+        with self.store.locked(ip, now) as state:
+            raised = risk_score > state.highest_risk
+            state.highest_risk = max(state.highest_risk, risk_score)
+            blocking = block_until and not state.blocked
+            if blocking:
+                state.block(block_until, reason)
+        if self.journal is not None:
+            if raised:
+                self.journal.risk(ip, risk_score)
+            if blocking:
+                self.journal.block(ip, block_until, reason)
+
+    async def block_ip(self, ip, until, reason, now, honeypot=False):
+        self.store.block(ip, until, reason, now, honeypot=honeypot)
+        if self.journal is not None:
+            self.journal.block(ip, until, reason, honeypot)
+
+    async def block_fingerprint(self, fingerprint):
+        self.fingerprints.add(fingerprint)
+        if self.journal is not None:
+            self.journal.fingerprint(fingerprint)
+
+    def peek(self, ip):
+        return self.store.get(ip)
+
+    async def items(self):
+        return self.store.items()
+
+    async def blocked_items(self):
+        return self.store.blocked_items()
+
+    async def blocked_count(self):
+        return self.store.blocked_count()
+
+    async def sweep(self):
+        unblocked, removed = self.store.sweep()
+        if self.journal is not None:
+            for ip in unblocked:
+                self.journal.unblock(ip)
+        return unblocked, removed
+
+    async def stats(self):
+        stats = self.store.stats()
+        stats["backend"] = "shared" if stats.get("shared") else "memory"
+        stats["blocked_fingerprints"] = len(self.fingerprints)
+        return stats
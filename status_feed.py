@@ -0,0 +1,106 @@
+import asyncio
+import heapq
+import json
+from collections import OrderedDict
+
+# Change feed behind /status/api and /status/stream.
+# The request path publishes a client's dashboard view only when something a
+# viewer cares about changed (risk, block, unblock) and when a client is
+# dropped from the store; viewers then receive those deltas instead of
+# re-rendering every client every few seconds.
+
+
+def change_key(view):
+    # Fields whose change is worth pushing to dashboards
+    return (view["risk"], view["blocked"], view["reason"], view["honeypot"], view["blocked_until"])
+
+
+def removed_view(ip):
+    # Tells viewers to drop the client's row
+    return {"ip": ip, "removed": True}
+
+
+class ChangeLog:
+    def __init__(self, maxlen=10000, remember=100_000):
+        # Events carry consecutive sequence numbers, so the event after `seq`
+        # sits at events[seq + 1 - first_seq]: catching up is a slice, not a
+        # scan. At least `maxlen` events are kept; the list is trimmed once it
+        # doubles, which keeps appends amortized O(1).
+        self.maxlen = maxlen
+        self.events = []
+        self.first_seq = 1
+        self.seq = 0
+        # Last published key per client, bounded LRU, used to drop no-op updates
+        self.last_key = OrderedDict()
+        self.remember = remember
+        self._changed = asyncio.Event()
+
+    def publish(self, view):
+        ip = view["ip"]
+        key = change_key(view)
+        if self.last_key.get(ip) == key:
+            return False
+        self.last_key[ip] = key
+        self.last_key.move_to_end(ip)
+        if len(self.last_key) > self.remember:
+            self.last_key.popitem(last=False)
+
+        self._append(view)
+        return True
+
+    def remove(self, ip):
+        # A client evicted from the store (idle TTL or LRU)
+        self.last_key.pop(ip, None)
+        self._append(removed_view(ip))
+
+    def _append(self, view):
+        self.seq += 1
+        self.events.append(view)
+        if len(self.events) >= 2 * self.maxlen:
+            drop = len(self.events) - self.maxlen
+            del self.events[:drop]
+            self.first_seq += drop
+        # Wake every waiting stream, then arm a fresh event for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def since(self, seq):
+        # Events after `seq`, or None when they already fell out of the log
+        # or `seq` is from before a restart (the viewer has to reload a full
+        # snapshot)
+        if seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        start = seq + 1 - self.first_seq
+        if start < 0:
+            return None
+        # Only the latest view per client matters to a viewer catching up
+        latest = {}
+        for view in self.events[start:]:
+            latest.pop(view["ip"], None)
+            latest[view["ip"]] = view
+        return list(latest.values())
+
+    async def wait(self, seq, timeout):
+        if seq < self.seq:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def top_by_risk(views, offset=0, limit=50):
+    # Top-K by risk (blocked first, then most recently blocked) without sorting everyone
+    ranked = heapq.nlargest(offset + limit, views, key=lambda v: (v["risk"], v["blocked"], v["blocked_until"]))
+    return ranked[offset:offset + limit]
+
+
+def sse_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append("data: " + json.dumps(data, separators=(",", ":")))
+    return ("\n".join(lines) + "\n\n").encode()
@@ -0,0 +1,206 @@
+import codecs
+import functools
+import urllib.parse
+
+from signature_engine import NO_MATCH
+
+# Streaming signature inspection for request bodies and headers.
+# Body chunks are scanned as the app pulls them from `receive`, feeding one
+# Aho-Corasick state across chunks (SignatureAutomaton.step), so a payload
+# split over two chunks still matches and nothing is ever buffered.
+
+# Media types whose bodies are scanned (prefix match). Bodies without a
+# content type are scanned as JSON, which is how FastAPI parses them.
+DEFAULT_BODY_TYPES = (
+    "application/json",
+    "application/x-www-form-urlencoded",
+    "text/plain",
+    "text/xml",
+    "application/xml",
+)
+
+# Headers left out of the header scan; a trailing "*" matches a name prefix.
+# Browsers fill these in themselves, so signatures there are false positives:
+# multipart boundaries ("----WebKitFormBoundary...") trip the SQL comment
+# signature, a Referer or Origin can carry any path including "../", and
+# credentials are opaque base64url tokens that contain "--" often enough.
+# What stays scanned is what a client sets freely (User-Agent,
+# X-Forwarded-For, custom headers).
+DEFAULT_SKIP_HEADERS = (
+    "authorization", "proxy-authorization", "cookie",
+    "content-type", "content-length", "content-encoding", "transfer-encoding",
+    "referer", "origin", "host",
+    "accept*", "sec-*", "if-*", "range", "cache-control", "connection",
+)
+
+JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class SignatureMatch(Exception):
+    # Raised from the wrapped `receive` when a body chunk matches
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class PercentDecoder:
+    # Incremental URL decoding: a "%4" at the end of one chunk is completed by
+    # the next chunk instead of being scanned as literal text
+    def __init__(self, plus_as_space=False):
+        self.plus_as_space = plus_as_space
+        self.pending = b""
+
+    def feed(self, data, final=False):
+        data = self.pending + data
+        self.pending = b""
+        if not final:
+            tail = data.rfind(b"%", max(0, len(data) - 2))
+            if tail != -1:
+                self.pending = data[tail:]
+                data = data[:tail]
+        if self.plus_as_space:
+            data = data.replace(b"+", b" ")
+        return urllib.parse.unquote_to_bytes(data)
+
+
+class JsonUnescaper:
+    # Incremental JSON string unescaping, so "\u005f\u005fimport\u005f\u005f"
+    # is scanned as "__import__" (structural characters are left as they are)
+    def __init__(self):
+        self.pending = ""
+
+    def feed(self, text, final=False):
+        text = self.pending + text
+        self.pending = ""
+        if "\\" not in text:
+            return text
+        out = []
+        i = 0
+        n = len(text)
+        while True:
+            j = text.find("\\", i)
+            if j == -1:
+                out.append(text[i:])
+                break
+            out.append(text[i:j])
+            end = j + 6 if text[j + 1:j + 2] == "u" else j + 2
+            if end > n:
+                if final:
+                    out.append(text[j:])
+                else:
+                    self.pending = text[j:]
+                break
+            if text[j + 1] == "u":
+                try:
+                    out.append(chr(int(text[j + 2:end], 16)))
+                except ValueError:
+                    out.append(text[j:end])
+            else:
+                out.append(JSON_ESCAPES.get(text[j + 1], text[j + 1]))
+            i = end
+        return "".join(out)
+
+
+def body_mode(headers, content_types=DEFAULT_BODY_TYPES):
+    # How to decode this request's body, or None to leave it unscanned
+    content_type = ""
+    has_body = False
+    for name, value in headers:
+        if name == b"content-type":
+            content_type = value.decode("latin-1")
+        elif name == b"content-length":
+            has_body = value.strip() not in (b"", b"0")
+        elif name == b"transfer-encoding":
+            has_body = True
+        elif name == b"content-encoding" and value.strip().lower() not in (b"", b"identity"):
+            # Compressed bodies cannot be scanned without inflating them
+            return None
+    if not has_body:
+        return None
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    if not media_type:
+        return "json"
+    if not any(media_type.startswith(prefix) for prefix in content_types):
+        return None
+    if media_type == "application/x-www-form-urlencoded":
+        return "form"
+    if media_type == "application/json" or media_type.endswith("+json"):
+        return "json"
+    return "text"
+
+
+class BodyInspector:
+    # Per-request scanner over the first `budget` bytes of the body.
+    # The automaton is pinned when the request starts, so a hot reload never
+    # mixes two rule sets inside one body.
+    __slots__ = ("automaton", "remaining", "state", "percent", "text", "json", "match")
+
+    def __init__(self, automaton, mode, budget):
+        self.automaton = automaton
+        self.remaining = budget
+        self.state = 0
+        self.percent = PercentDecoder(plus_as_space=True) if mode == "form" else None
+        self.text = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.json = JsonUnescaper() if mode == "json" else None
+        self.match = None
+
+    def feed(self, chunk, final=False):
+        # Returns the matching category, or None
+        if self.remaining <= 0:
+            return None
+        if len(chunk) >= self.remaining:
+            chunk = chunk[:self.remaining]
+            final = True
+        self.remaining -= len(chunk)
+
+        if self.percent is not None:
+            chunk = self.percent.feed(chunk, final)
+        text = self.text.decode(chunk, final)
+        if self.json is not None:
+            text = self.json.feed(text, final)
+        self.state, rank = self.automaton.step(self.state, text.lower())
+        if rank != NO_MATCH:
+            self.match = self.automaton.categories[rank]
+            self.remaining = 0
+        return self.match
+
+    def wrap(self, receive):
+        async def inspected_receive():
+            message = await receive()
+            if message["type"] == "http.request" and self.remaining > 0:
+                if self.feed(message.get("body", b""), not message.get("more_body", False)):
+                    # The chunk is never handed to the app
+                    raise SignatureMatch(self.match)
+            return message
+        return inspected_receive
+
+
+@functools.lru_cache(maxsize=16)
+def _skip_rule(skip):
+    # ("name", "prefix*", ...) -> (exact names, name prefixes), as bytes
+    exact = frozenset(name.encode("latin-1") for name in skip if not name.endswith("*"))
+    prefixes = tuple(name[:-1].encode("latin-1") for name in skip if name.endswith("*"))
+    return exact, prefixes
+
+
+def header_text(headers, skip=DEFAULT_SKIP_HEADERS):
+    # Header values joined for one scan, decoded the same way as the query.
+    # ASGI header names are already lowercase.
+    exact, prefixes = _skip_rule(tuple(skip))
+    values = [
+        value.decode("latin-1") for name, value in headers
+        if name not in exact and not name.startswith(prefixes)
+    ]
+    return urllib.parse.unquote("\n".join(values)).lower()
+
+
+@functools.lru_cache(maxsize=4096)
+def _scan_header_text(automaton, text):
+    # Keyed on the automaton too, so a rule reload never serves stale results
+    return automaton.scan(text)
+
+
+def scan_headers(engine, headers, skip=DEFAULT_SKIP_HEADERS):
+    # Most clients resend identical headers, hence the cache
+    engine.maybe_reload()
+    return _scan_header_text(engine.automaton, header_text(headers, skip))
@@ -0,0 +1,101 @@
+import asyncio
+import time
+
+from client_store import TimerWheel
+
+# Overflow policies when the tarpit is full
+OVERFLOW_REJECT = "reject"  # 429 + Retry-After
+OVERFLOW_SHED = "shed"      # 503, no body, connection closed
+
+
+class TarpitScheduler:
+    # Delays suspicious requests without one timer per request: every held
+    # request parks on a future in a shared timer wheel, and a single driver
+    # task releases whole buckets as they come due. Global and per-client caps
+    # bound how many connections the tarpit can ever hold open.
+
+    def __init__(self, max_held=1000, max_per_client=4, overflow=OVERFLOW_REJECT,
+                 min_delay=2.0, max_delay=4.0, tick=0.05):
+        self.max_held = max_held
+        self.max_per_client = max_per_client
+        self.overflow = overflow if overflow in (OVERFLOW_REJECT, OVERFLOW_SHED) else OVERFLOW_REJECT
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.tick = tick
+        self.wheel = TimerWheel(slots=256, tick=tick)
+        self.per_client = {}
+        self.held = 0
+        self._scheduled = 0  # wheel entries the driver still has to release
+        self.peak_held = 0
+        self.delayed_total = 0
+        self.overflow_total = 0
+        self._driver = None
+
+    def delay_for(self, risk):
+        # Linear from min_delay at risk 55 to max_delay at risk 99
+        fraction = min(max((risk - 55) / 44, 0.0), 1.0)
+        return self.min_delay + fraction * (self.max_delay - self.min_delay)
+
+    def has_room(self, ip):
+        return self.held < self.max_held and self.per_client.get(ip, 0) < self.max_per_client
+
+    async def delay(self, ip, risk):
+        # Returns False (without waiting) when the tarpit is full for this request
+        if not self.has_room(ip):
+            self.overflow_total += 1
+            return False
+
+        delay = self.delay_for(risk)
+        if delay <= 0:
+            # Tarpit disabled (delays configured to 0): nothing to park
+            return True
+
+        loop = asyncio.get_running_loop()
+        release = loop.create_future()
+        self.wheel.schedule(release, time.time() + delay)
+        self._scheduled += 1
+        self.held += 1
+        self.per_client[ip] = self.per_client.get(ip, 0) + 1
+        self.peak_held = max(self.peak_held, self.held)
+        self.delayed_total += 1
+        if self._driver is None:
+            self._driver = asyncio.create_task(self._drive())
+
+        try:
+            await release
+        finally:
+            # Also runs when the client disconnects mid-delay
+            self.held -= 1
+            remaining = self.per_client[ip] - 1
+            if remaining:
+                self.per_client[ip] = remaining
+            else:
+                del self.per_client[ip]
+        return True
+
+    async def _drive(self):
+        # The driver only runs while something is parked in the wheel
+        try:
+            while self._scheduled:
+                await asyncio.sleep(self.tick)
+                for release in self.wheel.advance(time.time()):
+                    self._scheduled -= 1
+                    if not release.done():
+                        release.set_result(None)
+        finally:
+            self._driver = None
+
+    def retry_after(self):
+        return str(int(self.max_delay) + 1)
+
+    def stats(self):
+        return {
+            "held": self.held,
+            "peak_held": self.peak_held,
+            "clients_held": len(self.per_client),
+            "delayed_total": self.delayed_total,
+            "overflow_total": self.overflow_total,
+            "max_held": self.max_held,
+            "max_per_client": self.max_per_client,
+            "overflow_policy": self.overflow,
+        }
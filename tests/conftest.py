@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# The modules live at the repository root, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Security events from the app under test go to a scratch file
+os.environ.setdefault("FLOWLOCK_EVENT_LOG", os.path.join(tempfile.gettempdir(), "flowlock-test-events.{pid}.jsonl"))
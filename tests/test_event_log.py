@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+from fastapi.testclient import TestClient
+
+import api_abuse_detection as flowlock
+from event_log import EventLog
+from signature_engine import SignatureEngine
+
+
+def test_events_are_written_as_jsonl(tmp_path):
+    path = tmp_path / "events.jsonl"
+    log = EventLog(path=str(path))
+    log.emit("block", ip="10.17.0.1", reason="VOLUMETRIC_FLOOD")
+    log.emit("tarpit", ip="10.17.0.2", risk=70)
+    asyncio.run(log.flush())
+    events = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [event["event"] for event in events] == ["block", "tarpit"]
+    assert list(events[0])[0] == "ts"
+
+
+def test_full_buffer_drops_and_counts():
+    log = EventLog(capacity=2)
+    for i in range(5):
+        log.emit("block", ip=f"10.17.1.{i}")
+    assert log.stats()["pending"] == 2
+    assert log.stats()["dropped"] == 3
+
+
+def test_log_defaults_to_a_file():
+    assert flowlock.event_log.path is not None
+
+
+def test_dropped_events_are_a_counter():
+    with TestClient(flowlock.app) as client:
+        text = client.get("/metrics").text
+    assert "# TYPE flowlock_event_log_dropped_total counter" in text
+    assert "# TYPE flowlock_event_log_pending gauge" in text
+
+
+def test_failed_signature_reload_goes_to_the_event_log(tmp_path, capsys):
+    rules = tmp_path / "rules.json"
+    rules.write_text("{not json")
+    events = EventLog()
+    engine = SignatureEngine(str(rules), events=events)
+    assert engine.last_error
+    assert engine.scan("union select") == "SQL_INJECTION_DETECTED"
+    [(_, kind, fields)] = list(events.ring)
+    assert kind == "signature_reload_failed"
+    assert fields["path"] == str(rules)
+    assert capsys.readouterr().out == ""
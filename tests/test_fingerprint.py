@@ -0,0 +1,45 @@
+from fastapi.testclient import TestClient
+
+import api_abuse_detection as flowlock
+
+BROWSER = [
+    (b"host", b"shop.example.com"),
+    (b"connection", b"keep-alive"),
+    (b"user-agent", b"Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/128.0"),
+    (b"accept", b"text/html,application/xhtml+xml,*/*;q=0.8"),
+    (b"accept-language", b"en-US,en;q=0.5"),
+    (b"accept-encoding", b"gzip, deflate, br"),
+]
+
+
+def fingerprint(headers):
+    return flowlock.fingerprint_from_headers(headers)
+
+
+def test_extra_custom_header_keeps_fingerprint():
+    assert fingerprint(BROWSER + [(b"x-a", b"1")]) == fingerprint(BROWSER)
+    assert fingerprint([(b"x-a", b"1")] + BROWSER) == fingerprint(BROWSER)
+
+
+def test_per_request_headers_keep_fingerprint():
+    navigation = BROWSER + [(b"upgrade-insecure-requests", b"1"), (b"sec-fetch-mode", b"navigate")]
+    image = [(name, b"image/avif,image/webp,*/*" if name == b"accept" else value) for name, value in BROWSER]
+    image += [(b"referer", b"https://shop.example.com/"), (b"sec-fetch-mode", b"no-cors")]
+    assert fingerprint(navigation) == fingerprint(image) == fingerprint(BROWSER)
+
+
+def test_browser_identity_changes_fingerprint():
+    other_agent = [(name, b"curl/8.5.0" if name == b"user-agent" else value) for name, value in BROWSER]
+    reordered = [BROWSER[0], BROWSER[2], BROWSER[1]] + BROWSER[3:]
+    assert fingerprint(other_agent) != fingerprint(BROWSER)
+    assert fingerprint(reordered) != fingerprint(BROWSER)
+
+
+def test_honeypot_blacklist_survives_an_added_header():
+    agent = "flowlock-test-fingerprint/1.0"
+    with TestClient(flowlock.app, client=("10.15.0.1", 50000)) as trapped:
+        trapped.get("/api/v1/debug_login", headers={"User-Agent": agent})
+    with TestClient(flowlock.app, client=("10.15.1.1", 50000)) as evading:
+        response = evading.get("/data", headers={"User-Agent": agent, "X-A": "1"})
+    assert response.status_code == 403
+    assert "Blacklisted" in response.json()["detail"]
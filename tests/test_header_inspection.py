@@ -0,0 +1,64 @@
+import time
+
+from fastapi.testclient import TestClient
+
+import api_abuse_detection as flowlock
+from signature_engine import SignatureEngine
+from stream_inspection import header_text, scan_headers
+
+
+def client_for(ip):
+    return TestClient(flowlock.app, client=(ip, 50000))
+
+
+def is_blocked(ip):
+    state = flowlock.state_backend.peek(ip)
+    return state is not None and state.is_blocked(time.time())
+
+
+def test_multipart_upload_is_not_a_signature():
+    # What a browser sends: the boundary starts with dashes ("--" is a SQL
+    # comment signature)
+    boundary = "----WebKitFormBoundary7MA4YWxkTrZu0gW"
+    body = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="report.txt"\r\n'
+        "Content-Type: text/plain\r\n\r\n"
+        "quarterly numbers\r\n"
+        f"--{boundary}--\r\n"
+    ).encode()
+    with client_for("10.12.0.1") as client:
+        response = client.post("/data", content=body, headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    # Reaches the app (GET-only route) instead of being denied
+    assert response.status_code == 405
+    assert not is_blocked("10.12.0.1")
+
+
+def test_referer_with_parent_path_is_not_a_signature():
+    with client_for("10.12.0.2") as client:
+        response = client.get("/data", headers={
+            "Referer": "https://example.com/docs/../guide/index.html",
+            "Origin": "https://example.com",
+            "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
+        })
+    assert response.status_code == 200
+    assert not is_blocked("10.12.0.2")
+
+
+def test_free_form_headers_are_still_scanned():
+    with client_for("10.12.0.3") as client:
+        response = client.get("/data", headers={"User-Agent": "sqlmap' union select password from users"})
+    assert response.status_code == 403
+    assert is_blocked("10.12.0.3")
+
+
+def test_skip_list_prefixes():
+    headers = [
+        (b"accept-language", b"../"),
+        (b"sec-fetch-site", b"../"),
+        (b"x-request-path", b"../etc"),
+    ]
+    assert header_text(headers, ("accept*", "sec-*")) == "../etc"
+    engine = SignatureEngine()
+    assert scan_headers(engine, headers, ("accept*", "sec-*")) == "PATH_TRAVERSAL_ATTEMPT"
+    assert scan_headers(engine, headers, ("accept*", "sec-*", "x-*")) is None
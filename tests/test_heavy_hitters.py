@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+import api_abuse_detection as flowlock
+from heavy_hitters import HeavyHitterFilter
+
+
+@pytest.fixture
+def no_tarpit_delay(monkeypatch):
+    monkeypatch.setattr(flowlock.tarpit, "min_delay", 0)
+    monkeypatch.setattr(flowlock.tarpit, "max_delay", 0)
+
+
+def inspect(ip, now):
+    return asyncio.run(flowlock.inspect_request(ip, "fp-heavy-hitters", "", [], "/data", now=now))
+
+
+def test_filter_is_off_by_default():
+    assert not flowlock.heavy_hitters.enabled
+    # ...and costs no sketch memory while off
+    assert flowlock.heavy_hitters.stats()["sketch_bytes"] == 0
+
+
+def test_history_starts_at_first_request(no_tarpit_delay):
+    # Same as with every client tracked exactly: risk follows the RPM tiers
+    # from the first request and the flood block comes at request FLOOD_RPM
+    start = 1_000_000.0
+    results = [inspect("10.14.0.1", start + i * 0.2) for i in range(flowlock.FLOOD_RPM)]
+    assert [risk for _, risk in results[:3]] == [0, 20, 60]
+    statuses = [denial.status_code if denial is not None else 200 for denial, _ in results]
+    assert statuses.index(403) == flowlock.FLOOD_RPM - 1
+
+
+def test_threshold_is_split_across_workers(monkeypatch):
+    monkeypatch.setenv("FLOWLOCK_HEAVY_HITTER_RPM", "5")
+    monkeypatch.setenv("FLOWLOCK_WORKERS", "4")
+    assert flowlock.heavy_hitter_threshold("FLOWLOCK_HEAVY_HITTER_RPM") == 5
+    monkeypatch.setenv("FLOWLOCK_SHARED_STATE", "/flowlock-test")
+    assert flowlock.heavy_hitter_threshold("FLOWLOCK_HEAVY_HITTER_RPM") == 2
+    monkeypatch.setenv("FLOWLOCK_HEAVY_HITTER_RPM", "0")
+    assert flowlock.heavy_hitter_threshold("FLOWLOCK_HEAVY_HITTER_RPM") == 0
+
+
+def test_promotion_at_threshold():
+    hitters = HeavyHitterFilter(ip_threshold=3)
+    assert [hitters.observe("10.14.0.2", "fp", 10.0) for _ in range(4)] == [False, False, True, True]
+    assert hitters.observe("10.14.0.3", "fp", 10.0) is False
+
+
+def test_light_clients_are_screened(monkeypatch, no_tarpit_delay):
+    # Below the threshold a client without a record gets no state, and one
+    # with a record goes through the exact path on the screen() result
+    for name, value in (("ip_threshold", 1000), ("ips", None), ("window_index", None)):
+        monkeypatch.setattr(flowlock.heavy_hitters, name, value)
+    start = 2_000_000.0
+    assert inspect("10.14.0.4", start) == (None, 0)
+    assert flowlock.state_backend.peek("10.14.0.4") is None
+    asyncio.run(flowlock.state_backend.block_ip("10.14.0.4", start + 60, "HONEYPOT_BREACH", start))
+    denial, _ = inspect("10.14.0.4", start + 1)
+    assert denial.status_code == 403
@@ -0,0 +1,56 @@
+import asyncio
+import json
+import os
+
+from rule_pipeline import PolicyEngine
+from signature_engine import SignatureEngine
+
+
+def write_rules(path, rules, mtime):
+    path.write_text(json.dumps(rules))
+    os.utime(path, (mtime, mtime))
+
+
+def test_reload_on_the_loop_builds_in_a_thread(tmp_path):
+    rules = tmp_path / "rules.json"
+    write_rules(rules, {"OLD_RULE": ["alpha"]}, 1000)
+    engine = SignatureEngine(str(rules))
+    assert engine.scan("alpha") == "OLD_RULE"
+    write_rules(rules, {"NEW_RULE": ["beta"]}, 2000)
+
+    async def request_path():
+        assert engine.maybe_reload(now=1e12) is True
+        # The request that noticed the change keeps the old automaton
+        assert engine.automaton.scan("beta") is None
+        # ...and a second build is not started while one is pending
+        assert engine.maybe_reload(now=2e12) is False
+        await engine.watch.pending
+
+    asyncio.run(request_path())
+    assert engine.watch.pending is None
+    assert engine.automaton.scan("beta") == "NEW_RULE"
+    assert engine.watch.reloads == 2
+
+
+def test_reload_without_a_loop_is_inline(tmp_path):
+    rules = tmp_path / "rules.json"
+    write_rules(rules, {"OLD_RULE": ["alpha"]}, 1000)
+    engine = SignatureEngine(str(rules))
+    write_rules(rules, {"NEW_RULE": ["beta"]}, 2000)
+    assert engine.maybe_reload(now=1e12) is True
+    assert engine.automaton.scan("beta") == "NEW_RULE"
+
+
+def test_policies_reload_the_same_way(tmp_path):
+    policy = tmp_path / "policy.json"
+    write_rules(policy, [{"name": "rest", "score": "behavior"}], 1000)
+    engine = PolicyEngine(str(policy))
+    write_rules(policy, [{"name": "admin", "when": {"route": {"prefix": "/admin"}}, "score": 100}], 2000)
+
+    async def request_path():
+        assert engine.maybe_reload(now=1e12) is True
+        await engine.watch.pending
+
+    asyncio.run(request_path())
+    assert [rule["name"] for rule in engine.stats()["rules"]] == ["admin"]
+    assert engine.stats()["reloads"] == 2
@@ -0,0 +1,21 @@
+from metrics import Metrics
+
+
+def test_exported_buckets_are_coarse_and_cumulative():
+    metrics = Metrics(stages=("scoring",))
+    histogram = metrics.stages["scoring"]
+    for ns in (1_000, 100_000, 100_000, 3 * 10**9):
+        histogram.record(ns)
+    buckets = {}
+    for line in metrics.render().splitlines():
+        if line.startswith("flowlock_stage_duration_seconds_bucket"):
+            le = line.split('le="')[1].split('"')[0]
+            buckets[le] = int(line.rsplit(" ", 1)[1])
+    # One bound per power of two from 2**15 to 2**30 ns, plus +Inf
+    assert len(buckets) == 17
+    assert buckets["3.2768e-05"] == 1
+    # 100 us samples sit in fine buckets between two exported bounds
+    assert buckets["6.5536e-05"] == 1
+    assert buckets["0.000131072"] == 3
+    assert buckets["1.07374182"] == 3
+    assert buckets["+Inf"] == 4
@@ -0,0 +1,396 @@
+import asyncio
+import fnmatch
+import time
+
+import pytest
+
+from behavior_features import HISTORY_SIZE
+from redis_backend import RedisError, RedisStateBackend, _read_reply
+
+
+class FakeRedisServer:
+    # Minimal in-process Redis speaking RESP2, covering exactly the commands
+    # RedisStateBackend uses. Commands named in `failing` answer with an
+    # error reply.
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.server = None
+        self.port = None
+        self.clients = set()
+        self.failing = set()
+
+    @property
+    def url(self):
+        return f"redis://127.0.0.1:{self.port}/0"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        # Closing our side lets every connection handler finish on its own
+        for writer in list(self.clients):
+            writer.close()
+        while self.clients:
+            await asyncio.sleep(0)
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while True:
+                request = await _read_reply(reader)
+                if request is None:
+                    break
+                writer.write(self._encode(self.execute(request)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    def _encode(self, value):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, RedisError):
+            return b"-%s\r\n" % str(value).encode()
+        if value is True:
+            return b"+OK\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, (list, tuple)):
+            return b"*%d\r\n" % len(value) + b"".join(self._encode(v) for v in value)
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    # --- keyspace ---
+
+    def _get(self, key, kind=None):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        value = self.data.get(key)
+        if value is None and kind is not None:
+            value = kind()
+        return value
+
+    def _set_ttl(self, key, seconds):
+        if key in self.data:
+            self.expires[key] = time.time() + seconds
+            return 1
+        return 0
+
+    @staticmethod
+    def _score(raw):
+        text = raw.decode()
+        if text in ("-inf", "+inf", "inf"):
+            return float(text), False
+        if text.startswith("("):
+            return float(text[1:]), True
+        return float(text), False
+
+    @staticmethod
+    def _in_range(score, low, high):
+        (lo, lo_ex), (hi, hi_ex) = low, high
+        return (score > lo if lo_ex else score >= lo) and (score < hi if hi_ex else score <= hi)
+
+    @staticmethod
+    def _span(length, start, stop):
+        start, stop = int(start), int(stop)
+        if start < 0:
+            start = max(length + start, 0)
+        if stop < 0:
+            stop = length + stop
+        return start, min(stop, length - 1)
+
+    def execute(self, request):
+        cmd, args = request[0].upper().decode(), request[1:]
+        if cmd in self.failing:
+            return RedisError(f"ERR injected failure in '{cmd}'")
+        handler = getattr(self, "cmd_" + cmd.lower(), None)
+        if handler is None:
+            return RedisError(f"ERR unknown command '{cmd}'")
+        try:
+            return handler(*args)
+        except (TypeError, ValueError, IndexError):
+            return RedisError(f"ERR syntax error in '{cmd}'")
+
+    def cmd_ping(self, *args):
+        return True
+
+    def cmd_auth(self, *args):
+        return True
+
+    def cmd_select(self, db):
+        return True
+
+    def cmd_flushall(self):
+        self.data.clear()
+        self.expires.clear()
+        return True
+
+    def cmd_keys(self, pattern):
+        return [k for k in list(self.data) if self._get(k) is not None and fnmatch.fnmatchcase(k.decode(), pattern.decode())]
+
+    def cmd_get(self, key):
+        return self._get(key)
+
+    def cmd_set(self, key, value, *options):
+        options = [o.upper() if isinstance(o, bytes) else o for o in options]
+        if b"NX" in options and self._get(key) is not None:
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if b"EX" in options:
+            self._set_ttl(key, float(options[options.index(b"EX") + 1]))
+        if b"PX" in options:
+            self._set_ttl(key, float(options[options.index(b"PX") + 1]) / 1000)
+        return True
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._get(key) is not None:
+                del self.data[key]
+                self.expires.pop(key, None)
+                removed += 1
+        return removed
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._get(key) is not None)
+
+    def cmd_expire(self, key, seconds):
+        return self._set_ttl(key, float(seconds)) if self._get(key) is not None else 0
+
+    def cmd_pexpire(self, key, ms):
+        return self._set_ttl(key, float(ms) / 1000) if self._get(key) is not None else 0
+
+    def cmd_rpush(self, key, *values):
+        items = self._get(key, list)
+        items.extend(values)
+        self.data[key] = items
+        return len(items)
+
+    def cmd_ltrim(self, key, start, stop):
+        items = self._get(key)
+        if items is not None:
+            start, stop = self._span(len(items), start, stop)
+            self.data[key] = items[start:stop + 1]
+            if not self.data[key]:
+                del self.data[key]
+        return True
+
+    def cmd_lrange(self, key, start, stop):
+        items = self._get(key) or []
+        start, stop = self._span(len(items), start, stop)
+        return items[start:stop + 1]
+
+    def cmd_lrem(self, key, count, value):
+        items = self._get(key)
+        if not items:
+            return 0
+        count = int(count)
+        order = range(len(items) - 1, -1, -1) if count < 0 else range(len(items))
+        limit = abs(count) or len(items)
+        hits = [i for i in order if items[i] == value][:limit]
+        for i in sorted(hits, reverse=True):
+            del items[i]
+        return len(hits)
+
+    def cmd_sadd(self, key, *members):
+        members_set = self._get(key, set)
+        before = len(members_set)
+        members_set.update(members)
+        self.data[key] = members_set
+        return len(members_set) - before
+
+    def cmd_sismember(self, key, member):
+        return int(member in (self._get(key) or ()))
+
+    def cmd_scard(self, key):
+        return len(self._get(key) or ())
+
+    def cmd_zadd(self, key, *args):
+        zset = self._get(key, dict)
+        added = 0
+        for i in range(0, len(args), 2):
+            member = args[i + 1]
+            added += member not in zset
+            zset[member] = float(args[i])
+        self.data[key] = zset
+        return added
+
+    def cmd_zcard(self, key):
+        return len(self._get(key) or {})
+
+    def cmd_zcount(self, key, low, high):
+        low, high = self._score(low), self._score(high)
+        return sum(self._in_range(s, low, high) for s in (self._get(key) or {}).values())
+
+    def cmd_zrangebyscore(self, key, low, high):
+        low, high = self._score(low), self._score(high)
+        zset = self._get(key) or {}
+        return [m for m, s in sorted(zset.items(), key=lambda item: item[1]) if self._in_range(s, low, high)]
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        low, high = self._score(low), self._score(high)
+        zset = self._get(key) or {}
+        doomed = [m for m, s in zset.items() if self._in_range(s, low, high)]
+        for member in doomed:
+            del zset[member]
+        return len(doomed)
+
+
+
+def run(test):
+    # Each test gets a fresh server and backend on its own event loop
+    async def main():
+        server = await FakeRedisServer().start()
+        backend = RedisStateBackend(server.url)
+        try:
+            await test(server, backend)
+        finally:
+            await backend.close()
+            await server.stop()
+    asyncio.run(main())
+
+
+def test_observe_records_history():
+    async def check(server, backend):
+        now = time.time()
+        for i in range(5):
+            fp_blocked, record = await backend.observe("10.0.0.1", "abcd1234", now + i * 0.1)
+        assert fp_blocked is False
+        assert len(record) == 5
+        assert record.rpm(now + 0.5) == 5
+        assert not record.is_blocked(now + 0.5)
+    run(check)
+
+
+def test_history_is_capped():
+    async def check(server, backend):
+        now = time.time()
+        for i in range(HISTORY_SIZE + 10):
+            _, record = await backend.observe("10.0.0.1", "abcd1234", now + i)
+        assert len(record) == HISTORY_SIZE
+    run(check)
+
+
+def test_commit_blocks_client():
+    async def check(server, backend):
+        now = time.time()
+        _, record = await backend.observe("10.0.0.1", "abcd1234", now)
+        await backend.commit("10.0.0.1", record, 100, "VOLUMETRIC_FLOOD", now + 60, now)
+        await backend.flush()
+        _, record = await backend.observe("10.0.0.1", "abcd1234", now + 1)
+        assert record.is_blocked(now + 1)
+        assert record.block_reason == "VOLUMETRIC_FLOOD"
+        assert record.highest_risk == 100
+        # The blocked request was taken back out of the log
+        await backend.flush()
+        assert len(server.cmd_lrange(b"flowlock:log:10.0.0.1", 0, -1)) == 1
+        assert await backend.blocked_count() == 1
+    run(check)
+
+
+def test_risk_only_rises():
+    async def check(server, backend):
+        now = time.time()
+        _, record = await backend.observe("10.0.0.1", "abcd1234", now)
+        await backend.commit("10.0.0.1", record, 60, "SCANNING", 0, now)
+        await backend.flush()
+        _, record = await backend.observe("10.0.0.1", "abcd1234", now + 1)
+        assert record.highest_risk == 60
+        await backend.commit("10.0.0.1", record, 20, "SCANNING", 0, now + 1)
+        await backend.flush()
+        _, record = await backend.observe("10.0.0.1", "abcd1234", now + 2)
+        assert record.highest_risk == 60
+    run(check)
+
+
+def test_fingerprint_blacklist_applies_to_new_ips():
+    async def check(server, backend):
+        now = time.time()
+        await backend.block_fingerprint("abcd1234")
+        fp_blocked, record = await backend.observe("10.0.0.2", "abcd1234", now)
+        assert fp_blocked is True
+        assert record is None
+        assert await backend.screen("10.0.0.3", "abcd1234", now) == (True, None)
+        fp_blocked, _ = await backend.observe("10.0.0.2", "ffff0000", now)
+        assert fp_blocked is False
+    run(check)
+
+
+def test_screen_does_not_create_records():
+    async def check(server, backend):
+        now = time.time()
+        assert await backend.screen("10.0.0.1", "abcd1234", now) == (False, None)
+        await backend.flush()
+        assert await backend.items() == []
+        await backend.observe("10.0.0.1", "abcd1234", now)
+        # An existing record is observed in the same round trip
+        _, record = await backend.screen("10.0.0.1", "abcd1234", now + 1)
+        assert len(record) == 2
+        await backend.flush()
+        _, record = await backend.observe("10.0.0.1", "abcd1234", now + 2)
+        assert len(record) == 3
+    run(check)
+
+
+def test_honeypot_block():
+    async def check(server, backend):
+        now = time.time()
+        await backend.block_ip("10.0.0.1", now + 86400, "HONEYPOT_BREACH", now, honeypot=True)
+        [(ip, record)] = await backend.blocked_items()
+        assert ip == "10.0.0.1"
+        assert record.honeypot
+        assert record.block_reason == "HONEYPOT_BREACH"
+    run(check)
+
+
+def test_sweep_reports_lifted_blocks():
+    async def check(server, backend):
+        now = time.time()
+        await backend.block_ip("10.0.0.1", now - 1, "VOLUMETRIC_FLOOD", now - 61)
+        await backend.block_ip("10.0.0.2", now + 60, "VOLUMETRIC_FLOOD", now)
+        assert await backend.sweep() == (["10.0.0.1"], [])
+        assert await backend.blocked_count() == 1
+    run(check)
+
+
+def test_error_reply_is_not_a_blocked_fingerprint():
+    async def check(server, backend):
+        server.failing.add("SISMEMBER")
+        with pytest.raises(RedisError):
+            await backend.observe("10.0.0.1", "abcd1234", time.time())
+        with pytest.raises(RedisError):
+            await backend.screen("10.0.0.1", "abcd1234", time.time())
+    run(check)
+
+
+def test_sweep_reports_idle_clients():
+    async def check(server, backend):
+        now = time.time()
+        await backend.observe("10.0.0.1", "abcd1234", now - backend.idle_ttl - 1)
+        await backend.observe("10.0.0.2", "abcd1234", now)
+        assert await backend.sweep() == ([], ["10.0.0.1"])
+        assert [ip for ip, _ in await backend.items()] == ["10.0.0.2"]
+    run(check)
+
+
+def test_deferred_errors_are_counted():
+    async def check(server, backend):
+        now = time.time()
+        _, record = await backend.observe("10.0.0.1", "abcd1234", now)
+        server.failing.add("SET")
+        await backend.commit("10.0.0.1", record, 60, "SCANNING", 0, now)
+        await backend.flush()
+        stats = await backend.stats()
+        assert stats["deferred_errors"] == 1
+        assert stats["entries"] == 1
+    run(check)
@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import sys
+
+from event_log import EventLog
+from rule_pipeline import BLOCK, SCORE, PolicyEngine, RequestFacts, RulePipeline
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def facts(route="/data", rpm=1, variance=1.0, signature=None):
+    return RequestFacts(route, "fp", False, rpm, variance, rpm, 0, None, "", None,
+                        lambda query, headers: signature, lambda rpm, variance, limits: (0, "SCANNING"))
+
+
+def test_first_matching_rule_decides():
+    pipeline = RulePipeline([
+        {"name": "admin", "when": {"route": {"prefix": "/admin"}}, "score": 100, "action": "block", "reason": "ADMIN"},
+        {"name": "sig", "when": {"signature": True}, "score": 100},
+        {"name": "rest", "score": "behavior"},
+    ])
+    assert pipeline.evaluate(facts(route="/admin/users"))[:3] == (100, "ADMIN", BLOCK)
+    assert pipeline.evaluate(facts(signature="PATH_TRAVERSAL_ATTEMPT"))[:3] == (100, "PATH_TRAVERSAL_ATTEMPT", SCORE)
+    assert pipeline.evaluate(facts())[:3] == (0, "SCANNING", SCORE)
+
+
+def test_failed_reload_goes_to_the_event_log(tmp_path, capsys):
+    policy = tmp_path / "policy.json"
+    policy.write_text(json.dumps([{"name": "bad", "when": {"nope": 1}}]))
+    events = EventLog()
+    engine = PolicyEngine(str(policy), events=events)
+    assert "unknown condition" in engine.last_error
+    # Still the built-in policy, and the broken file is not retried
+    assert engine.pipeline.source != str(policy)
+    assert engine.maybe_reload(now=1e12) is False
+    [(_, kind, fields)] = list(events.ring)
+    assert kind == "policy_reload_failed"
+    assert fields["path"] == str(policy)
+    assert capsys.readouterr().out == ""
+
+
+def test_replay_refuses_a_custom_policy(tmp_path):
+    log = tmp_path / "traffic.jsonl"
+    log.write_text(json.dumps({"ts": 1718000000.0, "ip": "10.20.0.1", "path": "/data"}) + "\n")
+    policy = tmp_path / "policy.json"
+    policy.write_text(json.dumps([{"name": "rest", "score": "behavior"}]))
+    env = dict(os.environ, FLOWLOCK_POLICY=str(policy))
+    result = subprocess.run([sys.executable, "replay.py", str(log)], cwd=ROOT, env=env, capture_output=True, text=True)
+    assert result.returncode != 0
+    assert "FLOWLOCK_POLICY" in result.stderr
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+from client_store import ClientStateStore
+from snapshot import StatePersistence
+from state_backend import LocalStateBackend
+
+
+def open_backend(path):
+    backend = LocalStateBackend(ClientStateStore(max_entries=1000, idle_ttl=600), set())
+    persistence = StatePersistence(str(path), backend.store, backend.fingerprints, idle_ttl=600)
+    backend.journal = persistence.journal
+    return backend, persistence
+
+
+def test_unblock_survives_a_restart(tmp_path):
+    path = tmp_path / "state.bin"
+    now = time.time()
+
+    async def run_first_process():
+        backend, persistence = open_backend(path)
+        persistence.load(now)
+        _, state = await backend.observe("10.18.0.1", "fp", now)
+        await persistence.snapshot()
+        # Blocked after the snapshot, lifted by the sweeper before the crash
+        await backend.commit("10.18.0.1", state, 100, "VOLUMETRIC_FLOOD", now + 0.01, now)
+        await asyncio.sleep(0.02)
+        assert await backend.sweep() == (["10.18.0.1"], [])
+        await backend.journal.flush()
+
+    asyncio.run(run_first_process())
+    backend, persistence = open_backend(path)
+    persistence.load()
+    record = backend.peek("10.18.0.1")
+    assert not record.blocked
+    assert record.highest_risk == 0
+
+
+def test_block_that_expired_while_down_resets_the_risk(tmp_path):
+    path = tmp_path / "state.bin"
+    now = 1_000_000.0
+
+    async def crash_while_blocked():
+        backend, persistence = open_backend(path)
+        persistence.load(now)
+        _, state = await backend.observe("10.18.0.3", "fp", now)
+        await persistence.snapshot()
+        await backend.commit("10.18.0.3", state, 100, "VOLUMETRIC_FLOOD", now + 60, now)
+        await backend.journal.flush()
+
+    asyncio.run(crash_while_blocked())
+    backend, persistence = open_backend(path)
+    persistence.load(now + 120)
+    record = backend.peek("10.18.0.3")
+    assert not record.blocked
+    assert record.highest_risk == 0
+
+
+def test_warm_start_indexes_blocks_and_caps_the_store(tmp_path):
+    path = tmp_path / "state.bin"
+    now = time.time()
+
+    async def write_snapshot():
+        backend, persistence = open_backend(path)
+        for i in range(20):
+            await backend.observe(f"10.18.1.{i}", "fp", now)
+        await backend.block_ip("10.18.1.19", now + 60, "HONEYPOT_BREACH", now)
+        await persistence.snapshot()
+
+    asyncio.run(write_snapshot())
+    store = ClientStateStore(max_entries=10, idle_ttl=600)
+    persistence = StatePersistence(str(path), store, set(), idle_ttl=600)
+    assert persistence.load()["clients"] == 20
+    # The oldest records go once the whole snapshot is in
+    assert [ip for ip, _ in store.items()] == [f"10.18.1.{i}" for i in range(10, 20)]
+    assert [ip for ip, _ in store.blocked_items()] == ["10.18.1.19"]
+    assert store.sweep(now + 61) == (["10.18.1.19"], [f"10.18.1.{i}" for i in range(10)])
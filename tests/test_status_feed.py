@@ -0,0 +1,55 @@
+import time
+
+from client_store import ClientStateStore
+from status_feed import ChangeLog
+
+
+def view(ip, risk):
+    return {"ip": ip, "risk": risk, "blocked": False, "reason": None, "honeypot": False, "blocked_until": 0}
+
+
+def test_since_returns_latest_view_per_client():
+    log = ChangeLog()
+    log.publish(view("10.0.0.1", 20))
+    log.publish(view("10.0.0.2", 40))
+    log.publish(view("10.0.0.1", 60))
+    assert log.since(0) == [view("10.0.0.2", 40), view("10.0.0.1", 60)]
+    assert log.since(2) == [view("10.0.0.1", 60)]
+    assert log.since(3) == []
+
+
+def test_since_reports_trimmed_history():
+    log = ChangeLog(maxlen=10)
+    for i in range(25):
+        log.publish(view(f"10.0.0.{i}", i + 1))
+    assert log.since(0) is None
+    assert len(log.events) < 20
+    assert log.since(24) == [view("10.0.0.24", 25)]
+    assert log.since(log.first_seq - 1) is not None
+
+
+def test_since_after_a_restart_needs_a_snapshot():
+    # A Last-Event-ID from the previous process is ahead of the new log
+    log = ChangeLog()
+    log.publish(view("10.0.0.1", 20))
+    assert log.since(500) is None
+
+
+def test_removed_clients_are_published():
+    log = ChangeLog()
+    log.publish(view("10.0.0.1", 20))
+    log.remove("10.0.0.1")
+    assert log.since(0) == [{"ip": "10.0.0.1", "removed": True}]
+    # A returning client is published again even with an unchanged view
+    assert log.publish(view("10.0.0.1", 20))
+
+
+def test_store_reports_evicted_clients():
+    now = time.time()
+    store = ClientStateStore(max_entries=2, idle_ttl=60)
+    store.touch("10.0.0.1", now)
+    store.touch("10.0.0.2", now - 120)
+    store.touch("10.0.0.3", now)
+    # 10.0.0.1 went out by LRU, 10.0.0.2 by idle TTL
+    assert store.sweep(now) == ([], ["10.0.0.1", "10.0.0.2"])
+    assert store.sweep(now) == ([], [])